@@ -0,0 +1,131 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+"""Rolling-window activity counts, kept up to date as events arrive.
+
+Counts are kept per project and per reviewer, for each of these kinds of
+activity:
+
+- ``reviews``: comments by people, rather than CI systems.
+- ``approvals``: Workflow +1 votes.
+- ``merges``: merged changes (counted for whoever submitted them).
+- ``ci-votes``: comments casting a Verified vote.
+"""
+
+import collections
+import json
+import threading
+import time
+
+
+# Each window's name, and the number and width (in seconds) of its buckets.
+WINDOWS = (
+    ('hour', 60, 60),
+    ('day', 96, 900),
+    ('week', 168, 3600),
+)
+
+
+def classify(event):
+    """Return the kinds of activity in an event, and who did them."""
+    if event['type'] == 'change-merged':
+        submitter = event.get('submitter') or {}
+        return ['merges'], submitter.get('username')
+    if event['type'] != 'comment-added':
+        return [], None
+
+    kinds = []
+    verified = False
+    for approval in event.get('approvals', ()):
+        if approval['type'] == 'Verified' and approval['value'] != '0':
+            verified = True
+        elif approval['type'] == 'Workflow' and approval['value'] == '1':
+            kinds.append('approvals')
+    kinds.append('ci-votes' if verified else 'reviews')
+    return kinds, event['author'].get('username')
+
+
+class Ring(object):
+    """Counts over a sliding window, in a fixed number of time buckets.
+
+    Each bucket counts the events within ``width`` seconds, and is recycled
+    once it falls out of the window, so the ring never holds more than
+    ``size`` buckets.
+    """
+
+    def __init__(self, size, width):
+        self.size = size
+        self.width = width
+        self.buckets = [(None, None)] * size
+
+    def add(self, key, when):
+        index = int(when // self.width)
+        slot = index % self.size
+        bucket_index, counts = self.buckets[slot]
+        if bucket_index != index:
+            if bucket_index is not None and bucket_index > index:
+                # Too old to be in the window any more.
+                return
+            counts = collections.Counter()
+            self.buckets[slot] = (index, counts)
+        counts[key] += 1
+
+    def totals(self, now):
+        """Return the counts of each key within the window ending now."""
+        current = int(now // self.width)
+        totals = collections.Counter()
+        for index, counts in self.buckets:
+            if index is not None and current - self.size < index <= current:
+                totals.update(counts)
+        return totals
+
+
+class Activity(object):
+    """Activity per project and per reviewer over each of WINDOWS."""
+
+    def __init__(self, windows=WINDOWS):
+        self.lock = threading.Lock()
+        self.rings = [(name, Ring(size, width))
+                      for name, size, width in windows]
+
+    def add(self, event):
+        kinds, username = classify(event)
+        if not kinds:
+            return
+        project = event['change'].get('project')
+        when = event.get('received_at') or time.time()
+        keys = []
+        for kind in kinds:
+            keys.append(('projects', project, kind))
+            if username is not None:
+                keys.append(('reviewers', username, kind))
+        with self.lock:
+            for name, ring in self.rings:
+                for key in keys:
+                    ring.add(key, when)
+
+    def snapshot(self, now=None):
+        """Return the counts in each window as nested dicts."""
+        now = time.time() if now is None else now
+        snapshot = {'generated_at': now}
+        for name, ring in self.rings:
+            with self.lock:
+                totals = ring.totals(now)
+            window = {'projects': {}, 'reviewers': {}}
+            for (group, key, kind), count in totals.items():
+                window[group].setdefault(key, {})[kind] = count
+            snapshot[name] = window
+        return snapshot
+
+    def render(self):
+        """Return a snapshot as JSON."""
+        return json.dumps(self.snapshot(), indent=2, sort_keys=True) + '\n'
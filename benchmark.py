@@ -0,0 +1,701 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+"""Benchmarks for gerrit-logger, runnable without access to Gerrit."""
+
+import argparse
+import copy
+import json
+import os
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    from http import server as http_server
+    import socketserver
+except ImportError:
+    import BaseHTTPServer as http_server
+    import SocketServer as socketserver
+
+import activity
+import event_archive
+import event_log
+import event_logger
+import event_store
+import fake_gerrit
+import priority_rules
+import summarize_events
+
+BUGSMASH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bugsmash')
+
+
+def percentile(values, fraction):
+    """Return the value at the given fraction of a sorted list."""
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, int(len(values) * fraction))
+    return values[index]
+
+
+def report(name, count, elapsed, nbytes=None, lags=None, unit='events'):
+    print('%s: %d %s in %.3fs (%.0f %s/s)' % (
+        name, count, unit, elapsed, count / elapsed if elapsed else 0.0,
+        unit))
+    if nbytes is not None:
+        print('  %.2f MiB/s' % (nbytes / elapsed / 1024 / 1024))
+    if lags:
+        lags = sorted(lags)
+        print('  lag p50=%.3fms p99=%.3fms max=%.3fms' % (
+            percentile(lags, 0.50) * 1000,
+            percentile(lags, 0.99) * 1000,
+            lags[-1] * 1000))
+
+
+def bench_stream(args):
+    """Measure read_lines() throughput and lag over a local socket.
+
+    A writer thread plays the part of Gerrit, sending bursts of events which
+    carry the time they were sent. The reader records how long each event
+    took to come out of read_lines().
+    """
+    reader, writer = socket.socketpair()
+    padding = 'x' * args.event_size
+
+    def produce():
+        for i in range(0, args.events, args.burst):
+            burst = []
+            for _ in range(i, min(i + args.burst, args.events)):
+                burst.append(json.dumps({
+                    'type': 'comment-added',
+                    'sent_at': time.time(),
+                    'comment': padding}))
+            writer.sendall(('\n'.join(burst) + '\n').encode('utf-8'))
+            if args.interval:
+                time.sleep(args.interval)
+        writer.close()
+
+    thread = threading.Thread(target=produce)
+    lags = []
+    nbytes = 0
+    start = time.time()
+    thread.start()
+    for line in event_logger.read_lines(reader):
+        event = json.loads(line.decode('utf-8'))
+        lags.append(time.time() - event['sent_at'])
+        nbytes += len(line) + 1
+    elapsed = time.time() - start
+    thread.join()
+    reader.close()
+    report('stream', len(lags), elapsed, nbytes=nbytes, lags=lags)
+
+
+def scan_contributors(token, contributors, fields):
+    """Find a contributor the way validate_ids.py used to, for comparison."""
+    for contributor in contributors:
+        for field in fields:
+            value = contributor.get(field)
+            if value is not None and value.lower() == token:
+                return contributor
+        for email in contributor.get('emails') or []:
+            if email.lower() == token:
+                return contributor
+
+
+def replicate_contributors(snapshot, count, fields):
+    """Return count contributors, copying a snapshot with suffixed ids."""
+    contributors = list(snapshot)
+    copies = 0
+    while len(contributors) < count:
+        copies += 1
+        for contributor in snapshot:
+            contributor = copy.deepcopy(contributor)
+            for field in fields:
+                if contributor.get(field):
+                    contributor[field] = '%s-%d' % (contributor[field], copies)
+            contributor['emails'] = [
+                '%d-%s' % (copies, email)
+                for email in contributor.get('emails') or []]
+            contributors.append(contributor)
+    return contributors[:count]
+
+
+def bench_ids(args):
+    """Compare scanning for contributors with looking them up in an index.
+
+    The Stackalytics snapshot is replicated (with suffixed identifiers) to
+    reach the requested number of contributors.
+    """
+    sys.path.insert(0, BUGSMASH)
+    import validate_ids
+
+    with open(args.snapshot) as f:
+        snapshot = json.load(f)
+    with open(args.tokens) as f:
+        tokens = [line.strip().lower() for line in f if line.strip()]
+
+    contributors = replicate_contributors(
+        snapshot, args.contributors, validate_ids.IDENTIFIER_FIELDS)
+    print('%d contributors, %d tokens' % (len(contributors), len(tokens)))
+
+    start = time.time()
+    scanned = [
+        scan_contributors(token, contributors, validate_ids.IDENTIFIER_FIELDS)
+        for token in tokens]
+    elapsed = time.time() - start
+    print('scan: %.3fs (%.0f lookups/s)' % (elapsed, len(tokens) / elapsed))
+
+    start = time.time()
+    index = validate_ids.build_index(contributors)
+    built = time.time() - start
+    start = time.time()
+    found = [
+        contributors[index[token]] if token in index else None
+        for token in tokens]
+    elapsed = time.time() - start
+    print('index: built in %.3fs, %d identifiers; lookups %.6fs '
+          '(%.0f lookups/s)' % (
+              built, len(index), elapsed,
+              len(tokens) / elapsed if elapsed else float('inf')))
+
+    mismatches = sum(1 for a, b in zip(scanned, found) if a is not b)
+    print('mismatches: %d' % mismatches)
+
+
+def serve_stackalytics(contributors, latency):
+    """Serve contributors from a stand-in for the Stackalytics API.
+
+    Every request is delayed by latency seconds. Returns the server and its
+    base URL.
+    """
+    users = dict((c['id'], c) for c in contributors)
+
+    class Handler(http_server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            time.sleep(latency)
+            path = self.path.split('?', 1)[0]
+            if path == '/api/1.0/users':
+                body = {'data': [
+                    {'id': c['id'], 'text': c.get('text'),
+                     'seq': c.get('seq')}
+                    for c in contributors]}
+            elif path.startswith('/api/1.0/users/') and (
+                    path[len('/api/1.0/users/'):] in users):
+                body = {'user': users[path[len('/api/1.0/users/'):]]}
+            else:
+                self.send_error(404)
+                return
+            body = json.dumps(body).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    class Server(socketserver.ThreadingMixIn, http_server.HTTPServer):
+        daemon_threads = True
+
+    server = Server(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, 'http://127.0.0.1:%d/api/1.0' % server.server_address[1]
+
+
+def bench_refresh(args):
+    """Measure refreshing a Stackalytics snapshot from a local stand-in."""
+    sys.path.insert(0, BUGSMASH)
+    import validate_ids
+
+    with open(args.snapshot) as f:
+        snapshot = json.load(f)
+    contributors = replicate_contributors(
+        snapshot, args.contributors, validate_ids.IDENTIFIER_FIELDS)
+    for seq, contributor in enumerate(contributors):
+        contributor['seq'] = seq
+    server, url = serve_stackalytics(contributors, args.latency)
+
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        for name, workers, full in (('serial, full', 1, True),
+                                    ('concurrent, full', args.workers, True),
+                                    ('concurrent, unchanged', args.workers,
+                                     False)):
+            start = time.time()
+            validate_ids.fetch_contributors(url, path, workers, full)
+            report(name, len(contributors), time.time() - start,
+                   unit='contributors')
+
+        # Change the summaries of some contributors, as if they'd moved on.
+        for contributor in contributors[::args.changed_every]:
+            contributor['seq'] += len(contributors)
+        start = time.time()
+        refreshed = validate_ids.fetch_contributors(url, path, args.workers)
+        report('concurrent, incremental', len(contributors),
+               time.time() - start, unit='contributors')
+        mismatches = sum(
+            1 for a, b in zip(contributors, refreshed) if a != b)
+        print('mismatches: %d' % mismatches)
+    finally:
+        server.shutdown()
+        os.remove(path)
+
+
+def bench_store(args):
+    """Compare the size and decoding speed of JSON lines and event stores."""
+    fd, store = tempfile.mkstemp(suffix='.store')
+    os.close(fd)
+    os.remove(store)
+    try:
+        start = time.time()
+        event_store.to_store(args.log, store)
+        print('converted in %.3fs' % (time.time() - start))
+
+        jsonl_size = os.path.getsize(args.log)
+        store_size = os.path.getsize(store)
+        print('jsonl: %d bytes; store: %d bytes (%.1f%%)' % (
+            jsonl_size, store_size, 100.0 * store_size / jsonl_size))
+
+        start = time.time()
+        with open(args.log, 'rb') as f:
+            count = sum(1 for line in f if json.loads(line.decode('utf-8')))
+        report('jsonl decode', count, time.time() - start)
+
+        start = time.time()
+        count = sum(1 for event in event_store.read_store(store))
+        report('store decode', count, time.time() - start)
+    finally:
+        os.remove(store)
+
+
+def bench_archive(args):
+    """Compare reading a JSON lines log with reading an archive of it."""
+    fd, path = tempfile.mkstemp(suffix='.archive')
+    os.close(fd)
+    try:
+        start = time.time()
+        event_archive.archive([args.log], path, args.block_bytes)
+        print('archived in %.3fs' % (time.time() - start))
+
+        jsonl_size = os.path.getsize(args.log)
+        archive_size = os.path.getsize(path)
+        print('jsonl: %d bytes; archive: %d bytes (%.1f%%)' % (
+            jsonl_size, archive_size, 100.0 * archive_size / jsonl_size))
+
+        for name, log in (('jsonl', args.log), ('archive', path)):
+            start = time.time()
+            count = sum(1 for event in event_log.iter_events(
+                log, jobs=args.jobs))
+            report('%s read' % name, count, time.time() - start)
+
+        # Read the last tenth of the log, as a report on recent events would.
+        blocks = event_archive.read_index(path)
+        since = blocks[len(blocks) * 9 // 10]['first']
+        for name, log in (('jsonl', args.log), ('archive', path)):
+            start = time.time()
+            count = sum(1 for event in event_log.iter_events(
+                log, since=since, jobs=args.jobs))
+            report('%s recent' % name, count, time.time() - start)
+    finally:
+        os.remove(path)
+
+
+def bench_rules(args):
+    """Measure priority rule evaluation against random rules and events."""
+    rng = random.Random(args.seed)
+    projects = ['openstack/project-%d' % i for i in range(args.projects)]
+    users = ['user%d' % i for i in range(args.users)]
+    types = ['comment-added', 'patchset-created', 'change-merged',
+             'change-abandoned', 'reviewer-added']
+    labels = ['Code-Review', 'Verified', 'Workflow']
+
+    rules = []
+    for _ in range(args.rules):
+        rule = {}
+        if rng.random() < 0.8:
+            rule['projects'] = rng.sample(projects, rng.randint(1, 3))
+        if rng.random() < 0.3:
+            rule['owners'] = rng.sample(users, rng.randint(1, 5))
+        if rng.random() < 0.3:
+            rule['reviewers'] = rng.sample(users, rng.randint(1, 5))
+        if rng.random() < 0.5:
+            rule['types'] = rng.sample(types, rng.randint(1, 2))
+        if rng.random() < 0.3:
+            rule['approvals'] = ['%s <= -1' % rng.choice(labels)]
+        if 'projects' not in rule and 'owners' not in rule:
+            rule['owners'] = rng.sample(users, rng.randint(1, 5))
+        rules.append(rule)
+
+    events = []
+    for _ in range(args.events):
+        events.append({
+            'type': rng.choice(types),
+            'author': {'username': rng.choice(users)},
+            'approvals': [{
+                'type': rng.choice(labels),
+                'value': str(rng.randint(-2, 2))}],
+            'change': {
+                'project': rng.choice(projects),
+                'branch': 'master',
+                'owner': {'username': rng.choice(users)}}})
+
+    start = time.time()
+    compiled = priority_rules.Rules(rules)
+    print('compiled %d rules in %.3fs' % (len(rules), time.time() - start))
+
+    start = time.time()
+    matched = sum(1 for event in events if compiled.match(event))
+    report('rules', len(events), time.time() - start)
+    print('  %d events matched' % matched)
+
+
+def generate_log(args, path):
+    """Write a log of synthetic events, received a second apart."""
+    generator = fake_gerrit.EventGenerator(
+        projects=args.projects, users=args.users, seed=args.seed)
+    received_at = time.time() - args.events
+    with open(path, 'wb') as f:
+        for event in generator.events(args.events):
+            event['received_at'] = received_at
+            received_at += 1
+            f.write(event_log.encode_event(event))
+    return generator
+
+
+def bench_logger(args):
+    """Measure the logger end to end, against a fake Gerrit over SSH."""
+    generator = fake_gerrit.EventGenerator(
+        projects=args.projects, users=args.users, seed=args.seed)
+    lines = list(generator.lines(args.events))
+
+    def source():
+        started = time.time()
+        for i, line in enumerate(lines):
+            if args.rate:
+                wait = started + i / args.rate - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+            yield line
+
+    sent = []
+    server = fake_gerrit.FakeGerritServer(
+        source, batch=args.burst,
+        sent=lambda sent_at, count: sent.extend([sent_at] * count))
+    server.start()
+
+    fd, path = tempfile.mkstemp(suffix='.log')
+    os.close(fd)
+    writer = event_log.EventLogWriter(path, flush_events=args.flush_events)
+    lags = []
+    start = time.time()
+    try:
+        events = event_logger.list_events(
+            server.host, server.port, 'benchmark', password='benchmark')
+        for i, event in enumerate(events):
+            event['received_at'] = time.time()
+            lags.append(event['received_at'] - sent[i])
+            writer.write(event)
+            event_logger.is_priority(
+                event, server.host, server.port, 'benchmark')
+        elapsed = time.time() - start
+    finally:
+        writer.close()
+        server.close()
+        nbytes = os.path.getsize(path)
+        os.remove(path)
+    report('logger', len(lags), elapsed, nbytes=nbytes, lags=lags)
+
+
+def cpu_time():
+    """Return the CPU time used by this process so far, in seconds."""
+    times = os.times()
+    return times[0] + times[1]
+
+
+def bench_ingest(args):
+    """Compare the CPU cost per event of decoding events and of raw lines.
+
+    Each event goes through the logger's main loop: it's counted, added to
+    the activity counts, stamped, logged and checked for priority.
+    """
+    generator = fake_gerrit.EventGenerator(
+        projects=args.projects, users=args.users, seed=args.seed)
+    lines = [line.rstrip(b'\n') for line in generator.lines(args.events)]
+    if args.rules:
+        event_logger.RULES = priority_rules.Rules.load(args.rules)
+
+    def decoded(line):
+        return json.loads(line.decode('utf-8'))
+
+    for name, parse in (('decoded', decoded), ('raw', event_log.RawEvent)):
+        fd, path = tempfile.mkstemp(suffix='.log')
+        os.close(fd)
+        writer = event_log.EventLogWriter(path, flush_events=1000)
+        counts = activity.Activity()
+        start = time.time()
+        cpu = cpu_time()
+        try:
+            for line in lines:
+                event = parse(line)
+                event['received_at'] = time.time()
+                event['origin'] = 'benchmark'
+                event_logger.record_event(event)
+                counts.add(event)
+                writer.write(event)
+                event_logger.is_priority(
+                    event, 'benchmark', 29418, 'benchmark')
+            cpu = cpu_time() - cpu
+            elapsed = time.time() - start
+        finally:
+            writer.close()
+            os.remove(path)
+        report(name, len(lines), elapsed)
+        print('  %.1fus CPU per event' % (cpu / len(lines) * 1000000))
+
+
+def bench_render(args):
+    """Measure how quickly a synthetic log is rendered as markdown."""
+    # Imported here, as it reconfigures the default encoding when imported.
+    import events_in_english
+
+    fd, path = tempfile.mkstemp(suffix='.log')
+    os.close(fd)
+    try:
+        generate_log(args, path)
+        start = time.time()
+        rendered = 0
+        for event in event_log.iter_events(path):
+            if events_in_english.render(event) is not None:
+                rendered += 1
+        elapsed = time.time() - start
+    finally:
+        os.remove(path)
+    report('render', args.events, elapsed)
+    print('  %d lines rendered (%.0f lines/s)' % (
+        rendered, rendered / elapsed))
+
+
+def bench_summarize(args):
+    """Measure how quickly a synthetic log is summarized."""
+    fd, path = tempfile.mkstemp(suffix='.log')
+    os.close(fd)
+    try:
+        generator = generate_log(args, path)
+        users = [user['username'] for user in generator.users[::2]]
+        start = time.time()
+        summary = summarize_events.Summary(users)
+        summary.update(event_log.iter_events(path))
+        elapsed = time.time() - start
+    finally:
+        os.remove(path)
+    report('summarize', args.events, elapsed)
+
+
+def bench_prefilter(args):
+    """Compare decoding every event with skipping ignored types first."""
+    path = args.log
+    if path is None:
+        fd, path = tempfile.mkstemp(suffix='.log')
+        os.close(fd)
+        generate_log(args, path)
+    try:
+        print('%d bytes' % os.path.getsize(path))
+        start = time.time()
+        with open(path, 'rb') as f:
+            kept = 0
+            count = 0
+            for line in f:
+                count += 1
+                event = json.loads(line.decode('utf-8'))
+                if event['type'] not in event_log.IGNORED_TYPES:
+                    kept += 1
+        report('decode all', count, time.time() - start)
+
+        start = time.time()
+        prefiltered = sum(1 for event in event_log.iter_events(
+            path, ignore=event_log.IGNORED_TYPES))
+        report('prefilter', count, time.time() - start)
+        print('  %d of %d events kept (%d expected)' % (
+            prefiltered, count, kept))
+    finally:
+        if args.log is None:
+            os.remove(path)
+
+
+def add_generator_arguments(parser, events=100000):
+    parser.add_argument(
+        '--events', type=int, default=events,
+        help='Number of events to generate.')
+    parser.add_argument(
+        '--projects', type=int, default=100,
+        help='Number of distinct projects.')
+    parser.add_argument(
+        '--users', type=int, default=1000,
+        help='Number of distinct users.')
+    parser.add_argument(
+        '--seed', type=int, default=0,
+        help='Random seed.')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark gerrit-logger without a Gerrit server.')
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+
+    stream = subparsers.add_parser(
+        'stream', help='Read events from a local socket stand-in.')
+    stream.add_argument(
+        '--events', type=int, default=100000,
+        help='Number of events to send.')
+    stream.add_argument(
+        '--burst', type=int, default=50,
+        help='Number of events sent back to back.')
+    stream.add_argument(
+        '--interval', type=float, default=0.0,
+        help='Seconds to wait between bursts.')
+    stream.add_argument(
+        '--event-size', type=int, default=512,
+        help='Approximate size of each event in bytes.')
+    stream.set_defaults(func=bench_stream)
+
+    ids = subparsers.add_parser(
+        'ids', help='Match bugsmash ids against Stackalytics contributors.')
+    ids.add_argument(
+        '--snapshot',
+        default=os.path.join(BUGSMASH, 'stackalytics-users'),
+        help='Stackalytics users snapshot.')
+    ids.add_argument(
+        '--tokens',
+        default=os.path.join(BUGSMASH, 'unvalidated-ids'),
+        help='Identifiers to look up, one per line.')
+    ids.add_argument(
+        '--contributors', type=int, default=20000,
+        help='Number of contributors to match against.')
+    ids.set_defaults(func=bench_ids)
+
+    refresh = subparsers.add_parser(
+        'refresh', help='Refresh a Stackalytics snapshot from a local '
+                        'stand-in server.')
+    refresh.add_argument(
+        '--snapshot',
+        default=os.path.join(BUGSMASH, 'stackalytics-users'),
+        help='Stackalytics users snapshot to serve.')
+    refresh.add_argument(
+        '--contributors', type=int, default=2000,
+        help='Number of contributors to serve.')
+    refresh.add_argument(
+        '--latency', type=float, default=0.005,
+        help='Seconds the stand-in takes to answer each request.')
+    refresh.add_argument(
+        '--workers', type=int, default=8,
+        help='Concurrent requests for contributors\' details.')
+    refresh.add_argument(
+        '--changed-every', type=int, default=20,
+        help='Change the summary of every this many contributors before '
+             'the incremental refresh.')
+    refresh.set_defaults(func=bench_refresh)
+
+    store = subparsers.add_parser(
+        'store', help='Compare JSON lines logs with event stores.')
+    store.add_argument(
+        'log', help='JSON lines event log to convert.')
+    store.set_defaults(func=bench_store)
+
+    archive = subparsers.add_parser(
+        'archive', help='Compare JSON lines logs with archives.')
+    archive.add_argument(
+        'log', help='JSON lines event log to archive.')
+    archive.add_argument(
+        '--block-bytes', type=int, default=event_archive.BLOCK_BYTES,
+        help='Uncompressed bytes of events per block.')
+    archive.add_argument(
+        '--jobs', type=int, default=1,
+        help='Processes to decompress blocks across.')
+    archive.set_defaults(func=bench_archive)
+
+    rules = subparsers.add_parser(
+        'rules', help='Evaluate priority rules against random events.')
+    rules.add_argument(
+        '--rules', type=int, default=500,
+        help='Number of rules.')
+    rules.add_argument(
+        '--events', type=int, default=100000,
+        help='Number of events.')
+    rules.add_argument(
+        '--projects', type=int, default=500,
+        help='Number of distinct projects.')
+    rules.add_argument(
+        '--users', type=int, default=2000,
+        help='Number of distinct users.')
+    rules.add_argument(
+        '--seed', type=int, default=0,
+        help='Random seed.')
+    rules.set_defaults(func=bench_rules)
+
+    logger = subparsers.add_parser(
+        'logger', help='Stream events from a fake Gerrit over SSH.')
+    add_generator_arguments(logger, events=50000)
+    logger.add_argument(
+        '--rate', type=float,
+        help='Events per second (default: as fast as possible).')
+    logger.add_argument(
+        '--burst', type=int, default=1,
+        help='Number of events sent back to back.')
+    logger.add_argument(
+        '--flush-events', type=int, default=1,
+        help='Flush the log after this many events.')
+    logger.set_defaults(func=bench_logger)
+
+    ingest = subparsers.add_parser(
+        'ingest', help='CPU per event in the logger, decoded or raw.')
+    add_generator_arguments(ingest)
+    ingest.add_argument(
+        '--rules',
+        help='Priority rules to check events against (default: any event '
+             'about a change is a priority).')
+    ingest.set_defaults(func=bench_ingest)
+
+    render = subparsers.add_parser(
+        'render', help='Render a synthetic log as markdown.')
+    add_generator_arguments(render)
+    render.set_defaults(func=bench_render)
+
+    summarize = subparsers.add_parser(
+        'summarize', help='Summarize a synthetic log.')
+    add_generator_arguments(summarize)
+    summarize.set_defaults(func=bench_summarize)
+
+    prefilter = subparsers.add_parser(
+        'prefilter', help='Skip ignored event types before decoding them.')
+    prefilter.add_argument(
+        '--log',
+        help='JSON lines event log to read (default: a synthetic log).')
+    add_generator_arguments(prefilter, events=500000)
+    prefilter.set_defaults(func=bench_prefilter)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -10,11 +10,14 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import argparse
+import hashlib
 import json
+from multiprocessing import pool
 import os
 
-import dogpile.cache
 import requests
+from requests import adapters
 
 COMPANIES = dict()
 
@@ -23,51 +26,143 @@ UNVALIDATED_IDS = 'unvalidated-ids'
 VALIDATED_IDS = 'validated-ids'
 INVALID_IDS = 'invalid-ids'
 STACKALYTICS_USERS = 'stackalytics-users'
-
-CACHE_DIR = '/tmp/gerrit-logger'
-if not os.path.exists(CACHE_DIR):
-    os.makedirs(CACHE_DIR, 0o0700)
-
-CACHE = dogpile.cache.make_region().configure(
-    'dogpile.cache.dbm',
-    expiration_time=60 * 60 * 24 * 7,
-    arguments={
-        'filename': '%s/cache.dbm' % CACHE_DIR,
-    }
+STACKALYTICS_INDEX = 'stackalytics-index'
+
+# Contributor fields which a bugsmash participant may have registered with, in
+# addition to any of their email addresses.
+IDENTIFIER_FIELDS = (
+    'id',
+    'launchpad_id',
+    'user_id',
+    'user_name',
+    'gerrit_id',
+    'text',
 )
 
+STACKALYTICS = 'http://stackalytics.com/api/1.0'
 
-@CACHE.cache_on_arguments()
-def GET(url, params=None):
-    resp = requests.get(url, params=params)
-    print('GET %s' % resp.url)
-    resp.raise_for_status()
-    data = resp.json()
-    return data
+# Concurrent requests for contributors' details.
+WORKERS = 8
+REQUEST_TIMEOUT = 60
 
 
-STACKALYTICS = 'http://stackalytics.com/api/1.0'
-USERS_ENDPOINT = STACKALYTICS + '/users'
-CONTRIBUTORS = GET(USERS_ENDPOINT)['data']
+def make_session(workers=WORKERS):
+    """Return an HTTP session keeping a connection open for each worker."""
+    session = requests.Session()
+    adapter = adapters.HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
 
-for contributor in CONTRIBUTORS:
-    user = GET(STACKALYTICS + '/users/' + contributor['id'])['user']
-    contributor.update(user)
 
+def GET(session, url, params=None):
+    resp = session.get(url, params=params, timeout=REQUEST_TIMEOUT)
+    resp.raise_for_status()
+    return resp.json()
 
-with open(STACKALYTICS_USERS, 'w+') as f:
-    f.write(json.dumps(CONTRIBUTORS, indent=4, sort_keys=True))
 
+def load_snapshot(path=STACKALYTICS_USERS):
+    """Return the contributors in a snapshot, or none if there isn't one."""
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return json.load(f)
 
-def equal(s1, s2):
-    if s1 is None and s2 is None:
-        return True
 
-    if s1 is None or s2 is None:
+def is_unchanged(summary, contributor):
+    """Return True if a contributor's summary is as it was in the snapshot."""
+    if contributor is None:
         return False
-
-    if s1.lower() == s2.lower():
-        return True
+    for key, value in summary.items():
+        if contributor.get(key) != value:
+            return False
+    return True
+
+
+def fetch_contributors(stackalytics=STACKALYTICS, snapshot=STACKALYTICS_USERS,
+                       workers=WORKERS, full=False):
+    """Refresh the snapshot of contributors from Stackalytics.
+
+    Contributors are listed with a summary of each. Only those whose summary
+    has changed since the snapshot was taken (or every one, if full) have
+    their details fetched, across a pool of workers sharing a session.
+    """
+    session = make_session(workers)
+    summaries = GET(session, stackalytics + '/users')['data']
+    print('GET %s/users: %d contributors' % (stackalytics, len(summaries)))
+
+    previous = dict()
+    if not full:
+        previous = dict(
+            (contributor['id'], contributor)
+            for contributor in load_snapshot(snapshot))
+
+    contributors = []
+    stale = []
+    for summary in summaries:
+        contributor = previous.get(summary['id'])
+        if is_unchanged(summary, contributor):
+            contributors.append(contributor)
+        else:
+            contributor = dict(summary)
+            contributors.append(contributor)
+            stale.append(contributor)
+
+    def fetch_details(contributor):
+        contributor.update(GET(
+            session, stackalytics + '/users/' + contributor['id'])['user'])
+
+    threads = pool.ThreadPool(workers)
+    try:
+        threads.map(fetch_details, stale)
+    finally:
+        threads.close()
+        threads.join()
+    print('Fetched details of %d contributors; %d unchanged' % (
+        len(stale), len(contributors) - len(stale)))
+
+    with open(snapshot, 'w+') as f:
+        f.write(json.dumps(contributors, indent=4, sort_keys=True))
+
+    return contributors
+
+
+def build_index(contributors):
+    """Map every case-folded identifier to the position of its contributor.
+
+    Where several contributors share an identifier, the first one wins.
+    """
+    index = dict()
+    for position, contributor in enumerate(contributors):
+        identifiers = [contributor.get(field) for field in IDENTIFIER_FIELDS]
+        identifiers.extend(contributor.get('emails') or [])
+        for identifier in identifiers:
+            if identifier is not None:
+                index.setdefault(identifier.lower(), position)
+    return index
+
+
+def load_index(snapshot=STACKALYTICS_USERS, path=STACKALYTICS_INDEX):
+    """Return the contributors in a snapshot and an index of them.
+
+    The index is saved alongside the snapshot, and only rebuilt when the
+    snapshot changes.
+    """
+    with open(snapshot, 'rb') as f:
+        data = f.read()
+    digest = hashlib.sha1(data).hexdigest()
+    contributors = json.loads(data.decode('utf-8'))
+
+    if os.path.exists(path):
+        with open(path) as f:
+            saved = json.load(f)
+        if saved.get('snapshot') == digest:
+            return contributors, saved['index']
+
+    index = build_index(contributors)
+    with open(path, 'w+') as f:
+        f.write(json.dumps({'snapshot': digest, 'index': index}))
+    return contributors, index
 
 
 def write_gerrit_id(contributor):
@@ -81,6 +176,23 @@ def write_invalid_id(token):
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Match bugsmash participants with Stackalytics '
+                    'contributors.')
+    parser.add_argument(
+        '--stackalytics', dest='stackalytics',
+        default=STACKALYTICS,
+        help='Base URL of the Stackalytics API.')
+    parser.add_argument(
+        '--workers', dest='workers', type=int,
+        default=WORKERS,
+        help='Number of contributors to fetch the details of at once.')
+    parser.add_argument(
+        '--full', dest='full', action='store_true',
+        help='Fetch the details of every contributor, rather than only of '
+             'those which changed since the last snapshot.')
+    args = parser.parse_args()
+
     # Truncate output files.
     with open(VALIDATED_IDS, 'w+') as f:
         pass
@@ -91,41 +203,14 @@ if __name__ == '__main__':
     with open(UNVALIDATED_IDS) as f:
         bugsmash_ids = [s.strip() for s in f.readlines()]
 
+    fetch_contributors(args.stackalytics, workers=args.workers,
+                       full=args.full)
+    contributors, index = load_index()
+
     for token in bugsmash_ids:
         token = token.lower()
-        found = False
-
-        for contributor in CONTRIBUTORS:
-            if equal(token, contributor.get('id')):
-                found = True
-                break
-
-            if equal(token, contributor.get('launchpad_id')):
-                found = True
-                break
-
-            if equal(token, contributor.get('user_id')):
-                found = True
-                break
-
-            if equal(token, contributor.get('user_name')):
-                found = True
-                break
-
-            if equal(token, contributor.get('gerrit_id')):
-                found = True
-                break
-
-            if equal(token, contributor.get('text')):
-                found = True
-                break
-
-            for email in contributor.get('emails'):
-                if equal(token, email):
-                    found = True
-                    break
-
-        if found:
+        if token in index:
+            contributor = contributors[index[token]]
             company_name = 'unknown'
             for company in contributor['companies']:
                 if company['end_date'] == 0:
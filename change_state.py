@@ -0,0 +1,252 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+"""The current state of each change, maintained as events are read.
+
+For each change number, the table holds the change's project, branch,
+subject, owner and status, its latest patch set, the bugs its commit message
+refers to, and the current votes by label. Bug references are only parsed
+once per patch set revision, however many events repeat the message.
+"""
+
+import argparse
+import collections
+import json
+import os
+import re
+
+import event_archive
+import event_log
+import event_store
+
+
+BUG_RE = re.compile(
+    r'([Rr]elated|[Pp]artial|[Cc]loses)-[Bb]ug[:]?[\s]?[#]?([0-9]+)',
+    re.MULTILINE)
+
+STATE_VERSION = 1
+
+# Patch set revisions whose bug references BugCache remembers.
+BUG_CACHE_SIZE = 10000
+
+# Patch set kinds for which Gerrit keeps the votes on the previous patch set.
+COPY_VOTES_KINDS = frozenset(['NO_CHANGE', 'NO_CODE_CHANGE', 'TRIVIAL_REBASE'])
+
+# Event types which aren't about a change.
+UNRELATED_TYPES = frozenset([
+    'ref-replicated', 'ref-replication-done', 'ref-updated'])
+
+STATUSES = {
+    'change-merged': 'MERGED',
+    'change-abandoned': 'ABANDONED',
+    'change-restored': 'NEW',
+}
+
+
+def bug_references(message):
+    """Return the (impact, bug number) of each bug a message refers to."""
+    return [(impact, int(number))
+            for impact, number in BUG_RE.findall(message)]
+
+
+class BugCache(object):
+    """The bug references of recently seen patch sets, keyed by revision.
+
+    Only the ``size`` most recently seen revisions are remembered, so memory
+    stays flat however many changes go by.
+    """
+
+    def __init__(self, size=BUG_CACHE_SIZE):
+        self.size = size
+        self.revisions = collections.OrderedDict()
+
+    def bugs(self, event):
+        """Return the bugs referred to by the commit message of an event."""
+        change = event.get('change')
+        if change is None:
+            return []
+        revision = event.get('patchSet', {}).get('revision')
+        if revision is None:
+            return bug_references(change.get('commitMessage', ''))
+
+        bugs = self.revisions.pop(revision, None)
+        if bugs is None:
+            bugs = bug_references(change.get('commitMessage', ''))
+            if len(self.revisions) >= self.size:
+                self.revisions.popitem(last=False)
+        # Move the revision to the most recently used end.
+        self.revisions[revision] = bugs
+        return bugs
+
+
+class ChangeTable(object):
+    """The state of every change seen, keyed by change number.
+
+    Events may be applied more than once, or out of order: anything older
+    than what a change's state already reflects is ignored.
+    """
+
+    def __init__(self):
+        self.changes = {}
+        self.logs = {}
+
+    @classmethod
+    def load(cls, path):
+        """Load a saved table, or return an empty one if there isn't one."""
+        table = cls()
+        if os.path.exists(path):
+            with open(path) as f:
+                data = json.load(f)
+            if data.get('version') == STATE_VERSION:
+                table.changes = data['changes']
+                table.logs = data['logs']
+        return table
+
+    def save(self, path):
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({
+                'version': STATE_VERSION,
+                'changes': self.changes,
+                'logs': self.logs,
+            }, f, separators=(',', ':'))
+        os.rename(tmp, path)
+
+    def get(self, number):
+        return self.changes.get(str(number))
+
+    def update(self, event):
+        """Apply an event, and return the state of its change, if any."""
+        change = event.get('change')
+        if change is None:
+            return None
+        number = str(change['number'])
+        state = self.changes.get(number)
+        if state is None:
+            state = self.changes[number] = {
+                'patch_set': 0,
+                'revision': None,
+                'bugs': None,
+                'votes': {},
+                'status': 'NEW',
+                'updated_at': 0,
+            }
+
+        when = event.get('eventCreatedOn') or event.get('received_at') or 0
+        current = when >= state['updated_at']
+        if current:
+            state['updated_at'] = when
+            state['project'] = change.get('project')
+            state['branch'] = change.get('branch')
+            state['subject'] = change.get('subject')
+            state['url'] = change.get('url')
+            state['owner'] = change.get('owner', {}).get('username')
+            state['status'] = STATUSES.get(
+                event['type'], change.get('status', state['status']))
+
+        patch_set = event.get('patchSet')
+        if patch_set is not None:
+            patch_set_number = int(patch_set['number'])
+            if patch_set_number > state['patch_set']:
+                if patch_set.get('kind') not in COPY_VOTES_KINDS:
+                    state['votes'] = {}
+                state['patch_set'] = patch_set_number
+                if patch_set.get('revision') != state['revision']:
+                    state['revision'] = patch_set.get('revision')
+                    state['bugs'] = None
+            if (current and event['type'] == 'comment-added' and
+                    patch_set_number == state['patch_set']):
+                username = event['author'].get('username')
+                for approval in event.get('approvals', ()):
+                    state['votes'].setdefault(approval['type'], {})[
+                        username] = int(approval['value'])
+
+        if state['bugs'] is None:
+            state['bugs'] = bug_references(change.get('commitMessage', ''))
+        return state
+
+    def catch_up(self, path):
+        """Apply the events in a log which haven't been applied already.
+
+        Only the lines appended to a JSON lines log since it was last read are
+        applied. Event stores and archives have to be decoded from the start,
+        but are skipped if they haven't changed, and only the events added to
+        them since are applied.
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        progress = self.logs.get(path)
+        if progress is None or len(progress) != 4:
+            # Read before progress was fingerprinted; replays are harmless.
+            progress = (None, 0, None, 0)
+        inode, offset, digest, applied = progress
+        offset = event_log.resume_offset(path, inode, offset, digest)
+        if offset == 0:
+            applied = 0
+
+        if event_store.is_store(path) or event_archive.is_archive(path):
+            if offset and stat.st_size == offset:
+                return
+            count = 0
+            for event in event_log.iter_events(path):
+                count += 1
+                if count > applied:
+                    self.update(event)
+            self.logs[path] = (
+                stat.st_ino, stat.st_size,
+                event_log.fingerprint(path, stat.st_size), count)
+            return
+
+        skip = event_log.type_filter(UNRELATED_TYPES)
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    # Leave a partially written event for next time.
+                    break
+                offset += len(line)
+                if skip is None or not skip(line):
+                    self.update(json.loads(line.decode('utf-8')))
+        self.logs[path] = (
+            stat.st_ino, offset, event_log.fingerprint(path, offset), 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Maintain and query the current state of Gerrit changes.')
+    parser.add_argument(
+        'logs', nargs='*',
+        help='Event logs to bring the state up to date with.')
+    parser.add_argument(
+        '--state', dest='state',
+        default='changes.json',
+        help='File the state is kept in.')
+    parser.add_argument(
+        '--change', dest='changes', action='append',
+        help='Print the state of this change number. Repeat for several.')
+    args = parser.parse_args()
+
+    table = ChangeTable.load(args.state)
+    if args.logs:
+        for path in args.logs:
+            table.catch_up(path)
+        table.save(args.state)
+
+    if args.changes:
+        for number in args.changes:
+            print(json.dumps(table.get(number), indent=2, sort_keys=True))
+    else:
+        print('%s: %d changes' % (args.state, len(table.changes)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,245 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+"""Compressed archives of event logs, which can still be read selectively.
+
+An archive begins with MAGIC, followed by blocks of JSON lines which are each
+compressed on their own, then a compressed JSON index of the blocks and a
+trailer holding the index's offset. The index records the range of
+``received_at`` and the projects within each block, so readers only
+decompress the blocks that may hold the events they want.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import struct
+import zlib
+
+import event_index
+import event_log
+import event_store
+
+
+MAGIC = b'GGEA\x01\n'
+TRAILER = struct.Struct('>Q')
+
+# Uncompressed bytes of JSON lines per block.
+BLOCK_BYTES = 1024 * 1024
+
+
+def is_archive(path):
+    """Return True if path is an archive rather than a log."""
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+class ArchiveWriter(object):
+    """Write JSON lines to an archive, one compressed block at a time."""
+
+    def __init__(self, path, block_bytes=BLOCK_BYTES, level=6):
+        self.path = path
+        self.block_bytes = block_bytes
+        self.level = level
+        self.f = open(path, 'wb')
+        self.f.write(MAGIC)
+        self.offset = len(MAGIC)
+        self.blocks = []
+        self._reset()
+
+    def _reset(self):
+        self.lines = []
+        self.size = 0
+        self.first = None
+        self.last = None
+        self.projects = set()
+
+    def write_line(self, line, event):
+        received_at = event.get('received_at')
+        if received_at is not None:
+            if self.first is None or received_at < self.first:
+                self.first = received_at
+            if self.last is None or received_at > self.last:
+                self.last = received_at
+        project = event_index.event_project(event)
+        if project is not None:
+            self.projects.add(project)
+        self.lines.append(line)
+        self.size += len(line)
+        if self.size >= self.block_bytes:
+            self.flush()
+
+    def flush(self):
+        if not self.lines:
+            return
+        data = zlib.compress(b''.join(self.lines), self.level)
+        self.f.write(data)
+        self.blocks.append({
+            'offset': self.offset,
+            'length': len(data),
+            'count': len(self.lines),
+            'first': self.first,
+            'last': self.last,
+            'projects': sorted(self.projects),
+        })
+        self.offset += len(data)
+        self._reset()
+
+    def close(self):
+        self.flush()
+        index = zlib.compress(json.dumps(
+            self.blocks, separators=(',', ':')).encode('utf-8'))
+        self.f.write(index)
+        self.f.write(TRAILER.pack(self.offset))
+        self.f.write(MAGIC)
+        self.f.close()
+
+
+def archive(sources, destination, block_bytes=BLOCK_BYTES, level=6):
+    """Compress logs, or event stores, into one archive.
+
+    The archive is written beside the destination and only renamed into
+    place once every source has been archived, so a failure never leaves
+    an incomplete archive behind.
+    """
+    for source in sources:
+        if (os.path.exists(destination) and
+                os.path.samefile(source, destination)):
+            raise ValueError('%s is one of the sources' % destination)
+    tmp = destination + '.tmp'
+    writer = ArchiveWriter(tmp, block_bytes, level)
+    try:
+        for source in sources:
+            if is_archive(source):
+                raise ValueError('%s is already an archive' % source)
+            if event_store.is_store(source):
+                for event in event_store.read_store(source):
+                    writer.write_line(event_log.encode_event(event), event)
+                continue
+            with open(source, 'rb') as f:
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        # Leave a partially written event behind.
+                        break
+                    writer.write_line(line, json.loads(line.decode('utf-8')))
+        writer.close()
+    except BaseException:
+        writer.f.close()
+        os.remove(tmp)
+        raise
+    os.rename(tmp, destination)
+
+
+def read_index(path):
+    """Return the list of blocks in an archive."""
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('%s is not an archive' % path)
+        f.seek(-(TRAILER.size + len(MAGIC)), os.SEEK_END)
+        end = f.tell()
+        trailer = f.read(TRAILER.size + len(MAGIC))
+        if trailer[TRAILER.size:] != MAGIC:
+            raise ValueError('%s is incomplete' % path)
+        offset, = TRAILER.unpack(trailer[:TRAILER.size])
+        f.seek(offset)
+        return json.loads(zlib.decompress(
+            f.read(end - offset)).decode('utf-8'))
+
+
+def block_matches(block, since=None, until=None, project=None):
+    """Return True if a block may hold events matching a query."""
+    if since is not None and (block['last'] is None or
+                              block['last'] < since):
+        return False
+    if until is not None and (block['first'] is None or
+                              block['first'] > until):
+        return False
+    if project is not None and project not in block['projects']:
+        return False
+    return True
+
+
+def read_block(work):
+    """Return the events in a block which match a query."""
+    path, block, filters, ignore = work
+    with open(path, 'rb') as f:
+        f.seek(block['offset'])
+        data = zlib.decompress(f.read(block['length']))
+    skip = event_log.type_filter(ignore)
+    events = []
+    for line in data.splitlines():
+        if skip is not None and skip(line):
+            continue
+        event = json.loads(line.decode('utf-8'))
+        if event_index.matches(event, **filters):
+            events.append(event)
+    return events
+
+
+def read_archive(path, since=None, until=None, project=None, change=None,
+                 ignore=None, jobs=1):
+    """Yield the events in an archive, optionally filtered.
+
+    Only blocks which may hold matching events are decompressed, across jobs
+    processes if there's more than one.
+    """
+    filters = dict(since=since, until=until, project=project, change=change)
+    work = [
+        (path, block, filters, ignore) for block in read_index(path)
+        if block_matches(block, since, until, project)]
+    if jobs > 1 and len(work) > 1:
+        pool = multiprocessing.Pool(min(jobs, len(work)))
+        try:
+            for events in pool.imap(read_block, work):
+                for event in events:
+                    yield event
+        finally:
+            pool.close()
+            pool.join()
+        return
+
+    for item in work:
+        for event in read_block(item):
+            yield event
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compress Gerrit event logs into a seekable archive.')
+    parser.add_argument(
+        'sources', nargs='+',
+        help='Event logs or event stores to archive, in order.')
+    parser.add_argument(
+        'destination',
+        help='Archive to create.')
+    parser.add_argument(
+        '--block-bytes', dest='block_bytes', type=int,
+        default=BLOCK_BYTES,
+        help='Uncompressed bytes of events per block. Smaller blocks make '
+             'selective reads cheaper, at some cost in compression.')
+    parser.add_argument(
+        '--level', dest='level', type=int, choices=range(1, 10),
+        default=6,
+        help='zlib compression level.')
+    args = parser.parse_args()
+
+    archive(args.sources, args.destination, args.block_bytes, args.level)
+    size = sum(os.path.getsize(source) for source in args.sources)
+    print('%s: %d blocks, %d bytes (%.1f%% of %d bytes)' % (
+        args.destination, len(read_index(args.destination)),
+        os.path.getsize(args.destination),
+        100.0 * os.path.getsize(args.destination) / size, size))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,385 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+"""A sidecar index of byte offsets into a JSON lines event log.
+
+The index lives beside the log (``event.log.idx``) and maps hourly buckets of
+``received_at``, change numbers and projects to the offsets of matching
+lines, so that consumers can seek straight to the events they want.
+"""
+
+import argparse
+import array
+import calendar
+import json
+import mmap
+import os
+import struct
+import sys
+import time
+
+
+INDEX_SUFFIX = '.idx'
+INDEX_MAGIC = b'GGEI\x02\n'
+INDEX_VERSION = 2
+HEADER = struct.Struct('>Q')
+BUCKET_SECONDS = 3600
+
+# Kinds of posting lists, each mapping a key to the offsets of its events.
+POSTING_TABLES = ('changes', 'projects')
+
+
+def parse_time(value):
+    """Parse a UTC date, date and time, or UNIX timestamp."""
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    for fmt in ('%Y-%m-%d', '%Y-%m-%d %H:%M', '%Y-%m-%d %H:%M:%S',
+                '%Y-%m-%dT%H:%M', '%Y-%m-%dT%H:%M:%S'):
+        try:
+            return calendar.timegm(time.strptime(value, fmt))
+        except ValueError:
+            continue
+    raise ValueError('Unrecognized time: %s' % value)
+
+
+def event_project(event):
+    """Return the project an event belongs to, if any."""
+    if 'change' in event:
+        return event['change'].get('project')
+    if 'refUpdate' in event:
+        return event['refUpdate'].get('project')
+    return event.get('project')
+
+
+def event_change(event):
+    """Return the change number an event belongs to, if any."""
+    if 'change' in event:
+        number = event['change'].get('number')
+        if number is not None:
+            return str(number)
+
+
+def offset_array(data=b''):
+    """Return an array of 64-bit offsets, decoded from little-endian bytes."""
+    for typecode in ('Q', 'L'):
+        try:
+            offsets = array.array(typecode)
+        except ValueError:
+            continue
+        if offsets.itemsize == 8:
+            break
+    if hasattr(offsets, 'frombytes'):
+        offsets.frombytes(data)
+    else:
+        offsets.fromstring(data)
+    if sys.byteorder != 'little':
+        offsets.byteswap()
+    return offsets
+
+
+def offset_bytes(offsets):
+    """Encode an array of offsets as little-endian bytes."""
+    if sys.byteorder != 'little':
+        offsets = array.array(offsets.typecode, offsets)
+        offsets.byteswap()
+    if hasattr(offsets, 'tobytes'):
+        return offsets.tobytes()
+    return offsets.tostring()
+
+
+class EventIndex(object):
+    """Byte offsets of the events in a log, by time, change and project.
+
+    The index file holds a JSON header, with the hourly spans and where each
+    change's and project's posting list is, followed by every posting list
+    as 64-bit offsets. Queries only read the posting lists they need.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.index_path = path + INDEX_SUFFIX
+        self.reset()
+
+    def reset(self):
+        self.inode = None
+        self.size = 0
+        self.digest = None
+        self.buckets = {}
+        # The (start, count) of each saved posting list, by key.
+        self.tables = dict((table, {}) for table in POSTING_TABLES)
+        # Offsets indexed since the index was loaded, by key.
+        self.added = dict((table, {}) for table in POSTING_TABLES)
+        self.postings_at = None
+
+    @property
+    def changes(self):
+        return set(self.tables['changes']).union(self.added['changes'])
+
+    @property
+    def projects(self):
+        return set(self.tables['projects']).union(self.added['projects'])
+
+    @classmethod
+    def load(cls, path):
+        """Load the index for a log, bringing it up to date if necessary."""
+        index = cls(path)
+        if os.path.exists(index.index_path):
+            with open(index.index_path, 'rb') as f:
+                header = None
+                if f.read(len(INDEX_MAGIC)) == INDEX_MAGIC:
+                    length, = HEADER.unpack(f.read(HEADER.size))
+                    header = json.loads(f.read(length).decode('utf-8'))
+            if header is not None and header.get('version') == INDEX_VERSION:
+                index.inode = header['inode']
+                index.size = header['size']
+                index.digest = header.get('digest')
+                index.buckets = dict(
+                    (int(k), v) for k, v in header['buckets'].items())
+                for table in POSTING_TABLES:
+                    index.tables[table] = header[table]
+                index.postings_at = len(INDEX_MAGIC) + HEADER.size + length
+        if index.update():
+            try:
+                index.save()
+            except (IOError, OSError):
+                # The index is still usable in memory, even if we can't save
+                # it next to a read-only log.
+                pass
+        return index
+
+    def _read_saved(self, start=0, count=None):
+        """Return saved postings, as little-endian bytes."""
+        if self.postings_at is None:
+            return b''
+        with open(self.index_path, 'rb') as f:
+            f.seek(self.postings_at + start * 8)
+            if count is None:
+                return f.read()
+            return f.read(count * 8)
+
+    def posting(self, table, key):
+        """Return the sorted offsets of the lines with a change or project."""
+        offsets = offset_array()
+        span = self.tables[table].get(key)
+        if span is not None:
+            offsets = offset_array(self._read_saved(*span))
+        offsets.extend(self.added[table].get(key, ()))
+        return offsets
+
+    def save(self):
+        saved = self._read_saved()
+        header = {
+            'version': INDEX_VERSION,
+            'inode': self.inode,
+            'size': self.size,
+            'digest': self.digest,
+            'buckets': self.buckets,
+        }
+        tables = {}
+        postings = []
+        position = 0
+        for table in POSTING_TABLES:
+            spans = header[table] = tables[table] = {}
+            for key in set(self.tables[table]).union(self.added[table]):
+                count = 0
+                span = self.tables[table].get(key)
+                if span is not None:
+                    start, count = span
+                    postings.append(saved[start * 8:(start + count) * 8])
+                added = self.added[table].get(key)
+                if added:
+                    postings.append(offset_bytes(added))
+                    count += len(added)
+                spans[key] = [position, count]
+                position += count
+        header = json.dumps(header, separators=(',', ':')).encode('utf-8')
+
+        tmp = self.index_path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(INDEX_MAGIC)
+            f.write(HEADER.pack(len(header)))
+            f.write(header)
+            for posting in postings:
+                f.write(posting)
+        os.rename(tmp, self.index_path)
+        self.tables = tables
+        self.added = dict((table, {}) for table in POSTING_TABLES)
+        self.postings_at = len(INDEX_MAGIC) + HEADER.size + len(header)
+
+    def update(self):
+        """Index any lines appended since the last update.
+
+        The whole log is re-indexed if it has been replaced or truncated.
+        Returns True if the index changed.
+        """
+        # Imported here, as event_log imports this module.
+        import event_log
+
+        changed = False
+        stat = os.stat(self.path)
+        if (stat.st_ino != self.inode or event_log.resume_offset(
+                self.path, self.inode, self.size, self.digest) != self.size):
+            self.reset()
+            self.inode = stat.st_ino
+            changed = True
+        if stat.st_size == self.size:
+            return changed
+
+        with open(self.path, 'rb') as f:
+            f.seek(self.size)
+            offset = self.size
+            for line in f:
+                if not line.endswith(b'\n'):
+                    # Leave a partially written event for next time.
+                    break
+                self.add(json.loads(line.decode('utf-8')), offset,
+                         offset + len(line))
+                offset += len(line)
+        if offset != self.size:
+            changed = True
+            self.size = offset
+            self.digest = event_log.fingerprint(self.path, offset)
+        return changed
+
+    def add(self, event, offset, end):
+        if 'received_at' in event:
+            bucket = int(event['received_at'] // BUCKET_SECONDS)
+            span = self.buckets.get(bucket)
+            if span is None:
+                self.buckets[bucket] = [offset, end]
+            else:
+                span[1] = end
+
+        change = event_change(event)
+        if change is not None:
+            self.added['changes'].setdefault(
+                change, offset_array()).append(offset)
+        project = event_project(event)
+        if project is not None:
+            self.added['projects'].setdefault(
+                project, offset_array()).append(offset)
+
+    def span(self, since=None, until=None):
+        """Return the range of offsets holding events in a time range."""
+        if since is None and until is None:
+            return 0, self.size
+        first = None if since is None else int(since // BUCKET_SECONDS)
+        last = None if until is None else int(until // BUCKET_SECONDS)
+        spans = [
+            span for bucket, span in self.buckets.items()
+            if (first is None or bucket >= first) and
+            (last is None or bucket <= last)]
+        if not spans:
+            return 0, 0
+        return min(s[0] for s in spans), max(s[1] for s in spans)
+
+    def offsets(self, since=None, until=None, project=None, change=None):
+        """Return the sorted offsets of lines which may match a query.
+
+        Returns None if every line within span() may match.
+        """
+        start, end = self.span(since, until)
+        postings = []
+        if project is not None:
+            postings.append(self.posting('projects', project))
+        if change is not None:
+            postings.append(self.posting('changes', str(change)))
+        if not postings:
+            return None
+
+        # Intersect, starting from the shortest posting list.
+        postings.sort(key=len)
+        matches = set(o for o in postings[0] if start <= o < end)
+        for posting in postings[1:]:
+            matches.intersection_update(posting)
+        return sorted(matches)
+
+
+def matches(event, since=None, until=None, project=None, change=None,
+            types=None):
+    """Return True if an event satisfies a query exactly."""
+    received_at = event.get('received_at')
+    if since is not None and (received_at is None or received_at < since):
+        return False
+    if until is not None and (received_at is None or received_at > until):
+        return False
+    if project is not None and event_project(event) != project:
+        return False
+    if change is not None and event_change(event) != str(change):
+        return False
+    if types is not None and event['type'] not in types:
+        return False
+    return True
+
+
+def read_lines(mm, start, end):
+    """Yield each line of a memory map within a byte range."""
+    while start < end:
+        newline = mm.find(b'\n', start, end)
+        if newline == -1:
+            newline = end
+        yield mm[start:newline]
+        start = newline + 1
+
+
+def query(path, since=None, until=None, project=None, change=None,
+          types=None, ignore=None):
+    """Yield the events in a log matching a query, seeking via its index.
+
+    Events of the ignore types are skipped before they're decoded.
+    """
+    # Imported here, as event_log reads logs through this module.
+    import event_log
+
+    skip = event_log.type_filter(ignore)
+    index = EventIndex.load(path)
+    start, end = index.span(since, until)
+    offsets = index.offsets(since, until, project, change)
+    if start == end or offsets == []:
+        return
+
+    with open(path, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if offsets is None:
+                lines = read_lines(mm, start, end)
+            else:
+                lines = (mm[o:mm.find(b'\n', o)] for o in offsets)
+            for line in lines:
+                if skip is not None and skip(line):
+                    continue
+                event = json.loads(line.decode('utf-8'))
+                if matches(event, since, until, project, change, types):
+                    yield event
+        finally:
+            mm.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Build or update the index of Gerrit event logs.')
+    parser.add_argument(
+        'files', nargs='+',
+        help='Event logs to index.')
+    args = parser.parse_args()
+
+    for path in args.files:
+        index = EventIndex.load(path)
+        print('%s: %d bytes, %d changes, %d projects' % (
+            index.index_path, index.size, len(index.changes),
+            len(index.projects)))
+
+
+if __name__ == '__main__':
+    main()
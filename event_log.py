@@ -0,0 +1,477 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+import hashlib
+import json
+import os
+import re
+import time
+
+import event_index
+
+
+WRITE_BUFFER_BYTES = 1024 * 1024
+
+# Bytes read back to tell whether a log still holds what was read from it.
+FINGERPRINT_BYTES = 1024
+
+# Event types which none of the tools have any use for.
+IGNORED_TYPES = frozenset([
+    'merge-failed',
+    'ref-replicated',
+    'ref-replication-done',
+    'ref-updated',
+    'reviewer-added',
+    'topic-changed',
+])
+
+
+# Event types are lowercase, unlike the labels approvals are typed by.
+EVENT_TYPE_RE = re.compile(br'"type"\s*:\s*"([a-z][a-z0-9-]*)"')
+CREATED_ON_RE = re.compile(br'"eventCreatedOn"\s*:\s*(\d+)')
+CHANGE_RE = re.compile(br'"change"\s*:\s*\{')
+
+
+def quoted(key):
+    """Return a key as it would appear in a JSON line."""
+    return ('"%s"' % key).encode('utf-8')
+
+
+def encode_event(event):
+    """Serialize an event as a compact JSON line."""
+    if isinstance(event, RawEvent):
+        return event.encode()
+    return (json.dumps(event, separators=(',', ':')) + '\n').encode('utf-8')
+
+
+class RawEvent(object):
+    """An event kept as the JSON line it was received as.
+
+    Fields added to the event (such as received_at) are spliced into the line
+    when it's encoded, rather than re-serializing the whole event. The type,
+    eventCreatedOn and whether there's a change are read from the line, and
+    the line is only decoded once any other field is needed. Supports enough
+    of the dict interface to be used in place of a decoded event, but changes
+    made to the decoded event itself aren't reflected in the line.
+
+    If given, decode(line) is used to decode the line, so that callers can
+    account for the time spent decoding.
+    """
+
+    def __init__(self, line, decode=None):
+        self.line = line.rstrip()
+        self.decode = decode
+        self.fields = {}
+        self._event = None
+        self._type = None
+
+    @property
+    def event(self):
+        """The event, decoded."""
+        if self._event is None:
+            if self.decode is not None:
+                event = self.decode(self.line)
+            else:
+                event = json.loads(self.line.decode('utf-8'))
+            event.update(self.fields)
+            self._event = event
+        return self._event
+
+    def encode(self):
+        if (not self.fields or not self.line.endswith(b'}') or
+                len(self.line) <= 2 or
+                any(quoted(key) in self.line for key in self.fields)):
+            # Unusual, or already has one of the fields.
+            return (json.dumps(self.event, separators=(',', ':')) +
+                    '\n').encode('utf-8')
+        # json.dumps() is slow for floats such as received_at, and encodes
+        # them with repr() anyway.
+        fields = ''.join(
+            ',"%s":%s' % (key, repr(value) if type(value) is float
+                          else json.dumps(value))
+            for key, value in self.fields.items())
+        return b''.join([self.line[:-1], fields.encode('utf-8'), b'}\n'])
+
+    def _get_type(self):
+        if self._type is None:
+            if self._event is None:
+                types = EVENT_TYPE_RE.findall(self.line)
+                if len(types) == 1:
+                    self._type = types[0].decode('utf-8')
+                    return self._type
+            self._type = self.event['type']
+        return self._type
+
+    def __getitem__(self, key):
+        if key in self.fields:
+            return self.fields[key]
+        if key == 'type':
+            return self._get_type()
+        if key == 'eventCreatedOn' and self._event is None:
+            match = CREATED_ON_RE.search(self.line)
+            if match is not None:
+                return int(match.group(1))
+        return self.event[key]
+
+    def __setitem__(self, key, value):
+        self.fields[key] = value
+        if self._event is not None:
+            self._event[key] = value
+
+    def __contains__(self, key):
+        if key in self.fields:
+            return True
+        if self._event is None:
+            if key == 'change':
+                return CHANGE_RE.search(self.line) is not None
+            if key == 'eventCreatedOn':
+                return CREATED_ON_RE.search(self.line) is not None
+            if quoted(key) not in self.line:
+                return False
+        return key in self.event
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+
+def type_filter(types):
+    """Return a function telling whether a raw JSON line has one of types.
+
+    This finds the event's type without decoding the line. A quoted string
+    within a JSON value can't contain an unescaped quote, so a match can only
+    be a real "type" key; the only other objects in an event with a "type"
+    key are approvals, which are typed by label rather than event type.
+    Returns None if there are no types to filter.
+    """
+    if not types:
+        return None
+    pattern = re.compile(
+        br'"type"\s*:\s*"(?:%s)"' % b'|'.join(
+            re.escape(t.encode('utf-8')) for t in sorted(types)))
+    return lambda line: pattern.search(line) is not None
+
+
+def iter_events(path, since=None, until=None, project=None, change=None,
+                ignore=None, jobs=1):
+    """Yield the events in a log, optionally filtered.
+
+    Logs may be JSON lines, event stores or archives. Filtered reads of JSON
+    lines logs seek through the log's index rather than parsing every line,
+    and events of the ignore types are skipped before they're decoded.
+    Archives are decompressed across jobs processes.
+    """
+    # Imported here, as event stores are written by a subclass of
+    # EventLogWriter.
+    import event_archive
+    import event_store
+
+    filters = dict(since=since, until=until, project=project, change=change)
+    if event_archive.is_archive(path):
+        for event in event_archive.read_archive(
+                path, ignore=ignore, jobs=jobs, **filters):
+            yield event
+        return
+
+    if event_store.is_store(path):
+        ignore = frozenset(ignore or ())
+        for event in event_store.read_store(path):
+            if (event['type'] not in ignore and
+                    event_index.matches(event, **filters)):
+                yield event
+        return
+
+    if any(value is not None for value in filters.values()):
+        for event in event_index.query(path, ignore=ignore, **filters):
+            yield event
+        return
+
+    skip = type_filter(ignore)
+    with open(path, 'rb') as f:
+        for line in f:
+            if skip is None or not skip(line):
+                yield json.loads(line.decode('utf-8'))
+
+
+def chunks(path, count, start=0, end=None):
+    """Split a file into (path, start, end) byte ranges on line boundaries.
+
+    The ranges cover the file from start to end (default: its size).
+    """
+    if end is None:
+        end = os.path.getsize(path)
+    offsets = [start]
+    with open(path, 'rb') as f:
+        for i in range(1, count):
+            f.seek(max(start + (end - start) * i // count, offsets[-1]))
+            f.readline()
+            offsets.append(min(f.tell(), end))
+    offsets.append(end)
+    return [(path, first, last)
+            for first, last in zip(offsets, offsets[1:]) if last > first]
+
+
+def read_chunk(path, start, end):
+    """Yield each line of a file within a byte range."""
+    with open(path, 'rb') as f:
+        f.seek(start)
+        position = start
+        while position < end:
+            line = f.readline()
+            if not line:
+                break
+            position += len(line)
+            yield line
+
+
+def complete_size(path):
+    """Return the size of a log, excluding any partially written event."""
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        position = size
+        while position > 0:
+            start = max(0, position - 65536)
+            f.seek(start)
+            newline = f.read(position - start).rfind(b'\n')
+            if newline != -1:
+                return start + newline + 1
+            position = start
+    return 0
+
+
+def fingerprint(path, offset):
+    """Return a digest of the bytes of a file just before an offset."""
+    start = max(0, offset - FINGERPRINT_BYTES)
+    with open(path, 'rb') as f:
+        f.seek(start)
+        return hashlib.sha1(f.read(offset - start)).hexdigest()
+
+
+def resume_offset(path, inode, offset, digest=None):
+    """Return the offset to carry on reading a file from.
+
+    That's offset, if the file still has the inode it was read from and the
+    bytes before offset are unchanged: they must match their digest from
+    fingerprint(), or at least still end a line if there's no digest.
+    Otherwise the file has been replaced or truncated, and must be read from
+    the start, so 0 is returned.
+    """
+    if inode is None or offset == 0:
+        return 0
+    stat = os.stat(path)
+    if stat.st_ino != inode or stat.st_size < offset:
+        return 0
+    if digest is not None:
+        return offset if fingerprint(path, offset) == digest else 0
+    with open(path, 'rb') as f:
+        f.seek(offset - 1)
+        return offset if f.read(1) == b'\n' else 0
+
+
+def add_filter_arguments(parser):
+    """Add the options accepted by iter_events() to an argument parser."""
+    parser.add_argument(
+        '--since', dest='since', type=event_index.parse_time,
+        help='Only read events received at or after this UTC time '
+             '(YYYY-MM-DD[ HH:MM[:SS]] or a UNIX timestamp).')
+    parser.add_argument(
+        '--until', dest='until', type=event_index.parse_time,
+        help='Only read events received at or before this UTC time.')
+    parser.add_argument(
+        '--project', dest='project',
+        help='Only read events for this project.')
+    parser.add_argument(
+        '--change', dest='change',
+        help='Only read events for this change number.')
+    parser.add_argument(
+        '--ignore-types', dest='ignore_types', type=parse_types,
+        help='Comma-separated event types to skip without decoding them '
+             '(default: types this tool has no use for; use an empty string '
+             'to decode everything).')
+
+
+def ignored_types(args, default=IGNORED_TYPES):
+    """Return the event types to skip, given parsed filter arguments."""
+    if args.ignore_types is None:
+        return default
+    return args.ignore_types
+
+
+def parse_types(value):
+    return frozenset(t.strip() for t in value.split(',') if t.strip())
+
+
+def has_filters(args):
+    """Return True if any of the add_filter_arguments() options were set."""
+    return any(x is not None for x in (
+        args.since, args.until, args.project, args.change))
+
+
+class EventLogWriter(object):
+    """Append events to a log file which is kept open between writes.
+
+    Writes are buffered and flushed according to a group commit policy: after
+    every ``flush_events`` events, and/or once ``flush_ms`` milliseconds have
+    passed since the last flush. Each flush is followed by an fsync() when
+    ``fsync`` is set. The time-based policy is evaluated as events arrive,
+    and by tick() in between, and anything still buffered is flushed by
+    close().
+
+    The log is rotated once it would grow beyond ``rotate_bytes``, or when the
+    current time crosses a ``rotate_seconds`` boundary. Rotated segments are
+    renamed with the time of their first event, and recorded in a JSON lines
+    index alongside the log (``event.log.segments``).
+    """
+
+    def __init__(self, path='event.log', flush_events=1, flush_ms=None,
+                 fsync=False, rotate_bytes=None, rotate_seconds=None):
+        self.path = path
+        self.segments_path = path + '.segments'
+        self.flush_events = flush_events
+        self.flush_ms = flush_ms
+        self.fsync = fsync
+        self.rotate_bytes = rotate_bytes
+        self.rotate_seconds = rotate_seconds
+        self.f = None
+        self._open()
+
+    def _open(self):
+        self.events = 0
+        self.first_received_at = None
+        if os.path.exists(self.path):
+            self.size = os.path.getsize(self.path)
+            self.opened_at = os.path.getmtime(self.path)
+            if self.size:
+                self._recover()
+        else:
+            self.size = 0
+            self.opened_at = time.time()
+        self.f = open(self.path, 'ab', WRITE_BUFFER_BYTES)
+        self.pending = 0
+        self.last_received_at = None
+        self.last_flush = time.time()
+
+    def _recover(self):
+        """Count the events already in the log, and find when it started."""
+        with open(self.path, 'rb') as f:
+            first = f.readline()
+            if first.endswith(b'\n'):
+                self.first_received_at = json.loads(
+                    first.decode('utf-8')).get('received_at')
+            f.seek(0)
+            for block in iter(lambda: f.read(WRITE_BUFFER_BYTES), b''):
+                self.events += block.count(b'\n')
+
+    def encode(self, event):
+        """Return the bytes to append to the log for an event."""
+        return encode_event(event)
+
+    def write(self, event):
+        """Append an event to the log, stamping it if it's not already."""
+        event.setdefault('received_at', time.time())
+        self.write_line(self.encode(event), event['received_at'])
+
+    def write_line(self, line, received_at):
+        """Append a serialized event to the log."""
+        if self._should_rotate(len(line), received_at):
+            self.rotate()
+
+        self.f.write(line)
+        self.size += len(line)
+        self.events += 1
+        self.pending += 1
+        if self.first_received_at is None:
+            self.first_received_at = received_at
+        self.last_received_at = received_at
+
+        if self.flush_events and self.pending >= self.flush_events:
+            self.flush()
+        elif (self.flush_ms is not None and
+                (time.time() - self.last_flush) * 1000 >= self.flush_ms):
+            self.flush()
+
+    def tick(self):
+        """Apply the time-based flush policy while no events are arriving.
+
+        Returns the number of seconds until it should next be applied, or
+        None if there's no time-based policy.
+        """
+        if self.flush_ms is None:
+            return None
+        elapsed = (time.time() - self.last_flush) * 1000
+        if elapsed >= self.flush_ms:
+            if self.pending:
+                self.flush()
+            else:
+                self.last_flush = time.time()
+            elapsed = 0
+        return (self.flush_ms - elapsed) / 1000.0
+
+    def flush(self):
+        """Commit any buffered events to the log."""
+        self.f.flush()
+        if self.fsync:
+            os.fsync(self.f.fileno())
+        self.pending = 0
+        self.last_flush = time.time()
+
+    def _should_rotate(self, nbytes, received_at):
+        if not self.size:
+            return False
+        if self.rotate_bytes and self.size + nbytes > self.rotate_bytes:
+            return True
+        if self.rotate_seconds:
+            interval = int(self.opened_at // self.rotate_seconds)
+            return int(received_at // self.rotate_seconds) != interval
+        return False
+
+    def _segment_path(self):
+        started = self.first_received_at or self.opened_at
+        path = '%s.%s' % (
+            self.path, time.strftime('%Y%m%dT%H%M%S', time.gmtime(started)))
+        candidate = path
+        n = 1
+        while os.path.exists(candidate):
+            candidate = '%s.%d' % (path, n)
+            n += 1
+        return candidate
+
+    def rotate(self):
+        """Move the current log aside and start a new one."""
+        self.flush()
+        self.f.close()
+
+        segment = self._segment_path()
+        os.rename(self.path, segment)
+        with open(self.segments_path, 'a') as f:
+            f.write(json.dumps({
+                'path': os.path.basename(segment),
+                'first_received_at': self.first_received_at,
+                'last_received_at': self.last_received_at,
+                'events': self.events,
+                'bytes': self.size,
+            }, sort_keys=True))
+            f.write('\n')
+
+        self._open()
+
+    def close(self):
+        if self.f is not None:
+            self.flush()
+            self.f.close()
+            self.f = None
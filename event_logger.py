@@ -11,99 +11,386 @@
 # the License.
 
 import argparse
+import collections
 import getpass
+import hashlib
 import json
 import os
+import random
 import select
+import sys
+import threading
 import time
 import traceback
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
 import dogpile.cache
 import paramiko
 
+import activity
+import event_log
+import event_store
+import fanout
+import gerrit_query
+import metrics
+import notifications
+import priority_rules
+
 
 GERRIT_TIMEOUT = 15
 GERRIT_RECV_BYTES = 16384
 
+RECONNECT_MIN_DELAY = 1
+RECONNECT_MAX_DELAY = 300
+RECENT_EVENTS = 10000
+
 DEBUG = False
 VERBOSE = False
 
+# Compiled priority rules, if any were configured.
+RULES = None
+
+# Lookups of change metadata, by origin, if any rules need them.
+LOOKUPS = {}
+
 
 CACHE_DIR = os.path.expanduser('~/.gerrit-growler')
 if not os.path.exists(CACHE_DIR):
     os.mkdir(CACHE_DIR, 0o0700)
 
+METRICS = metrics.Metrics()
+ACTIVITY = activity.Activity()
+
 CACHE = dogpile.cache.make_region().configure(
     'dogpile.cache.dbm',
     expiration_time=15,
     arguments={'filename': '%s/cache.dbm' % CACHE_DIR})
 
 
-def get_client(host, port, username, password=None):
-    """Return an authenticated SSH client."""
+def connect(host, port, username, password=None):
+    """Return an SSH client connected to host, or raise paramiko's errors."""
     client = paramiko.SSHClient()
     client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
     client.load_system_host_keys()
+    client.connect(host, port=port, username=username, password=password)
+    return client
+
+
+def auth_failed(host):
+    return SystemExit('Failed to authenticate against %s. Have you added '
+                      'your SSH public key to Gerrit?' % host)
+
+
+def get_client(host, port, username, password=None):
+    """Return an authenticated SSH client.
+
+    Never prompts: password is the passphrase of the SSH key, if it needs
+    one, as returned by unlock_key().
+    """
     try:
-        client.connect(
-            host,
-            port=port,
-            username=username,
-            password=password)
+        return connect(host, port, username, password)
     except paramiko.PasswordRequiredException:
-        password = getpass.getpass('SSH Key Passphrase: ')
-        return get_client(password=getpass.getpass('SSH Key Passphrase: '))
+        raise SystemExit('Failed to unlock your SSH key for %s.' % host)
     except paramiko.AuthenticationException:
-        raise SystemExit('Failed to authenticate against %s. Have you added '
-                         'your SSH public key to Gerrit?' % host)
-    return client
+        raise auth_failed(host)
 
 
-def list_events(host, port, username):
-    """A real-time iterable of events occurring in gerrit."""
-    return_buffer = ''
+def unlock_key(host, port, username):
+    """Return the passphrase of the user's SSH key, or None if it has none.
+
+    Connects to host to find out, prompting for the passphrase if the key
+    needs one, so that it's only ever asked for once.
+    """
+    password = None
+    while True:
+        try:
+            connect(host, port, username, password).close()
+            return password
+        except paramiko.PasswordRequiredException:
+            if password is not None:
+                raise SystemExit(
+                    'Failed to unlock your SSH key for %s.' % host)
+            password = getpass.getpass('SSH Key Passphrase: ')
+        except paramiko.AuthenticationException:
+            raise auth_failed(host)
+        except Exception as e:
+            # The logger will keep trying to reach the host anyway.
+            sys.stderr.write('Failed to connect to %s: %s\n' % (host, e))
+            return password
+
+
+def read_lines(channel, timeout=GERRIT_TIMEOUT, origin=None):
+    """Yield each complete line received on a channel, as bytes.
+
+    Blocks in select() until the channel is readable, then drains every
+    complete line out of the receive buffer before waiting again. Any
+    trailing partial line is kept for the next recv(). Bytes received and the
+    size of the buffer are reported in METRICS, labelled with origin.
+    """
+    buf = bytearray()
+    while True:
+        readable, _, _ = select.select([channel], [], [], timeout)
+        if not readable:
+            # Nothing arrived within the timeout; give up if the remote
+            # command has exited, otherwise keep waiting.
+            exit_status_ready = getattr(channel, 'exit_status_ready', None)
+            if exit_status_ready is not None and exit_status_ready():
+                return
+            continue
+
+        data = channel.recv(GERRIT_RECV_BYTES)
+        if not data:
+            # recv() returns an empty string when the channel closes.
+            return
+        buf.extend(data)
+        METRICS.inc('received_bytes_total', len(data), origin=origin)
+
+        start = 0
+        end = buf.find(b'\n', start)
+        while end != -1:
+            yield bytes(buf[start:end])
+            start = end + 1
+            end = buf.find(b'\n', start)
+        if start:
+            del buf[:start]
+        METRICS.set('buffer_bytes', len(buf), origin=origin)
+
+
+def decode_event(line):
+    """Decode an event, counting the time spent in METRICS."""
+    with METRICS.timer('json_loads'):
+        return json.loads(line.decode('utf-8'))
+
+
+def list_events(host, port, username, password=None, raw=False):
+    """A real-time iterable of events occurring in gerrit.
+
+    If raw is set, events are yielded as event_log.RawEvent, which are only
+    decoded if something needs more than their type.
+    """
+    client = get_client(host, port, username, password)
     try:
-        client = get_client(host, port, username)
         stdin, stdout, stderr = client.exec_command('gerrit stream-events')
-
-        while not stderr.channel.exit_status_ready():
-            while stderr.channel.recv_ready():
-                readable, w, e = select.select(
-                    [stderr.channel], [], [], GERRIT_TIMEOUT)
-
-                # readable will be an empty string when the channel closes
-                if readable:
-                    return_buffer += stderr.channel.recv(GERRIT_RECV_BYTES)
-                    if '\n' in return_buffer:
-                        event, return_buffer = return_buffer.split('\n', 1)
-                        yield json.loads(event)
-            # FIXME: there's got to be a more efficient way to idle here
-            time.sleep(0.1)
+        for line in read_lines(stdout.channel, origin=origin(host, port)):
+            if raw:
+                yield event_log.RawEvent(line, decode_event)
+            else:
+                yield decode_event(line)
     finally:
         client.close()
 
 
+def event_key(event):
+    """Return a key identifying an event, regardless of when it arrived."""
+    if isinstance(event, event_log.RawEvent):
+        # Replayed events are sent as the same line.
+        return hashlib.sha1(event.line).digest()
+    change = event.get('change', {})
+    patch_set = event.get('patchSet', {})
+    ref_update = event.get('refUpdate', {})
+    return (
+        event.get('type'),
+        event.get('eventCreatedOn'),
+        change.get('number'),
+        patch_set.get('revision'),
+        ref_update.get('refName'),
+        ref_update.get('newRev'),
+        event.get('comment'))
+
+
+class RecentEvents(object):
+    """A bounded set of the most recently seen event keys."""
+
+    def __init__(self, size=RECENT_EVENTS):
+        self.size = size
+        self.keys = collections.OrderedDict()
+
+    def seen(self, key):
+        """Return True if key was seen recently, and remember it either way."""
+        if key in self.keys:
+            # Move the key to the most recently used end.
+            del self.keys[key]
+            self.keys[key] = True
+            return True
+
+        self.keys[key] = True
+        if len(self.keys) > self.size:
+            self.keys.popitem(last=False)
+        return False
+
+
+GAP_LOG_LOCK = threading.Lock()
+
+
+def record_gap(path, gap):
+    """Append a disconnect window to the gap log."""
+    if VERBOSE:
+        sys.stderr.write('Lost %(origin)s for %(seconds).1fs\n' % {
+            'origin': gap['origin'],
+            'seconds': gap['reconnected_at'] - gap['disconnected_at']})
+    if path is None:
+        return
+    with GAP_LOG_LOCK:
+        with open(path, 'a') as f:
+            f.write(json.dumps(gap, sort_keys=True))
+            f.write('\n')
+
+
+def follow(host, port, username, callback, gap_log=None, password=None):
+    """Pass events from a Gerrit server to callback, reconnecting forever.
+
+    Reconnects are delayed with exponential backoff and full jitter, and the
+    delay is only reset once a connection delivers an event. Each window
+    between the last event before a disconnect and the first event after it
+    is recorded in gap_log, and events replayed after a reconnect are
+    dropped.
+    """
+    recent = RecentEvents()
+    delay = RECONNECT_MIN_DELAY
+    last_received_at = None
+    last_created_on = None
+    disconnected_at = None
+    while True:
+        try:
+            for event in list_events(
+                    host, port, username, password, raw=True):
+                received_at = time.time()
+                delay = RECONNECT_MIN_DELAY
+                if disconnected_at is not None:
+                    record_gap(gap_log, {
+                        'origin': origin(host, port),
+                        'disconnected_at': disconnected_at,
+                        'reconnected_at': received_at,
+                        'last_received_at': last_received_at,
+                        'last_event_created_on': last_created_on,
+                        'first_event_created_on': event.get('eventCreatedOn'),
+                    })
+                    disconnected_at = None
+                last_received_at = received_at
+                last_created_on = event.get('eventCreatedOn', last_created_on)
+
+                if recent.seen(event_key(event)):
+                    continue
+                callback(host, port, event)
+        except SystemExit as e:
+            # Authentication failures won't be fixed by retrying.
+            sys.stderr.write('%s\n' % e)
+            return
+        except Exception:
+            traceback.print_exc()
+
+        if disconnected_at is None:
+            disconnected_at = time.time()
+        METRICS.inc('reconnects_total', origin=origin(host, port))
+        time.sleep(random.uniform(0, delay))
+        delay = min(delay * 2, RECONNECT_MAX_DELAY)
+
+
+def stream_events(endpoints, username, gap_log=None, prefetch=None,
+                  idle=None, password=None):
+    """A merged, real-time iterable of events from several Gerrit servers.
+
+    Each (host, port) endpoint is followed by its own thread, so a slow or
+    broken server never holds up the others. Events are stamped with the time
+    they were received and the host:port they came from (their origin), and
+    are yielded as (host, port, event) tuples in the order they were
+    received. If given, prefetch(host, port, event) is called by each thread
+    as events arrive.
+    If given, idle() is called before waiting for each event, and returns the
+    longest time to wait before calling it again (or None for no limit).
+    Exits once every server has stopped being followed.
+    """
+    events = queue.Queue()
+    lock = threading.Lock()
+
+    def receive(host, port, event):
+        if prefetch is not None:
+            prefetch(host, port, event)
+        # Stamp and enqueue together so the merged stream stays ordered by
+        # received_at.
+        with lock:
+            event['received_at'] = time.time()
+            event['origin'] = origin(host, port)
+            events.put((host, port, event))
+
+    def run(host, port):
+        try:
+            follow(host, port, username, receive, gap_log, password)
+        finally:
+            # Let the main thread know this server is no longer followed.
+            events.put(None)
+
+    following = 0
+    for host, port in endpoints:
+        thread = threading.Thread(
+            target=run, args=(host, port),
+            name='gerrit-%s:%d' % (host, port))
+        thread.daemon = True
+        thread.start()
+        following += 1
+
+    while True:
+        # A timeout keeps the main thread responsive to KeyboardInterrupt.
+        timeout = GERRIT_TIMEOUT
+        if idle is not None:
+            wait = idle()
+            if wait is not None:
+                timeout = min(timeout, wait)
+        try:
+            received = events.get(timeout=timeout)
+        except queue.Empty:
+            continue
+        if received is None:
+            following -= 1
+            if not following:
+                raise SystemExit('No Gerrit servers left to follow.')
+            continue
+        yield received
+
+
+def origin(host, port):
+    """Return the name events from a Gerrit server are tagged with."""
+    return '%s:%d' % (host, port)
+
+
+def parse_endpoint(value, default_port):
+    """Parse a host[:port] string into a (host, port) tuple."""
+    host, sep, port = value.rpartition(':')
+    if not sep:
+        return value, default_port
+    return host, int(port)
+
+
+def lookup_change(event):
+    """Return the metadata of an event's change, looked up in Gerrit."""
+    return LOOKUPS[event['origin']].get(event['change']['number'])
+
+
+def prefetch_change(host, port, event):
+    """Start looking up an event's change, so it's ready when needed."""
+    if 'change' in event:
+        LOOKUPS[origin(host, port)].prefetch(event['change']['number'])
+
+
 def is_priority(event, host, port, username):
     if 'change' not in event:
         # this is probably a ref-updated event
         return False
 
-    return True
-
-
-def log_event(event):
-    event['received_at'] = time.time()
-    with open('event.log', 'a') as f:
-        f.write(json.dumps(event, separators=(',', ':')))
-        f.write('\n')
+    if RULES is not None and not RULES.needs_lookup:
+        return RULES.match(event)
 
+    # Rules which look changes up are matched by the notification workers,
+    # so that a slow Gerrit never holds up the events.
+    return True
 
-def notify(event):
-    """Emit a growl notification for the specified event."""
-    # The notification title.
-    title = event['change']['subject']
 
-    # The notification message.
+def describe(event):
+    """Return a short description of an event for a notification."""
     message = list()
     message.append(event['type'].replace('-', ' ').capitalize())
     if 'author' in event:
@@ -115,7 +402,18 @@ def notify(event):
             'type': approval['type'],
             'negative': '+' if '-' not in approval['value'] else '',
             'value': approval['value']})
-    message = ' '.join(message)
+    return ' '.join(message)
+
+
+def notify(events):
+    """Emit a growl notification for a burst of events on one change."""
+    event = events[-1]
+
+    # The notification title.
+    title = event['change']['subject']
+
+    # The notification message.
+    message = '; '.join(describe(e) for e in events)
 
     # The notification subtitle.
     subtitle = event['change']['project']
@@ -126,8 +424,21 @@ def notify(event):
     print((title, subtitle, message, url))
 
 
+def timed_notify(events):
+    with METRICS.timer('notify'):
+        notify(events)
+
+
+def record_event(event):
+    """Count an event, and how long it took to reach us, in METRICS."""
+    METRICS.inc('events_total', type=event['type'])
+    if 'eventCreatedOn' in event:
+        METRICS.observe(
+            'lag_seconds', event['received_at'] - event['eventCreatedOn'])
+
+
 def main():
-    global DEBUG, VERBOSE
+    global DEBUG, VERBOSE, RULES
 
     parser = argparse.ArgumentParser(
         description='Receive growl notifications for your starred changes in '
@@ -139,30 +450,207 @@ def main():
         '--debug', dest='debug', action='store_true',
         help='Enable debug output.')
     parser.add_argument(
-        '--host', dest='host',
-        default='review.openstack.org',
-        help='SSH hostname for Gerrit.')
+        '--host', dest='hosts', action='append', metavar='HOST',
+        help='SSH hostname for Gerrit, optionally as host:port. Repeat to '
+             'follow several Gerrit servers in one merged log (default: '
+             'review.openstack.org).')
     parser.add_argument(
         '--port', dest='port', type=int,
         default=29418,
-        help='SSH port for Gerrit.')
+        help='Default SSH port for Gerrit.')
     parser.add_argument(
         '--username', dest='username',
         default=getpass.getuser(),
         help='Your SSH username for Gerrit.')
+    parser.add_argument(
+        '--log-file', dest='log_file',
+        default='event.log',
+        help='File to append events to.')
+    parser.add_argument(
+        '--log-format', dest='log_format', choices=('jsonl', 'binary'),
+        default='jsonl',
+        help='Write the log as JSON lines, or as a compact event store.')
+    parser.add_argument(
+        '--gap-log', dest='gap_log',
+        help='File to record disconnect windows in (default: the log file '
+             'with a .gaps suffix).')
+    parser.add_argument(
+        '--flush-events', dest='flush_events', type=int,
+        help='Flush the log after this many events (0 to disable; default: '
+             '1, or 0 with --flush-ms).')
+    parser.add_argument(
+        '--flush-ms', dest='flush_ms', type=int,
+        help='Flush the log once this many milliseconds have passed since '
+             'the last flush, even if no more events arrive.')
+    parser.add_argument(
+        '--fsync', dest='fsync', action='store_true',
+        help='fsync() the log after each flush.')
+    parser.add_argument(
+        '--rotate-bytes', dest='rotate_bytes', type=int,
+        help='Rotate the log before it grows beyond this many bytes.')
+    parser.add_argument(
+        '--rotate-seconds', dest='rotate_seconds', type=int,
+        help='Rotate the log at this interval (e.g. 86400 for daily).')
+    parser.add_argument(
+        '--rules', dest='rules',
+        help='JSON file of rules deciding which changes to be notified '
+             'about (default: all of them).')
+    parser.add_argument(
+        '--query-batch', dest='query_batch', type=int,
+        default=gerrit_query.QUERY_BATCH,
+        help='Maximum changes to look up in one gerrit query, for rules on '
+             'starred changes or changes you\'re reviewing.')
+    parser.add_argument(
+        '--query-window-ms', dest='query_window_ms', type=int,
+        default=int(gerrit_query.QUERY_WINDOW * 1000),
+        help='Milliseconds to wait for more changes to look up before '
+             'running a gerrit query.')
+    parser.add_argument(
+        '--notify-window', dest='notify_window', type=float,
+        default=2.0,
+        help='Seconds over which to coalesce notifications for a change.')
+    parser.add_argument(
+        '--notify-rate', dest='notify_rate', type=float,
+        default=1.0,
+        help='Maximum notifications per second, on average.')
+    parser.add_argument(
+        '--notify-burst', dest='notify_burst', type=int,
+        default=5,
+        help='Maximum notifications to send back to back.')
+    parser.add_argument(
+        '--notify-workers', dest='notify_workers', type=int,
+        default=2,
+        help='Number of threads delivering notifications.')
+    parser.add_argument(
+        '--notify-queue', dest='notify_queue', type=int,
+        default=1000,
+        help='Maximum notifications waiting to be delivered before new ones '
+             'are dropped.')
+    parser.add_argument(
+        '--fanout-socket', dest='fanout_socket',
+        help='Republish events to local subscribers on this Unix socket, '
+             'so they needn\'t open SSH sessions of their own.')
+    parser.add_argument(
+        '--fanout-buffer', dest='fanout_buffer', type=int,
+        default=10000,
+        help='Maximum events waiting to be sent to each subscriber.')
+    parser.add_argument(
+        '--fanout-drop', dest='fanout_drop', choices=fanout.DROP_POLICIES,
+        default='oldest',
+        help='Which events to drop when a subscriber\'s buffer is full.')
+    parser.add_argument(
+        '--metrics-port', dest='metrics_port', type=int,
+        help='Serve metrics in Prometheus text format on this local port, '
+             'at /metrics, and rolling activity counts as JSON at '
+             '/activity.')
+    parser.add_argument(
+        '--stats-file', dest='stats_file',
+        help='Periodically rewrite this file with metrics in Prometheus text '
+             'format.')
+    parser.add_argument(
+        '--stats-interval', dest='stats_interval', type=float,
+        default=15,
+        help='Seconds between rewrites of --stats-file and '
+             '--activity-file.')
+    parser.add_argument(
+        '--activity-file', dest='activity_file',
+        help='Periodically rewrite this file with rolling activity counts '
+             'per project and reviewer, as JSON.')
     args = parser.parse_args()
 
     DEBUG = args.debug
+    if args.flush_events is None:
+        args.flush_events = 0 if args.flush_ms else 1
     VERBOSE = args.verbose
+    if args.rules:
+        RULES = priority_rules.Rules.load(args.rules, lookup_change)
+
+    endpoints = [
+        parse_endpoint(host, args.port)
+        for host in args.hosts or ['review.openstack.org']]
+
+    # Ask for the passphrase of the SSH key up front, rather than from each
+    # thread that connects to Gerrit.
+    password = unlock_key(endpoints[0][0], endpoints[0][1], args.username)
+
+    prefetch = None
+    if RULES is not None and RULES.needs_lookup:
+        for host, port in endpoints:
+            LOOKUPS[origin(host, port)] = gerrit_query.ChangeLookup(
+                lambda host=host, port=port: get_client(
+                    host, port, args.username, password),
+                args.username,
+                cache=CACHE,
+                ttl=CACHE.expiration_time,
+                batch=args.query_batch,
+                window=args.query_window_ms / 1000.0,
+                metrics=METRICS,
+                prefix=origin(host, port) + ':')
+        prefetch = prefetch_change
+
+    pipeline = notifications.NotificationPipeline(
+        timed_notify,
+        workers=args.notify_workers,
+        window=args.notify_window,
+        rate=args.notify_rate,
+        burst=args.notify_burst,
+        maxsize=args.notify_queue,
+        accept=RULES.match if prefetch is not None else None)
+
+    if args.log_format == 'binary':
+        writer_class = event_store.EventStoreWriter
+    else:
+        writer_class = event_log.EventLogWriter
+    writer = writer_class(
+        args.log_file,
+        flush_events=args.flush_events,
+        flush_ms=args.flush_ms,
+        fsync=args.fsync,
+        rotate_bytes=args.rotate_bytes,
+        rotate_seconds=args.rotate_seconds)
+
+    METRICS.register_gauge(
+        'notifications_dropped', lambda: pipeline.dropped)
+    publisher = None
+    if args.fanout_socket:
+        publisher = fanout.FanoutServer(
+            args.fanout_socket, args.fanout_buffer, args.fanout_drop).start()
+        METRICS.register_gauge(
+            'fanout_subscribers', lambda: len(publisher.subscribers))
+        METRICS.register_gauge('fanout_dropped', lambda: publisher.dropped)
+    if args.metrics_port:
+        metrics.serve(args.metrics_port, {
+            '/metrics': lambda: ('text/plain; version=0.0.4',
+                                 METRICS.render()),
+            '/activity': lambda: ('application/json', ACTIVITY.render()),
+        })
+    if args.stats_file:
+        metrics.write_periodically(
+            args.stats_file, METRICS.render, args.stats_interval)
+    if args.activity_file:
+        metrics.write_periodically(
+            args.activity_file, ACTIVITY.render, args.stats_interval)
 
-    while True:
-        try:
-            for event in list_events(args.host, args.port, args.username):
-                log_event(event)
-                if is_priority(event, args.host, args.port, args.username):
-                    notify(event)
-        except Exception:
-            traceback.print_exc()
+    try:
+        events = stream_events(
+            endpoints, args.username,
+            gap_log=args.gap_log or args.log_file + '.gaps',
+            prefetch=prefetch, idle=writer.tick, password=password)
+        for host, port, event in events:
+            record_event(event)
+            with METRICS.timer('activity'):
+                ACTIVITY.add(event)
+            with METRICS.timer('log_event'):
+                writer.write(event)
+            if publisher is not None:
+                with METRICS.timer('fanout'):
+                    publisher.publish(event)
+            if is_priority(event, host, port, args.username):
+                pipeline.submit(event)
+    finally:
+        writer.close()
+        if publisher is not None:
+            publisher.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,265 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+"""A compact, dictionary-encoded alternative to JSON lines event logs.
+
+A store begins with MAGIC, followed by length-prefixed records. Each change,
+patch set and account (user) is written in its own record the first time it
+is seen; events then refer to them by ID instead of repeating them. Writers
+only remember so many entries, and forget them when restarted, so an entry
+may be written again under a new ID.
+Readers yield the same dicts as the JSON lines log would, except that events
+sharing a change, patch set or account share the same dict, so they shouldn't
+be modified.
+"""
+
+import argparse
+import collections
+import hashlib
+import json
+import mmap
+import os
+import struct
+
+import event_log
+
+
+MAGIC = b'GGES\x01\n'
+
+RECORD = struct.Struct('>BI')
+CHANGE = 1
+ACCOUNT = 2
+EVENT = 3
+PATCH_SET = 4
+
+ACCOUNT_KEYS = frozenset(['name', 'email', 'username'])
+
+# Entries remembered by a writer per table. Beyond this, the table is
+# forgotten, and entries are defined again (under new IDs) as they're seen.
+TABLE_SIZE = 100000
+
+
+def is_account(value):
+    return (isinstance(value, dict) and value and
+            ACCOUNT_KEYS.issuperset(value))
+
+
+def is_store(path):
+    """Return True if path is an event store rather than a JSON lines log."""
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def dumps(value):
+    return json.dumps(value, separators=(',', ':'), sort_keys=True)
+
+
+class EventStoreWriter(event_log.EventLogWriter):
+    """Append events to an event store, with the same policies as a log."""
+
+    def _open(self):
+        # Each table maps the digest of an entry to its ID.
+        self.changes = {}
+        self.patch_sets = {}
+        self.accounts = {}
+        self.counts = collections.Counter()
+        exists = os.path.exists(self.path) and os.path.getsize(self.path)
+        if exists:
+            # Carry on numbering entries after those already in the store.
+            # Entries already in it are defined again when they're next seen,
+            # rather than decoding the whole store to find them.
+            self.counts, end = count_records(self.path)
+            if end < os.path.getsize(self.path):
+                # Anything appended after a partially written record would be
+                # misread, so cut it off.
+                with open(self.path, 'r+b') as f:
+                    f.truncate(end)
+
+        super(EventStoreWriter, self)._open()
+        if not exists:
+            self.f.write(MAGIC)
+            self.size += len(MAGIC)
+
+    def _recover(self):
+        self.events = self.counts[EVENT]
+        events = read_store(self.path)
+        for event in events:
+            self.first_received_at = event.get('received_at')
+            break
+        events.close()
+
+    def _reference(self, table, kind, payload, records):
+        """Return the ID of a table entry, defining it if it's new."""
+        payload = payload.encode('utf-8')
+        key = hashlib.sha1(payload).digest()
+        ref = table.get(key)
+        if ref is None:
+            if len(table) >= TABLE_SIZE:
+                table.clear()
+            ref = table[key] = self.counts[kind]
+            self.counts[kind] += 1
+            records.append(RECORD.pack(kind, len(payload)))
+            records.append(payload)
+        return ref
+
+    def _extract(self, value, records):
+        """Replace the accounts in a dict with references to them."""
+        body = dict()
+        refs = dict()
+        for key, item in value.items():
+            if is_account(item):
+                refs[key] = self._reference(
+                    self.accounts, ACCOUNT, dumps(item), records)
+            else:
+                body[key] = item
+        return body, refs
+
+    def _store(self, table, kind, value, records):
+        """Return the ID of a change or patch set, and of its accounts."""
+        body, refs = self._extract(value, records)
+        return self._reference(table, kind, dumps([refs, body]), records)
+
+    def encode(self, event):
+        if isinstance(event, event_log.RawEvent):
+            event = event.event
+        records = []
+        body, refs = self._extract(event, records)
+
+        change = None
+        if 'change' in body:
+            change = self._store(
+                self.changes, CHANGE, body.pop('change'), records)
+        patch_set = None
+        if 'patchSet' in body:
+            patch_set = self._store(
+                self.patch_sets, PATCH_SET, body.pop('patchSet'), records)
+
+        payload = dumps([change, patch_set, refs, body]).encode('utf-8')
+        records.append(RECORD.pack(EVENT, len(payload)))
+        records.append(payload)
+        return b''.join(records)
+
+
+def read_records(path):
+    """Yield the (kind, payload) of each record in an event store."""
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('%s is not an event store' % path)
+        size = os.fstat(f.fileno()).st_size
+        if size == len(MAGIC):
+            return
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            offset = len(MAGIC)
+            while offset + RECORD.size <= size:
+                kind, length = RECORD.unpack_from(mm, offset)
+                offset += RECORD.size
+                if offset + length > size:
+                    # Leave a partially written record alone.
+                    break
+                yield kind, mm[offset:offset + length]
+                offset += length
+        finally:
+            mm.close()
+
+
+def count_records(path):
+    """Return the number of records of each kind in an event store.
+
+    Also returns the offset just past the last complete record.
+    """
+    counts = collections.Counter()
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('%s is not an event store' % path)
+        size = os.fstat(f.fileno()).st_size
+        offset = len(MAGIC)
+        while offset + RECORD.size <= size:
+            kind, length = RECORD.unpack(f.read(RECORD.size))
+            if offset + RECORD.size + length > size:
+                break
+            counts[kind] += 1
+            offset += RECORD.size + length
+            f.seek(offset)
+    return counts, offset
+
+
+def _resolve(body, refs, accounts):
+    for key, ref in refs.items():
+        body[key] = accounts[ref]
+    return body
+
+
+def read_store(path):
+    """Yield each event in an event store, as a dict."""
+    changes = []
+    patch_sets = []
+    accounts = []
+    for kind, payload in read_records(path):
+        if kind == EVENT:
+            change, patch_set, refs, event = json.loads(
+                payload.decode('utf-8'))
+            if change is not None:
+                event['change'] = changes[change]
+            if patch_set is not None:
+                event['patchSet'] = patch_sets[patch_set]
+            yield _resolve(event, refs, accounts) if refs else event
+        elif kind == ACCOUNT:
+            accounts.append(json.loads(payload.decode('utf-8')))
+        elif kind == CHANGE:
+            refs, change = json.loads(payload.decode('utf-8'))
+            changes.append(_resolve(change, refs, accounts))
+        elif kind == PATCH_SET:
+            refs, patch_set = json.loads(payload.decode('utf-8'))
+            patch_sets.append(_resolve(patch_set, refs, accounts))
+
+
+def to_store(source, destination):
+    """Convert a JSON lines log into an event store."""
+    writer = EventStoreWriter(destination, flush_events=0)
+    try:
+        with open(source, 'rb') as f:
+            for line in f:
+                writer.write(json.loads(line.decode('utf-8')))
+    finally:
+        writer.close()
+
+
+def to_jsonl(source, destination):
+    """Convert an event store into a JSON lines log."""
+    with open(destination, 'ab') as f:
+        for event in read_store(source):
+            f.write(event_log.encode_event(event))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Convert Gerrit event logs to and from event stores.')
+    parser.add_argument(
+        'format', choices=('binary', 'jsonl'),
+        help='Format to convert to.')
+    parser.add_argument(
+        'source',
+        help='Event log or event store to read.')
+    parser.add_argument(
+        'destination',
+        help='Event store or event log to append to.')
+    args = parser.parse_args()
+
+    if args.format == 'binary':
+        to_store(args.source, args.destination)
+    else:
+        to_jsonl(args.source, args.destination)
+
+
+if __name__ == '__main__':
+    main()
@@ -9,23 +9,40 @@
 # WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 # License for the specific language governing permissions and limitations under
 # the License.
+import argparse
+import collections
 import fileinput
+import glob
+import io
 import json
+import multiprocessing
+import os
 import sys
 import time
 
+import change_state
+import event_archive
+import event_log
+import event_store
+import user_registry
 
-# http://stackoverflow.com/q/21129020/
-reload(sys)
-sys.setdefaultencoding('utf8')
 
-BOTS = set()
+if sys.version_info[0] < 3:
+    # http://stackoverflow.com/q/21129020/
+    reload(sys)  # noqa: F821
+    sys.setdefaultencoding('utf8')
+
+# Every user seen, and whether they're a bot.
+USERS = user_registry.UserRegistry()
+
+# The state of each change, if it's being maintained as events are read.
+CHANGES = None
 
 
 def is_bot(user):
     if 'username' not in user:
         return False
-    return user['username'] in BOTS or ' CI' in user['name']
+    return USERS.is_bot(user)
 
 
 def name(user):
@@ -45,98 +62,533 @@ def review(review):
         review['url'])
 
 
-def pretty_print(event, message):
-    if 'received_at' in event:
-        received_at = time.gmtime(event['received_at'])
-        print(u'- [{0}] {1}'.format(
-            time.strftime('%Y-%m-%d %H:%M:%S', received_at).encode('utf-8'),
-            message))
+# A classified event: who did what to which change, and when.
+Action = collections.namedtuple(
+    'Action', 'received_at type user verb detail change')
 
+# Lines buffered by each sink before they're written out.
+SINK_BUFFER_LINES = 1000
 
-def main():
-    for line in fileinput.input():
-        event = json.loads(line)
-        if event['type'] == 'change-abandoned':
-            if is_bot(event['abandoner']):
-                continue
-            pretty_print(event, '%s abandoned %s' % (
-                name(event['abandoner']),
-                review(event['change'])))
-        elif event['type'] == 'change-restored':
-            if is_bot(event['restorer']):
-                continue
-            pretty_print(event, '%s restored %s' % (
-                name(event['restorer']),
-                review(event['change'])))
-        elif event['type'] == 'patchset-created':
-            if is_bot(event['uploader']):
-                continue
-            pretty_print(event, '%s revised %s' % (
-                name(event['uploader']),
-                review(event['change'])))
-        elif event['type'] == 'change-merged':
-            pretty_print(event, '%s merged %s' % (
-                name(event['submitter']),
-                review(event['change'])))
-        elif event['type'] == 'comment-added':
-            if is_bot(event['author']):
+
+def votes(event):
+    """Return the Code-Review, Verified and Workflow votes on an event."""
+    code_review = 0
+    verified = 0
+    workflow = 0
+    for approval in event.get('approvals', []):
+        if approval['type'] == 'Workflow':
+            workflow = int(approval['value'])
+        elif approval['type'] == 'Verified':
+            verified = int(approval['value'])
+        elif approval['type'] == 'Code-Review':
+            code_review = int(approval['value'])
+    return code_review, verified, workflow
+
+
+def action(event, user, verb, detail=None):
+    return Action(event.get('received_at'), event['type'], user, verb,
+                  detail, event['change'])
+
+
+def change_abandoned(event):
+    if not is_bot(event['abandoner']):
+        return action(event, event['abandoner'], 'abandoned')
+
+
+def change_restored(event):
+    if not is_bot(event['restorer']):
+        return action(event, event['restorer'], 'restored')
+
+
+def patchset_created(event):
+    if not is_bot(event['uploader']):
+        return action(event, event['uploader'], 'revised')
+
+
+def change_merged(event):
+    return action(event, event['submitter'], 'merged')
+
+
+def comment_added(event):
+    if is_bot(event['author']):
+        return
+    code_review, verified, workflow = votes(event)
+
+    if workflow >= 1:
+        return action(event, event['author'], 'approved')
+    elif workflow <= -1:
+        return action(event, event['author'], 'WIP\'d')
+    elif code_review != 0:
+        return action(event, event['author'], '%s%d\'d' % (
+            '+' if code_review >= 1 else '', code_review))
+    elif verified != 0:
+        return action(event, event['author'], 'tested', '%s%d' % (
+            '+' if verified >= 1 else '', verified))
+    else:
+        return action(event, event['author'], 'commented on')
+
+
+def ignored(event):
+    return None
+
+
+CLASSIFIERS = {
+    'change-abandoned': change_abandoned,
+    'change-restored': change_restored,
+    'patchset-created': patchset_created,
+    'change-merged': change_merged,
+    'comment-added': comment_added,
+    # I think this is review request spam; ignore?
+    'reviewer-added': ignored,
+    # A bug was added to the commit message, etc; ignore?
+    'topic-changed': ignored,
+    # I think this is a change rebased by gerrit; ignore?
+    'ref-updated': ignored,
+    # Non-human events; ignore?
+    'merge-failed': ignored,
+    'ref-replicated': ignored,
+    'ref-replication-done': ignored,
+}
+
+
+class UnknownEventType(ValueError):
+    """An event of a type with no classifier, described by its JSON."""
+
+
+def classify(event):
+    """Return the Action an event describes, or None to skip it."""
+    classifier = CLASSIFIERS.get(event['type'])
+    if classifier is None:
+        raise UnknownEventType(json.dumps(event, indent=2))
+    if CHANGES is not None:
+        CHANGES.update(event)
+    return classifier(event)
+
+
+def timestamp(received_at):
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(received_at))
+
+
+def markdown(action):
+    """Return a markdown list item for an action, or None if it's undated."""
+    if action.received_at is None:
+        return None
+    message = u'%s %s %s' % (name(action.user), action.verb,
+                             review(action.change))
+    if action.detail is not None:
+        message += u' (%s)' % action.detail
+    return u'- [%s] %s' % (timestamp(action.received_at), message)
+
+
+def render(event):
+    """Return a markdown line describing an event, or None to skip it."""
+    classified = classify(event)
+    if classified is not None:
+        return markdown(classified)
+
+
+class Sink(object):
+    """An output format, written to a file (or stdout) in buffered batches.
+
+    Subclasses format each action as a line, or override write() and close()
+    to write something once every action has been seen.
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.lines = []
+
+    def format(self, action):
+        raise NotImplementedError()
+
+    def write(self, action):
+        line = self.format(action)
+        if line is not None:
+            self.lines.append(line)
+            if len(self.lines) >= SINK_BUFFER_LINES:
+                self.flush()
+
+    def flush(self):
+        if self.lines:
+            self.f.write(u''.join(self.lines))
+            self.lines = []
+        self.f.flush()
+
+    def close(self):
+        self.flush()
+        if self.f is not sys.stdout:
+            self.f.close()
+
+
+class MarkdownSink(Sink):
+    """A markdown list item per event."""
+
+    def format(self, action):
+        line = markdown(action)
+        if line is not None:
+            return line + u'\n'
+
+
+class DigestSink(Sink):
+    """A JSON object per event, for bots to consume."""
+
+    def format(self, action):
+        digest = {
+            'received_at': action.received_at,
+            'type': action.type,
+            'username': action.user.get('username'),
+            'name': action.user.get('name'),
+            'action': action.verb,
+            'detail': action.detail,
+            'project': action.change.get('project'),
+            'change': action.change.get('number'),
+            'subject': action.change.get('subject'),
+            'url': action.change.get('url'),
+        }
+        state = CHANGES and CHANGES.get(action.change.get('number'))
+        if state:
+            digest['status'] = state['status']
+            digest['bugs'] = [number for impact, number in state['bugs']]
+        return u'%s\n' % json.dumps(digest, sort_keys=True)
+
+
+class ProjectsSink(Sink):
+    """A markdown breakdown of the activity in each project, once done."""
+
+    def __init__(self, f):
+        super(ProjectsSink, self).__init__(f)
+        self.projects = collections.defaultdict(collections.Counter)
+
+    def write(self, action):
+        self.projects[action.change.get('project')][action.verb] += 1
+
+    def close(self):
+        for project, counts in sorted(self.projects.items()):
+            self.lines.append(u'- `%s`: %d events (%s)\n' % (
+                project, sum(counts.values()), ', '.join(
+                    '%d %s' % (count, verb)
+                    for verb, count in counts.most_common())))
+        super(ProjectsSink, self).close()
+
+
+SINKS = {
+    'markdown': MarkdownSink,
+    'json': DigestSink,
+    'projects': ProjectsSink,
+}
+
+
+def parse_sink(value):
+    """Parse a FORMAT[:PATH] sink specification."""
+    sink_format, _, path = value.partition(':')
+    if sink_format not in SINKS:
+        raise argparse.ArgumentTypeError(
+            'Unknown sink format: %s (choose from %s)' % (
+                sink_format, ', '.join(sorted(SINKS))))
+    return sink_format, path or '-'
+
+
+def open_sinks(specs):
+    """Open each (format, path) sink, appending to files."""
+    sinks = []
+    for sink_format, path in specs:
+        if path == '-':
+            f = sys.stdout
+        else:
+            f = io.open(path, 'a', encoding='utf-8')
+        sinks.append(SINKS[sink_format](f))
+    return sinks
+
+
+def emit(sinks):
+    """Return a function passing each action to every sink."""
+    def write(action):
+        for sink in sinks:
+            sink.write(action)
+    return write
+
+
+def use_users(users):
+    """Classify users in this process according to a registry's users."""
+    USERS.users = users
+
+
+def render_chunk(work):
+    """Return the actions within a chunk of a log."""
+    chunk, ignore = work
+    skip = event_log.type_filter(ignore)
+    actions = []
+    for line in event_log.read_chunk(*chunk):
+        if skip is not None and skip(line):
+            continue
+        classified = classify(json.loads(line.decode('utf-8')))
+        if classified is not None:
+            actions.append(classified)
+    return actions
+
+
+def render_parallel(paths, jobs, write, ignore=None):
+    """Classify logs across a pool of processes, writing actions in order.
+
+    Each log is split into several chunks per process. Every worker
+    classifies users according to USERS, which should already have caught up
+    with the logs.
+    """
+    work = []
+    for path in paths:
+        work.extend((chunk, ignore)
+                    for chunk in event_log.chunks(path, jobs * 4))
+
+    pool = multiprocessing.Pool(
+        jobs, initializer=use_users, initargs=(USERS.users,))
+    try:
+        for actions in pool.imap(render_chunk, work):
+            for classified in actions:
+                write(classified)
+        pool.close()
+    except BaseException:
+        # Don't wait for the rest of the log to be classified.
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def load_checkpoint(path):
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_checkpoint(path, checkpoint):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(checkpoint, f, sort_keys=True)
+    os.rename(tmp, path)
+
+
+def find_rotated(path, inode):
+    """Return the rotated segment of a log with the given inode, if any."""
+    for candidate in glob.glob(path + '.*'):
+        if os.stat(candidate).st_ino == inode:
+            return candidate
+
+
+def rotated_segments(path, inode):
+    """Return the segments of a log from the one with the given inode on.
+
+    Segments are listed oldest first, as recorded in the log's segments
+    index. Returns None if the segment with the inode can't be found.
+    """
+    segments = []
+    segments_path = path + '.segments'
+    if os.path.exists(segments_path):
+        directory = os.path.dirname(path)
+        with open(segments_path) as f:
+            for line in f:
+                segment = os.path.join(
+                    directory, json.loads(line)['path'])
+                if os.path.exists(segment):
+                    segments.append(segment)
+    for i, segment in enumerate(segments):
+        if os.stat(segment).st_ino == inode:
+            return segments[i:]
+
+    # Rotated by something other than gerrit-logger.
+    rotated = find_rotated(path, inode)
+    if rotated is not None:
+        return [rotated]
+    return None
+
+
+def render_from(path, offset, write, ignore=None):
+    """Classify the complete lines of a log from an offset.
+
+    Returns the offset just past the last line classified.
+    """
+    skip = event_log.type_filter(ignore)
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        for line in f:
+            if not line.endswith(b'\n'):
+                # Leave a partially written event for next time.
+                break
+            offset += len(line)
+            if skip is not None and skip(line):
                 continue
-            code_review = 0
-            verified = 0
-            workflow = 0
-            for approval in event.get('approvals', []):
-                if approval['type'] == 'Workflow':
-                    workflow = int(approval['value'])
-                elif approval['type'] == 'Verified':
-                    verified = int(approval['value'])
-                elif approval['type'] == 'Code-Review':
-                    code_review = int(approval['value'])
-
-            if workflow >= 1:
-                pretty_print(event, '%s approved %s' % (
-                    name(event['author']),
-                    review(event['change'])))
-            elif workflow <= -1:
-                pretty_print(event, '%s WIP\'d %s' % (
-                    name(event['author']),
-                    review(event['change'])))
-            elif code_review != 0:
-                pretty_print(event, '%s %s%d\'d %s' % (
-                    name(event['author']),
-                    '+' if code_review >= 1 else '',
-                    code_review,
-                    review(event['change']))),
-            elif verified != 0:
-                BOTS.add(event['author']['username'])
-                pretty_print(event, '%s tested %s (%s%d)' % (
-                    name(event['author']),
-                    review(event['change']),
-                    '+' if verified >= 1 else '',
-                    verified))
-            else:
-                pretty_print(event, '%s commented on %s' % (
-                    name(event['author']),
-                    review(event['change'])))
-        elif event['type'] == 'reviewer-added':
-            # I think this is review request spam; ignore?
-            pass
-        elif event['type'] == 'topic-changed':
-            # A bug was added to the commit message, etc; ignore?
-            pass
-        elif event['type'] == 'ref-updated':
-            # I think this is a change rebased by gerrit; ignore?
-            pass
-        elif event['type'] == 'merge-failed':
-            # Non-human event; ignore?
-            pass
-        elif event['type'] == 'ref-replicated':
-            # Non-human event; ignore?
-            pass
-        elif event['type'] == 'ref-replication-done':
-            # Non-human event; ignore?
-            pass
+            classified = classify(json.loads(line.decode('utf-8')))
+            if classified is not None:
+                write(classified)
+    return offset
+
+
+def render_incremental(path, checkpoint_path, write, ignore=None):
+    """Render only the events appended to a log since the last checkpoint.
+
+    The checkpoint records how far into the log we got, the identity of the
+    log and a fingerprint of what was read from it. If the log has since been
+    rotated, the remainder of the rotated segment and any segments rotated
+    after it are rendered before starting on the new log from the beginning;
+    if it has been truncated, it is rendered from the beginning.
+    """
+    checkpoint = load_checkpoint(checkpoint_path)
+    stat = os.stat(path)
+    offset = 0
+    if checkpoint is not None:
+        # Checkpoints used to hold the bots, before there was a registry.
+        for username in checkpoint.get('bots', ()):
+            USERS.add_bot(username)
+        if checkpoint['inode'] == stat.st_ino:
+            offset = event_log.resume_offset(
+                path, checkpoint['inode'], checkpoint['offset'],
+                checkpoint.get('digest'))
         else:
-            raise SystemExit(json.dumps(event, indent=2))
+            segments = rotated_segments(path, checkpoint['inode'])
+            if segments is None:
+                sys.stderr.write(
+                    'Warning: %s has been rotated, and the segment last '
+                    'rendered from is gone; anything logged to it after the '
+                    'checkpoint, and in any segments since, is skipped.\n'
+                    % path)
+                segments = []
+            for i, segment in enumerate(segments):
+                start = 0
+                if i == 0:
+                    start = event_log.resume_offset(
+                        segment, checkpoint['inode'], checkpoint['offset'],
+                        checkpoint.get('digest'))
+                USERS.catch_up(segment)
+                render_from(segment, start, write, ignore)
+
+    USERS.catch_up(path)
+    offset = render_from(path, offset, write, ignore)
+    save_checkpoint(checkpoint_path, {
+        'inode': stat.st_ino,
+        'offset': offset,
+        'digest': event_log.fingerprint(path, offset),
+    })
+
+
+def render_to(parser, args, write, ignore):
+    """Pass the actions in the logs named by args to write."""
+    if args.incremental:
+        if len(args.files) != 1 or args.files == ['-']:
+            parser.error('--incremental requires exactly one log file.')
+        path = args.files[0]
+        if event_store.is_store(path) or event_archive.is_archive(path):
+            parser.error('--incremental requires a JSON lines log.')
+        render_incremental(
+            path, args.checkpoint or path + '.checkpoint', write, ignore)
+        return
+
+    if not args.files or '-' in args.files:
+        if event_log.has_filters(args):
+            parser.error('Filtering events requires log files.')
+        skip = event_log.type_filter(ignore)
+        for line in fileinput.input(args.files, mode='rb'):
+            if skip is not None and skip(line):
+                continue
+            # There's no history to learn users from, so learn as we go.
+            event = json.loads(line.decode('utf-8'))
+            USERS.update(event)
+            classified = classify(event)
+            if classified is not None:
+                write(classified)
+        return
+
+    # Learn every bot up front, so users are classified the same way
+    # throughout the logs, and in any order. Only the bots matter unless the
+    # registry is being kept.
+    for path in args.files:
+        USERS.catch_up(path, args.jobs, bots_only=not args.users)
+
+    # Changes' states are kept by this process, so can't be updated by a pool.
+    if (args.jobs > 1 and not event_log.has_filters(args) and
+            CHANGES is None and
+            not any(event_store.is_store(path) or
+                    event_archive.is_archive(path) for path in args.files)):
+        render_parallel(args.files, args.jobs, write, ignore)
+        return
+
+    for path in args.files:
+        for event in event_log.iter_events(
+                path, since=args.since, until=args.until,
+                project=args.project, change=args.change, ignore=ignore,
+                jobs=args.jobs):
+            classified = classify(event)
+            if classified is not None:
+                write(classified)
+
+
+def main():
+    global CHANGES, USERS
+
+    parser = argparse.ArgumentParser(
+        description='Render a log of Gerrit events as markdown.')
+    parser.add_argument(
+        'files', nargs='*',
+        help='Event logs to render (default: stdin).')
+    parser.add_argument(
+        '--jobs', dest='jobs', type=int,
+        default=1,
+        help='Render log files in parallel across this many processes (0 '
+             'to use every CPU).')
+    parser.add_argument(
+        '--incremental', dest='incremental', action='store_true',
+        help='Only render events logged since the last incremental run, '
+             'resuming from a checkpoint.')
+    parser.add_argument(
+        '--checkpoint', dest='checkpoint',
+        help='Checkpoint file for --incremental (default: the log file with '
+             'a .checkpoint suffix).')
+    parser.add_argument(
+        '--output', dest='output',
+        help='Append markdown to this file rather than printing it.')
+    parser.add_argument(
+        '--sink', dest='sinks', action='append', type=parse_sink,
+        metavar='FORMAT[:PATH]',
+        help='Write events in this format (%s) to a file, or to stdout if no '
+             'path is given. Repeat to write several formats from one pass '
+             'over the log (default: markdown).' % ', '.join(sorted(SINKS)))
+    parser.add_argument(
+        '--change-state', dest='change_state',
+        help='Keep the state of each change up to date in this file, as '
+             'events are rendered (see change_state.py).')
+    parser.add_argument(
+        '--users', dest='users',
+        help='Keep a registry of users and bots in this file, rather than '
+             'learning them from the whole of each log every time (default '
+             'with --incremental: the log file with a .users suffix; see '
+             'user_registry.py).')
+    event_log.add_filter_arguments(parser)
+    args = parser.parse_args()
+
+    if args.incremental and not args.users and len(args.files) == 1:
+        args.users = args.files[0] + '.users'
+    if args.users:
+        USERS = user_registry.UserRegistry.load(args.users)
+    if args.change_state:
+        CHANGES = change_state.ChangeTable.load(args.change_state)
+    if args.jobs == 0:
+        args.jobs = multiprocessing.cpu_count()
+    ignore = event_log.ignored_types(args)
+
+    specs = args.sinks or []
+    if args.output or not specs:
+        specs.append(('markdown', args.output or '-'))
+    sinks = open_sinks(specs)
+    try:
+        render_to(parser, args, emit(sinks), ignore)
+    except UnknownEventType as e:
+        raise SystemExit(str(e))
+    finally:
+        for sink in sinks:
+            sink.close()
+    if CHANGES is not None:
+        CHANGES.save(args.change_state)
+    if args.users:
+        USERS.save(args.users)
 
 
 if __name__ == '__main__':
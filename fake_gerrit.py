@@ -0,0 +1,448 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+"""Synthetic Gerrit events, and a local SSH server streaming them.
+
+These stand in for a real Gerrit when benchmarking, so that no network access
+is required.
+"""
+
+import argparse
+import json
+import random
+import socket
+import sys
+import threading
+import time
+
+import paramiko
+
+
+# The relative frequency of each type of event, roughly as seen on
+# review.openstack.org.
+DEFAULT_MIX = {
+    'comment-added': 40,
+    'ref-replicated': 15,
+    'patchset-created': 10,
+    'ref-updated': 10,
+    'reviewer-added': 10,
+    'ref-replication-done': 5,
+    'change-merged': 3,
+    'change-abandoned': 2,
+    'change-restored': 1,
+    'topic-changed': 1,
+    'merge-failed': 1,
+}
+
+# The share of comments which are CI votes.
+BOT_COMMENTS = 0.4
+
+PATCH_SET_KINDS = ('REWORK', 'REWORK', 'REWORK', 'TRIVIAL_REBASE',
+                   'NO_CODE_CHANGE', 'NO_CHANGE')
+
+
+def parse_mix(value):
+    """Parse a type mix such as ``comment-added=40,ref-updated=10``."""
+    mix = dict()
+    for item in value.split(','):
+        event_type, _, weight = item.partition('=')
+        mix[event_type.strip()] = float(weight or 1)
+    return mix
+
+
+class EventGenerator(object):
+    """Generate realistic ``stream-events`` events.
+
+    Events are about a pool of ``changes`` changes, spread across
+    ``projects`` projects, with ``users`` people and ``bots`` CI systems
+    taking part.
+    """
+
+    def __init__(self, projects=100, users=1000, bots=20, changes=5000,
+                 mix=None, seed=None):
+        self.random = random.Random(seed)
+        self.projects = ['openstack/project-%d' % i for i in range(projects)]
+        self.users = [{
+            'name': 'User %d' % i,
+            'email': 'user%d@example.com' % i,
+            'username': 'user%d' % i,
+        } for i in range(users)]
+        self.bots = [{
+            'name': 'Bot %d CI' % i,
+            'email': 'bot%d@example.com' % i,
+            'username': 'bot%d' % i,
+        } for i in range(bots)]
+
+        mix = mix or DEFAULT_MIX
+        self.types = list(mix)
+        self.cumulative_weights = []
+        total = 0
+        for event_type in self.types:
+            total += mix[event_type]
+            self.cumulative_weights.append(total)
+
+        self.next_number = 100000
+        self.changes = [self._new_change() for _ in range(changes)]
+
+    def _user(self):
+        return self.random.choice(self.users)
+
+    def _revision(self):
+        return '%040x' % self.random.getrandbits(160)
+
+    def _new_change(self):
+        number = self.next_number
+        self.next_number += 1
+        project = self.random.choice(self.projects)
+        change_id = 'I%040x' % self.random.getrandbits(160)
+        subject = 'Fix issue %d in %s' % (number, project.split('/')[-1])
+        bug = self.random.randint(1000000, 1600000)
+        owner = self._user()
+        return {
+            'change': {
+                'project': project,
+                'branch': self.random.choice(
+                    ('master', 'master', 'master', 'stable/mitaka')),
+                'id': change_id,
+                'number': str(number),
+                'subject': subject,
+                'owner': owner,
+                'url': 'https://review.openstack.org/%d' % number,
+                'commitMessage': '%s\n\n%s\n\n%s-Bug: #%d\nChange-Id: %s\n' % (
+                    subject,
+                    'A longer description of the change.\n' * 3,
+                    self.random.choice(('Closes', 'Partial', 'Related')),
+                    bug, change_id),
+                'status': 'NEW',
+            },
+            'patchSet': self._patch_set(number, 1, owner),
+        }
+
+    def _patch_set(self, change_number, number, uploader):
+        return {
+            'number': str(number),
+            'revision': self._revision(),
+            'parents': [self._revision()],
+            'ref': 'refs/changes/%02d/%d/%d' % (
+                change_number % 100, change_number, number),
+            'uploader': uploader,
+            'createdOn': int(time.time()),
+            'author': uploader,
+            'kind': 'REWORK' if number == 1 else self.random.choice(
+                PATCH_SET_KINDS),
+            'sizeInsertions': self.random.randint(1, 500),
+            'sizeDeletions': -self.random.randint(0, 200),
+        }
+
+    def _type(self):
+        x = self.random.uniform(0, self.cumulative_weights[-1])
+        for event_type, weight in zip(self.types, self.cumulative_weights):
+            if x <= weight:
+                return event_type
+        return self.types[-1]
+
+    def event(self):
+        """Return a new event."""
+        event_type = self._type()
+        i = self.random.randrange(len(self.changes))
+        state = self.changes[i]
+        change = state['change']
+        patch_set = state['patchSet']
+        event = {'type': event_type}
+
+        if event_type == 'comment-added':
+            if self.random.random() < BOT_COMMENTS:
+                author = self.random.choice(self.bots)
+                vote = self.random.choice(('1', '1', '1', '-1'))
+                approvals = [{'type': 'Verified', 'description': 'Verified',
+                              'value': vote}]
+                comment = 'Patch Set %s: Verified%s\n\nBuild %s.' % (
+                    patch_set['number'], '+1' if vote == '1' else '-1',
+                    'succeeded' if vote == '1' else 'failed')
+            else:
+                author = self._user()
+                vote = self.random.choice(('0', '0', '1', '1', '-1', '2'))
+                approvals = [{'type': 'Code-Review',
+                              'description': 'Code-Review', 'value': vote}]
+                if vote == '2' and self.random.random() < 0.5:
+                    approvals.append({'type': 'Workflow',
+                                      'description': 'Workflow',
+                                      'value': '1'})
+                comment = 'Patch Set %s:%s\n\nLooks reasonable.' % (
+                    patch_set['number'],
+                    ' Code-Review%s' % vote if vote != '0' else '')
+            event.update({
+                'author': author,
+                'approvals': approvals,
+                'comment': comment,
+                'change': change,
+                'patchSet': patch_set,
+            })
+        elif event_type == 'patchset-created':
+            uploader = self._user()
+            patch_set = self._patch_set(
+                int(change['number']), int(patch_set['number']) + 1,
+                uploader)
+            state['patchSet'] = patch_set
+            event.update({
+                'uploader': uploader,
+                'change': change,
+                'patchSet': patch_set,
+            })
+        elif event_type == 'reviewer-added':
+            event.update({
+                'reviewer': self._user(),
+                'change': change,
+                'patchSet': patch_set,
+            })
+        elif event_type == 'change-merged':
+            change['status'] = 'MERGED'
+            event.update({
+                'submitter': self._user(),
+                'newRev': self._revision(),
+                'change': change,
+                'patchSet': patch_set,
+            })
+            # Move on to a new change.
+            self.changes[i] = self._new_change()
+        elif event_type == 'change-abandoned':
+            change['status'] = 'ABANDONED'
+            event.update({
+                'abandoner': change['owner'],
+                'reason': 'No longer needed.',
+                'change': change,
+                'patchSet': patch_set,
+            })
+        elif event_type == 'change-restored':
+            change['status'] = 'NEW'
+            event.update({
+                'restorer': change['owner'],
+                'reason': 'Still needed.',
+                'change': change,
+                'patchSet': patch_set,
+            })
+        elif event_type == 'topic-changed':
+            event.update({
+                'changer': change['owner'],
+                'oldTopic': '',
+                'change': change,
+            })
+        elif event_type == 'merge-failed':
+            event.update({
+                'submitter': self._user(),
+                'reason': 'Merge conflict.',
+                'change': change,
+                'patchSet': patch_set,
+            })
+        elif event_type == 'ref-updated':
+            event.update({
+                'submitter': self._user(),
+                'refUpdate': {
+                    'oldRev': self._revision(),
+                    'newRev': self._revision(),
+                    'refName': 'refs/heads/%s' % change['branch'],
+                    'project': change['project'],
+                },
+            })
+        elif event_type in ('ref-replicated', 'ref-replication-done'):
+            event.update({
+                'project': change['project'],
+                'ref': patch_set['ref'],
+                'nodesCount': 1,
+            })
+            if event_type == 'ref-replicated':
+                event.update({
+                    'targetNode': 'git@git%d.openstack.org' % (
+                        self.random.randint(1, 8)),
+                    'status': 'succeeded',
+                })
+        else:
+            raise ValueError('Unsupported event type: %s' % event_type)
+
+        event['eventCreatedOn'] = int(time.time())
+        return event
+
+    def events(self, count=None, rate=None):
+        """Yield count events (or forever), optionally paced to a rate/s."""
+        started = time.time()
+        n = 0
+        while count is None or n < count:
+            if rate:
+                wait = started + n / float(rate) - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+            yield self.event()
+            n += 1
+
+    def lines(self, count=None, rate=None):
+        """Yield events serialized as Gerrit sends them."""
+        for event in self.events(count, rate):
+            yield (json.dumps(event, separators=(',', ':')) +
+                   '\n').encode('utf-8')
+
+
+class _GerritInterface(paramiko.ServerInterface):
+    """Accept anyone, and nothing but ``gerrit stream-events``."""
+
+    def __init__(self):
+        self.streaming = threading.Event()
+
+    def get_allowed_auths(self, username):
+        return 'none,password,publickey'
+
+    def check_auth_none(self, username):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        if command in (b'gerrit stream-events', 'gerrit stream-events'):
+            self.streaming.set()
+            return True
+        return False
+
+
+class FakeGerritServer(object):
+    """A local SSH server which answers ``gerrit stream-events``.
+
+    ``source`` is called once per session, and should return an iterable of
+    event lines (as bytes) to stream; the session is closed once it is
+    exhausted. Lines are sent in batches of up to ``batch`` lines at a time,
+    and ``sent`` is called with the time and number of lines of each batch
+    just before it is sent.
+    """
+
+    def __init__(self, source, host='127.0.0.1', port=0, batch=1,
+                 sent=None):
+        self.source = source
+        self.batch = batch
+        self.sent = sent
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen(5)
+        self.host, self.port = self.sock.getsockname()[:2]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def serve_forever(self):
+        while True:
+            try:
+                client, address = self.sock.accept()
+            except (socket.error, OSError):
+                return
+            thread = threading.Thread(target=self._session, args=(client,))
+            thread.daemon = True
+            thread.start()
+
+    def _session(self, client):
+        transport = paramiko.Transport(client)
+        transport.add_server_key(self.host_key)
+        interface = _GerritInterface()
+        try:
+            transport.start_server(server=interface)
+            channel = transport.accept(30)
+            if channel is None or not interface.streaming.wait(30):
+                return
+            batch = []
+            for line in self.source():
+                batch.append(line)
+                if len(batch) >= self.batch:
+                    self._send(channel, batch)
+                    batch = []
+            if batch:
+                self._send(channel, batch)
+            channel.send_exit_status(0)
+            channel.close()
+            # Leave the client to hang up once it has read everything, as
+            # closing the transport under it would lose the last events.
+            deadline = time.time() + 30
+            while transport.is_active() and time.time() < deadline:
+                time.sleep(0.1)
+        except (EOFError, socket.error, paramiko.SSHException):
+            pass
+        finally:
+            transport.close()
+
+    def _send(self, channel, batch):
+        if self.sent is not None:
+            self.sent(time.time(), len(batch))
+        channel.sendall(b''.join(batch))
+
+    def close(self):
+        self.sock.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Generate synthetic Gerrit events, or serve them over '
+                    'SSH as gerrit stream-events.')
+    parser.add_argument(
+        '--events', type=int,
+        help='Number of events to generate (default: forever).')
+    parser.add_argument(
+        '--rate', type=float,
+        help='Events per second (default: as fast as possible).')
+    parser.add_argument(
+        '--mix', type=parse_mix,
+        help='Relative frequency of event types, such as '
+             'comment-added=40,ref-updated=10.')
+    parser.add_argument(
+        '--projects', type=int, default=100,
+        help='Number of distinct projects.')
+    parser.add_argument(
+        '--users', type=int, default=1000,
+        help='Number of distinct users.')
+    parser.add_argument(
+        '--seed', type=int,
+        help='Random seed, for repeatable output.')
+    parser.add_argument(
+        '--serve', action='store_true',
+        help='Serve events over SSH rather than printing them.')
+    parser.add_argument(
+        '--port', type=int, default=29418,
+        help='Port to serve SSH on.')
+    args = parser.parse_args()
+
+    def source():
+        generator = EventGenerator(
+            projects=args.projects, users=args.users, mix=args.mix,
+            seed=args.seed)
+        return generator.lines(args.events, args.rate)
+
+    if args.serve:
+        server = FakeGerritServer(source, port=args.port)
+        print('Serving gerrit stream-events on %s:%d' % (
+            server.host, server.port))
+        server.serve_forever()
+    else:
+        out = getattr(sys.stdout, 'buffer', sys.stdout)
+        for line in source():
+            out.write(line)
+
+
+if __name__ == '__main__':
+    main()
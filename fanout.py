@@ -0,0 +1,231 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+"""Republish the logger's events to local subscribers over a Unix socket.
+
+A subscriber connects to the socket and sends a single line of JSON, such as
+``{"types": ["comment-added"], "projects": ["openstack/nova"]}`` (or ``{}``
+for every event), then reads events as JSON lines, exactly as they're logged.
+Each subscriber has a bounded buffer, so a slow one loses events rather than
+holding up the logger.
+"""
+
+import argparse
+import collections
+import json
+import os
+import socket
+import stat
+import sys
+import threading
+
+import event_index
+import event_log
+
+
+# Seconds a subscriber has to send its subscription once connected.
+HANDSHAKE_TIMEOUT = 10
+
+DROP_POLICIES = ('oldest', 'newest')
+
+
+class Subscriber(object):
+    """A connected subscriber, with its filters and buffer of lines."""
+
+    def __init__(self, sock, types=None, projects=None, maxsize=10000,
+                 drop='oldest'):
+        self.sock = sock
+        self.types = frozenset(types) if types else None
+        self.projects = frozenset(projects) if projects else None
+        self.maxsize = maxsize
+        self.drop = drop
+        self.dropped = 0
+        self.lines = collections.deque()
+        self.condition = threading.Condition()
+        self.closed = False
+
+    def wants(self, event):
+        if self.types is not None and event['type'] not in self.types:
+            return False
+        if (self.projects is not None and
+                event_index.event_project(event) not in self.projects):
+            return False
+        return True
+
+    def put(self, line):
+        """Buffer a line for sending, dropping one if the buffer is full."""
+        with self.condition:
+            if len(self.lines) >= self.maxsize:
+                self.dropped += 1
+                if self.drop == 'newest':
+                    return
+                self.lines.popleft()
+            self.lines.append(line)
+            self.condition.notify()
+
+    def run(self):
+        """Send buffered lines until the subscriber goes away."""
+        while True:
+            with self.condition:
+                while not self.lines and not self.closed:
+                    self.condition.wait()
+                if self.closed:
+                    return
+                batch = b''.join(self.lines)
+                self.lines.clear()
+            try:
+                self.sock.sendall(batch)
+            except (socket.error, OSError):
+                self.close()
+                return
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        try:
+            self.sock.close()
+        except (socket.error, OSError):
+            pass
+
+
+class FanoutServer(object):
+    """Accept subscribers on a Unix socket, and publish events to them.
+
+    publish() only appends to the buffers of interested subscribers; each
+    subscriber is sent its events by a thread of its own. When a buffer
+    holds ``maxsize`` lines, the ``drop`` policy decides whether the oldest
+    line or the newest is lost.
+    """
+
+    def __init__(self, path, maxsize=10000, drop='oldest'):
+        self.path = path
+        self.maxsize = maxsize
+        self.drop = drop
+        self.lock = threading.Lock()
+        # Replaced rather than modified, so publish() needn't take the lock.
+        self.subscribers = ()
+        self.departed_dropped = 0
+
+        if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+            # Left behind by a previous run.
+            os.unlink(path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen(16)
+
+    def start(self):
+        thread = threading.Thread(target=self._accept, name='fanout')
+        thread.daemon = True
+        thread.start()
+        return self
+
+    @property
+    def dropped(self):
+        """The number of lines dropped for slow subscribers so far."""
+        return self.departed_dropped + sum(
+            s.dropped for s in self.subscribers)
+
+    def _accept(self):
+        while True:
+            try:
+                sock, address = self.sock.accept()
+            except (socket.error, OSError):
+                return
+            thread = threading.Thread(
+                target=self._serve, args=(sock,), name='fanout-subscriber')
+            thread.daemon = True
+            thread.start()
+
+    def _serve(self, sock):
+        try:
+            sock.settimeout(HANDSHAKE_TIMEOUT)
+            f = sock.makefile('rb')
+            subscription = json.loads(f.readline().decode('utf-8') or '{}')
+            f.close()
+            sock.settimeout(None)
+        except (socket.error, OSError, ValueError):
+            sock.close()
+            return
+
+        subscriber = Subscriber(
+            sock, subscription.get('types'), subscription.get('projects'),
+            self.maxsize, self.drop)
+        with self.lock:
+            self.subscribers += (subscriber,)
+        try:
+            subscriber.run()
+        finally:
+            with self.lock:
+                self.subscribers = tuple(
+                    s for s in self.subscribers if s is not subscriber)
+                self.departed_dropped += subscriber.dropped
+
+    def publish(self, event):
+        """Pass an event to every subscriber interested in it."""
+        line = None
+        for subscriber in self.subscribers:
+            if subscriber.wants(event):
+                if line is None:
+                    line = event_log.encode_event(event)
+                subscriber.put(line)
+
+    def close(self):
+        self.sock.close()
+        for subscriber in self.subscribers:
+            subscriber.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+def subscribe(path, types=None, projects=None):
+    """Yield each event line published on a fan-out socket, as bytes."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(path)
+    subscription = {}
+    if types:
+        subscription['types'] = list(types)
+    if projects:
+        subscription['projects'] = list(projects)
+    sock.sendall(json.dumps(subscription).encode('utf-8') + b'\n')
+    f = sock.makefile('rb')
+    try:
+        for line in f:
+            yield line
+    finally:
+        f.close()
+        sock.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Print the events republished by gerrit-logger '
+                    '--fanout-socket, as JSON lines.')
+    parser.add_argument(
+        'socket',
+        help='Fan-out socket to subscribe to.')
+    parser.add_argument(
+        '--type', dest='types', action='append',
+        help='Only receive events of this type. Repeat for several.')
+    parser.add_argument(
+        '--project', dest='projects', action='append',
+        help='Only receive events for this project. Repeat for several.')
+    args = parser.parse_args()
+
+    out = getattr(sys.stdout, 'buffer', sys.stdout)
+    for line in subscribe(args.socket, args.types, args.projects):
+        out.write(line)
+        out.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,260 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+"""Look up what changes mean to us with ``gerrit query``.
+
+Lookups of changes requested close together are batched into one query, and
+results are cached in memory, in front of an optional dogpile.cache region
+shared between processes. Once a change has been resolved, lookups of it
+never wait on Gerrit again: stale results are returned while they're
+refreshed in the background. Failed lookups are remembered for a few seconds
+too, so a broken server isn't asked again for every event.
+"""
+
+import collections
+import json
+import threading
+import time
+import traceback
+
+
+QUERY_BATCH = 50
+QUERY_WINDOW = 0.05
+LRU_SIZE = 10000
+QUERY_TIMEOUT = 15
+FAILURE_TTL = 5
+
+
+def query_lines(client, query, timeout=QUERY_TIMEOUT):
+    """Yield each change returned by a gerrit query, as a dict.
+
+    Raises socket.timeout if Gerrit goes quiet for timeout seconds.
+    """
+    stdin, stdout, stderr = client.exec_command(
+        'gerrit query --format=JSON %s' % query, timeout=timeout)
+    for line in stdout:
+        row = json.loads(line)
+        if row.get('type') == 'stats' or 'number' not in row:
+            continue
+        yield row
+
+
+def query_changes(client, username, numbers, timeout=QUERY_TIMEOUT):
+    """Return the metadata of each of several changes, by change number.
+
+    Each change's metadata says who owns and reviews it, whether username is
+    its owner or one of its reviewers, and whether username has starred it.
+    """
+    changes = ' OR '.join('change:%s' % number for number in numbers)
+    metadata = dict(
+        (str(number), {'owner': None, 'reviewers': [], 'reviewing': False,
+                       'starred': False})
+        for number in numbers)
+    for row in query_lines(
+            client, '--all-reviewers (%s)' % changes, timeout):
+        owner = row.get('owner', {}).get('username')
+        reviewers = [r.get('username') for r in row.get('allReviewers', [])]
+        metadata[str(row['number'])] = {
+            'owner': owner,
+            'reviewers': reviewers,
+            'reviewing': username == owner or username in reviewers,
+            'starred': False,
+        }
+    for row in query_lines(client, 'is:starred (%s)' % changes, timeout):
+        metadata[str(row['number'])]['starred'] = True
+    return metadata
+
+
+class LRU(object):
+    """A bounded mapping, evicting the least recently used keys."""
+
+    def __init__(self, size=LRU_SIZE):
+        self.size = size
+        self.items = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.items.pop(key, None)
+            if value is not None:
+                self.items[key] = value
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = value
+            if len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+
+class Flight(object):
+    """A lookup in progress, which any number of callers may wait on."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+
+
+class ChangeLookup(object):
+    """Cached, batched lookups of change metadata on one Gerrit server.
+
+    ``connect`` returns a connected SSH client, and ``username`` is the user
+    it authenticates as. It's called from a background thread, so mustn't
+    prompt for anything. Results are kept for ``ttl`` seconds in an LRU of
+    ``size`` changes, and in ``cache`` (a dogpile.cache region), if given.
+    A change whose lookup failed isn't looked up again for ``retry`` seconds,
+    and lookups of it return what's cached, if anything, without waiting.
+    Concurrent lookups of the same change share one query, and changes
+    requested within ``window`` seconds of each other are queried together,
+    up to ``batch`` at a time.
+    """
+
+    def __init__(self, connect, username, cache=None, ttl=15, size=LRU_SIZE,
+                 batch=QUERY_BATCH, window=QUERY_WINDOW, metrics=None,
+                 prefix='', retry=FAILURE_TTL, timeout=QUERY_TIMEOUT):
+        self.connect = connect
+        self.username = username
+        self.cache = cache
+        self.ttl = ttl
+        self.retry = retry
+        self.timeout = timeout
+        self.lru = LRU(size)
+        self.failures = LRU(size)
+        self.batch = batch
+        self.window = window
+        self.metrics = metrics
+        self.prefix = prefix
+        self.client = None
+
+        self.condition = threading.Condition()
+        self.pending = []
+        self.flights = {}
+        thread = threading.Thread(target=self._run, name='gerrit-query')
+        thread.daemon = True
+        thread.start()
+
+    def _count(self, tier):
+        if self.metrics is not None:
+            self.metrics.inc('lookups_total', tier=tier)
+
+    def _request(self, number):
+        """Return the flight looking a change up, starting one if needed."""
+        with self.condition:
+            flight = self.flights.get(number)
+            if flight is None:
+                flight = self.flights[number] = Flight()
+                self.pending.append(number)
+                self.condition.notify()
+            return flight
+
+    def _cached(self, number):
+        """Return a change's cached (metadata, fetched_at), if any."""
+        entry = self.lru.get(number)
+        if entry is not None:
+            self._count('lru')
+            return entry
+        if self.cache is not None:
+            # Imported here, as only callers with a cache need dogpile.
+            from dogpile.cache.api import NO_VALUE
+
+            entry = self.cache.get(self.prefix + number)
+            if entry is not NO_VALUE:
+                self._count('cache')
+                self.lru.put(number, entry)
+                return entry
+        return None
+
+    def _due(self, number, entry):
+        """Return True if a change, cached as entry, should be looked up."""
+        failed_at = self.failures.get(number)
+        if failed_at is not None and time.time() - failed_at <= self.retry:
+            return False
+        return entry is None or time.time() - entry[1] > self.ttl
+
+    def prefetch(self, number):
+        """Start looking a change up, if it isn't cached, without waiting."""
+        number = str(number)
+        if self._due(number, self._cached(number)):
+            self._request(number)
+
+    def get(self, number, timeout=QUERY_TIMEOUT):
+        """Return a change's metadata, or None if it couldn't be looked up.
+
+        Only waits on Gerrit if the change has never been resolved, and
+        hasn't just failed to be.
+        """
+        number = str(number)
+        entry = self._cached(number)
+        due = self._due(number, entry)
+        if entry is not None:
+            if due:
+                self._request(number)
+            return entry[0]
+        if not due:
+            return None
+
+        self._count('miss')
+        flight = self._request(number)
+        flight.done.wait(timeout)
+        return flight.value
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+            # Give other lookups a moment to join the batch.
+            time.sleep(self.window)
+            with self.condition:
+                numbers = self.pending[:self.batch]
+                del self.pending[:self.batch]
+
+            try:
+                results = self._query(numbers)
+            except (Exception, SystemExit):
+                # Including authentication failures, which mustn't stop
+                # this thread: waiting lookups are resolved with no result.
+                traceback.print_exc()
+                results = {}
+            fetched_at = time.time()
+
+            for number in numbers:
+                metadata = results.get(number)
+                if metadata is not None:
+                    entry = (metadata, fetched_at)
+                    self.lru.put(number, entry)
+                    if self.cache is not None:
+                        self.cache.set(self.prefix + number, entry)
+                else:
+                    self.failures.put(number, fetched_at)
+                with self.condition:
+                    flight = self.flights.pop(number)
+                flight.value = metadata
+                flight.done.set()
+
+    def _query(self, numbers):
+        if self.client is None:
+            self.client = self.connect()
+        start = time.time()
+        try:
+            return query_changes(
+                self.client, self.username, numbers, self.timeout)
+        except (Exception, SystemExit):
+            # Reconnect for the next batch.
+            self.client.close()
+            self.client = None
+            raise
+        finally:
+            if self.metrics is not None:
+                self.metrics.inc('queries_total')
+                self.metrics.inc('query_seconds_total', time.time() - start)
@@ -0,0 +1,182 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+"""Cheap, always-on instrumentation, exposed in Prometheus text format."""
+
+import bisect
+import collections
+import contextlib
+import os
+import threading
+import time
+
+try:
+    from http import server as http_server
+except ImportError:
+    import BaseHTTPServer as http_server
+
+
+PREFIX = 'gerrit_logger_'
+
+# Buckets for the lag between Gerrit creating an event and us receiving it.
+# eventCreatedOn only has a resolution of one second.
+LAG_BUCKETS = (0.5, 1, 2, 5, 10, 30, 60, 300, 900)
+
+
+def _key(name, labels):
+    return name, tuple(sorted(
+        (k, v) for k, v in labels.items() if v is not None))
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+        for k, v in labels)
+
+
+class Histogram(object):
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics(object):
+    """Counters, gauges and histograms, safe to update from any thread."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = collections.defaultdict(float)
+        self.gauges = dict()
+        self.gauge_callbacks = dict()
+        self.histograms = dict()
+
+    def inc(self, name, value=1, **labels):
+        key = _key(name, labels)
+        with self.lock:
+            self.counters[key] += value
+
+    def set(self, name, value, **labels):
+        key = _key(name, labels)
+        with self.lock:
+            self.gauges[key] = value
+
+    def register_gauge(self, name, callback):
+        """Report the value returned by callback whenever metrics are read."""
+        self.gauge_callbacks[(name, ())] = callback
+
+    def observe(self, name, value, buckets=LAG_BUCKETS):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram(buckets)
+            histogram.observe(value)
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        """Count the calls to, and seconds spent in, a stage of ingest."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            labels = (('stage', stage),)
+            with self.lock:
+                self.counters[('stage_seconds_total', labels)] += elapsed
+                self.counters[('stage_calls_total', labels)] += 1
+
+    def render(self):
+        """Return every metric in Prometheus text format."""
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            gauges = dict(self.gauges)
+            histograms = sorted(
+                (name, list(h.buckets), list(h.counts), h.sum, h.count)
+                for name, h in self.histograms.items())
+        for key, callback in self.gauge_callbacks.items():
+            gauges[key] = callback()
+
+        declared = set()
+        for kind, items in (('counter', counters),
+                            ('gauge', sorted(gauges.items()))):
+            for (name, labels), value in items:
+                if name not in declared:
+                    lines.append('# TYPE %s%s %s' % (PREFIX, name, kind))
+                    declared.add(name)
+                lines.append('%s%s%s %r' % (
+                    PREFIX, name, _labels(labels), float(value)))
+
+        for name, buckets, counts, total, count in histograms:
+            lines.append('# TYPE %s%s histogram' % (PREFIX, name))
+            cumulative = 0
+            for bound, n in zip(buckets + ['+Inf'], counts):
+                cumulative += n
+                lines.append('%s%s_bucket{le="%s"} %d' % (
+                    PREFIX, name, bound, cumulative))
+            lines.append('%s%s_sum %r' % (PREFIX, name, total))
+            lines.append('%s%s_count %d' % (PREFIX, name, count))
+        return '\n'.join(lines) + '\n'
+
+
+def serve(port, routes, host='127.0.0.1'):
+    """Serve routes over HTTP from a background thread.
+
+    routes maps each path to a callable returning a content type and a body.
+    """
+    class Handler(http_server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            route = routes.get(self.path.split('?', 1)[0])
+            if route is None:
+                self.send_error(404)
+                return
+            content_type, body = route()
+            body = body.encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http_server.HTTPServer((host, port), Handler)
+    thread = threading.Thread(target=server.serve_forever, name='http')
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def write_periodically(path, render, interval):
+    """Rewrite a file with the output of render every interval seconds."""
+    def run():
+        while True:
+            time.sleep(interval)
+            tmp = path + '.tmp'
+            with open(tmp, 'w') as f:
+                f.write(render())
+            os.rename(tmp, path)
+
+    thread = threading.Thread(target=run, name='stats-file')
+    thread.daemon = True
+    thread.start()
+    return thread
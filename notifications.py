@@ -0,0 +1,146 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+import heapq
+import threading
+import time
+import traceback
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+class RateLimiter(object):
+    """A token bucket allowing ``rate`` acquisitions per second on average.
+
+    Up to ``burst`` acquisitions may happen back to back.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a token is available, then take it."""
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(
+                    self.burst,
+                    self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def coalesce_key(event):
+    """Return the key under which bursts of events are coalesced."""
+    if 'change' in event:
+        return (event.get('origin'), event['change'].get('number'))
+    # Anything not about a change is delivered on its own.
+    return id(event)
+
+
+class NotificationPipeline(object):
+    """Deliver notifications from worker threads, off the ingest path.
+
+    Events submitted for the same change within ``window`` seconds of the
+    first are coalesced, and delivered to ``sink`` together as a list. Batches
+    are handed to ``workers`` threads through a bounded queue, and delivery is
+    limited to ``rate`` batches per second overall. submit() never blocks:
+    when too many batches are waiting, new ones are dropped and counted
+    instead. If given, ``accept(event)`` is called by the workers to decide
+    which events in a batch to deliver, so it may take its time.
+    """
+
+    def __init__(self, sink, workers=2, window=2.0, rate=1.0, burst=5,
+                 maxsize=1000, accept=None):
+        self.sink = sink
+        self.accept = accept
+        self.window = window
+        self.maxsize = maxsize
+        self.limiter = RateLimiter(rate, burst)
+        self.dropped = 0
+
+        self.pending = {}
+        self.deadlines = []
+        self.condition = threading.Condition()
+        self.batches = queue.Queue(maxsize)
+
+        threads = [threading.Thread(
+            target=self._dispatch, name='notify-dispatch')]
+        for i in range(workers):
+            threads.append(threading.Thread(
+                target=self._work, name='notify-%d' % i))
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+    def submit(self, event):
+        """Queue an event for notification.
+
+        Returns False if the event was dropped.
+        """
+        key = coalesce_key(event)
+        with self.condition:
+            batch = self.pending.get(key)
+            if batch is not None:
+                batch.append(event)
+                return True
+            if len(self.pending) >= self.maxsize:
+                self.dropped += 1
+                return False
+            self.pending[key] = [event]
+            heapq.heappush(self.deadlines, (time.time() + self.window, key))
+            self.condition.notify()
+        return True
+
+    def _dispatch(self):
+        """Move each batch onto the work queue once its window closes."""
+        while True:
+            with self.condition:
+                while True:
+                    if not self.deadlines:
+                        self.condition.wait()
+                        continue
+                    wait = self.deadlines[0][0] - time.time()
+                    if wait <= 0:
+                        break
+                    self.condition.wait(wait)
+                deadline, key = heapq.heappop(self.deadlines)
+                batch = self.pending.pop(key)
+
+            try:
+                self.batches.put_nowait(batch)
+            except queue.Full:
+                with self.condition:
+                    self.dropped += len(batch)
+
+    def _work(self):
+        while True:
+            batch = self.batches.get()
+            try:
+                if self.accept is not None:
+                    batch = [event for event in batch if self.accept(event)]
+                if batch:
+                    self.limiter.acquire()
+                    self.sink(batch)
+            except Exception:
+                traceback.print_exc()
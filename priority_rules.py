@@ -0,0 +1,186 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+"""Declarative rules deciding which events are worth a notification.
+
+A rule file is a JSON list of rules, and an event is a priority if it matches
+any of them. Each rule is a JSON object, and an event matches it if it
+satisfies every condition the rule sets:
+
+- ``projects``: the change's project is one of these.
+- ``branches``: the change's branch is one of these.
+- ``owners``: the change is owned by one of these usernames.
+- ``reviewers``: the comment's author, or the added reviewer, is one of these
+  usernames.
+- ``types``: the event type is one of these.
+- ``approvals``: every threshold, such as ``"Code-Review <= -1"``, is met by a
+  vote on the event.
+- ``starred``: whether you have starred the change.
+- ``reviewing``: whether you own, or are a reviewer of, the change.
+
+The last two are looked up in Gerrit, so they're only checked once an event
+has met a rule's other conditions.
+
+For example::
+
+    [
+        {"projects": ["openstack/keystone"],
+         "approvals": ["Code-Review <= -1"]},
+        {"owners": ["dolph"], "types": ["comment-added", "change-merged"]}
+    ]
+"""
+
+import json
+import operator
+import re
+
+
+OPERATORS = {
+    '<=': operator.le,
+    '>=': operator.ge,
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '>': operator.gt,
+}
+
+THRESHOLD_RE = re.compile(r'^\s*([\w-]+)\s*(<=|>=|==|!=|<|>)\s*([+-]?\d+)\s*$')
+
+CONDITIONS = frozenset([
+    'projects', 'branches', 'owners', 'reviewers', 'types', 'approvals',
+    'starred', 'reviewing'])
+
+# Conditions which need a change's metadata to be looked up.
+LOOKUP_CONDITIONS = frozenset(['starred', 'reviewing'])
+
+
+def event_reviewer(event):
+    """Return the username of whoever reviewed, or was asked to review."""
+    reviewer = event.get('author') or event.get('reviewer') or {}
+    return reviewer.get('username')
+
+
+def compile_threshold(threshold):
+    """Return a predicate checking an event's votes against a threshold."""
+    match = THRESHOLD_RE.match(threshold)
+    if match is None:
+        raise ValueError('Invalid approval threshold: %s' % threshold)
+    label, op, value = match.groups()
+    op = OPERATORS[op]
+    value = int(value)
+
+    def check(event):
+        for approval in event.get('approvals', ()):
+            if approval['type'] == label and op(int(approval['value']), value):
+                return True
+        return False
+    return check
+
+
+def compile_lookup(condition, expected, lookup):
+    """Return a predicate checking a change's metadata, from lookup."""
+    def check(event):
+        metadata = lookup(event)
+        return metadata is not None and metadata[condition] == expected
+    return check
+
+
+def compile_rule(rule, lookup=None):
+    """Return a predicate for every condition of a rule except its projects.
+
+    lookup returns the metadata of an event's change, for conditions which
+    need it.
+    """
+    unknown = set(rule) - CONDITIONS
+    if unknown:
+        raise ValueError('Unknown rule conditions: %s' % ', '.join(
+            sorted(unknown)))
+    if lookup is None and LOOKUP_CONDITIONS.intersection(rule):
+        raise ValueError('Rule conditions need lookups: %s' % ', '.join(
+            sorted(LOOKUP_CONDITIONS.intersection(rule))))
+
+    checks = []
+    if 'types' in rule:
+        types = frozenset(rule['types'])
+        checks.append(lambda event: event['type'] in types)
+    if 'branches' in rule:
+        branches = frozenset(rule['branches'])
+        checks.append(
+            lambda event: event['change'].get('branch') in branches)
+    if 'owners' in rule:
+        owners = frozenset(rule['owners'])
+        checks.append(
+            lambda event: event['change'].get(
+                'owner', {}).get('username') in owners)
+    if 'reviewers' in rule:
+        reviewers = frozenset(rule['reviewers'])
+        checks.append(lambda event: event_reviewer(event) in reviewers)
+    for threshold in rule.get('approvals', ()):
+        checks.append(compile_threshold(threshold))
+    # Checked last, so that lookups are only made for otherwise matching
+    # events.
+    for condition in sorted(LOOKUP_CONDITIONS.intersection(rule)):
+        checks.append(
+            compile_lookup(condition, bool(rule[condition]), lookup))
+
+    if not checks:
+        return lambda event: True
+    if len(checks) == 1:
+        return checks[0]
+
+    def predicate(event):
+        for check in checks:
+            if not check(event):
+                return False
+        return True
+    return predicate
+
+
+class Rules(object):
+    """A compiled set of rules.
+
+    Rules are indexed by project, so only the rules for an event's project
+    (and those for any project) are evaluated against it. ``needs_lookup`` is
+    True if any rule has conditions which are looked up.
+    """
+
+    def __init__(self, rules, lookup=None):
+        self.by_project = dict()
+        self.any_project = []
+        self.needs_lookup = False
+        for rule in rules:
+            if LOOKUP_CONDITIONS.intersection(rule):
+                self.needs_lookup = True
+            predicate = compile_rule(
+                dict((k, v) for k, v in rule.items() if k != 'projects'),
+                lookup)
+            if 'projects' in rule:
+                for project in rule['projects']:
+                    self.by_project.setdefault(project, []).append(predicate)
+            else:
+                self.any_project.append(predicate)
+
+    @classmethod
+    def load(cls, path, lookup=None):
+        with open(path) as f:
+            return cls(json.load(f), lookup)
+
+    def match(self, event):
+        """Return True if a change event matches any rule."""
+        for predicate in self.by_project.get(event['change'].get('project'),
+                                             ()):
+            if predicate(event):
+                return True
+        for predicate in self.any_project:
+            if predicate(event):
+                return True
+        return False
@@ -10,11 +10,20 @@ setuptools.setup(
     url='http://github.com/dolph/gerrit-logger',
     scripts=['event_logger.py', 'events_in_english.py'],
     install_requires=['paramiko', 'dogpile.cache'],
-    py_modules=['gerrit_growler'],
+    py_modules=['gerrit_growler', 'activity', 'change_state', 'event_archive',
+                'event_index', 'event_log', 'event_store', 'fake_gerrit',
+                'fanout', 'gerrit_query', 'metrics', 'notifications',
+                'priority_rules', 'user_registry'],
     entry_points={
         'console_scripts': [
             'gerrit-logger = event_logger:main',
-            'gerrit-events-in-english = events_in_english:main']},
+            'gerrit-events-in-english = events_in_english:main',
+            'gerrit-index-events = event_index:main',
+            'gerrit-event-store = event_store:main',
+            'gerrit-archive-events = event_archive:main',
+            'gerrit-subscribe = fanout:main',
+            'gerrit-change-state = change_state:main',
+            'gerrit-user-registry = user_registry:main']},
     classifiers=[
         'Development Status :: 5 - Production/Stable',
         'Environment :: Console',
@@ -10,121 +10,211 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import argparse
 import json
-import re
+import multiprocessing
 
-
-BUG_PATTERN = '([Rr]elated|[Pp]artial|[Cc]loses)-[Bb]ug[:]?[\s]?[#]?([0-9]+)'
-BUG_RE = re.compile(BUG_PATTERN, re.MULTILINE)
+import change_state
+import event_log
 
 
 def debug(d):
     print(json.dumps(d, indent=4, sort_keys=True))
 
 
-EVENTS = []
-with open('bugsmash/events') as f:
-    for line in f.readlines():
-        EVENTS.append(json.loads(line))
-
-USERS = []
-with open('bugsmash/validated-ids') as f:
-    for line in f.readlines():
-        USERS.append(line.strip())
-
-STATS = {
-    'participants': set(),
-    'new-patches': 0,
-    'new-patches-total': 0,
-    'approved-patches': set(),
-    'code-reviews': 0,
-    'revised-patches': 0,
-    'revised-patches-total': 0,
-    'patches-merged-total': 0,
-    'impacted-bugs': set(),
-    'fixed-bugs': set(),
-    'contributors-registered': set(USERS),
-}
-
-for event in EVENTS:
-    # We don't care about these events for summary purposes.
-    if event['type'] in (
-            'change-abandoned',
-            'change-restored',
-            'ref-replicated',
-            'ref-replication-done',
-            'ref-updated',
-            'reviewer-added',
-            'topic-changed'):
-        continue
-
-    bugs = BUG_RE.findall(event['change']['commitMessage'])
-
-    if event['type'] == 'patchset-created':
-        if event['patchSet']['kind'] in (
-                'NO_CHANGE',
-                'NO_CODE_CHANGE',
-                'TRIVIAL_REBASE'):
-            continue
-
-        if event['patchSet']['kind'] == 'REWORK':
-            if event['patchSet']['uploader']['username'] in USERS:
-                STATS['participants'].add(
-                    event['patchSet']['uploader']['username'])
+IGNORED_TYPES = event_log.IGNORED_TYPES | frozenset([
+    'change-abandoned',
+    'change-restored',
+])
+
+
+def load_users(path):
+    with open(path) as f:
+        return frozenset(line.strip() for line in f)
+
+
+class Summary(object):
+    """Participation statistics accumulated one event at a time.
+
+    Summaries of different parts of a log (or of different logs) can be
+    combined with merge(), so they can be computed in parallel.
+    """
+
+    def __init__(self, users):
+        self.users = frozenset(users)
+        self.bugs = change_state.BugCache()
+        self.stats = {
+            'participants': set(),
+            'new-patches': 0,
+            'new-patches-total': 0,
+            'approved-patches': set(),
+            'code-reviews': 0,
+            'revised-patches': 0,
+            'revised-patches-total': 0,
+            'patches-merged-total': 0,
+            'impacted-bugs': set(),
+            'fixed-bugs': set(),
+        }
+
+    def add(self, event):
+        users = self.users
+        stats = self.stats
+
+        # We don't care about these events for summary purposes.
+        if event['type'] in IGNORED_TYPES:
+            return
+
+        bugs = self.bugs.bugs(event)
+
+        if event['type'] == 'patchset-created':
+            if event['patchSet']['kind'] in (
+                    'NO_CHANGE',
+                    'NO_CODE_CHANGE',
+                    'TRIVIAL_REBASE'):
+                return
+
+            if event['patchSet']['kind'] != 'REWORK':
+                debug(event)
+                raise ValueError('Unexpected patch set kind: %s' % (
+                    event['patchSet']['kind']))
+
+            uploader = event['patchSet']['uploader']['username']
+            if uploader in users:
+                stats['participants'].add(uploader)
                 for impact, bug_number in bugs:
-                    STATS['impacted-bugs'].add(int(bug_number))
+                    stats['impacted-bugs'].add(int(bug_number))
 
             if int(event['patchSet']['number']) == 1:
-                STATS['new-patches-total'] += 1
-                if event['patchSet']['uploader']['username'] in USERS:
-                    STATS['new-patches'] += 1
+                stats['new-patches-total'] += 1
+                if uploader in users:
+                    stats['new-patches'] += 1
             else:
-                STATS['revised-patches-total'] += 1
-                if event['patchSet']['uploader']['username'] in USERS:
-                    STATS['revised-patches'] += 1
+                stats['revised-patches-total'] += 1
+                if uploader in users:
+                    stats['revised-patches'] += 1
+        elif event['type'] == 'comment-added':
+            if event['author'].get('username') in users:
+                stats['code-reviews'] += 1
+                stats['participants'].add(event['author']['username'])
+                for impact, bug_number in bugs:
+                    stats['impacted-bugs'].add(int(bug_number))
+                for approval in event.get('approvals', []):
+                    if (approval['type'] == 'Workflow' and
+                            approval['value'] == '1'):
+                        stats['approved-patches'].add(
+                            event['change']['number'])
+                        break
+        elif event['type'] == 'change-merged':
+            stats['patches-merged-total'] += 1
+            if (event['patchSet']['author']['username'] in users or
+                    event['patchSet']['uploader']['username'] in users or
+                    event['change']['owner'].get('username') in users):
+                for impact, bug_number in bugs:
+                    stats['impacted-bugs'].add(int(bug_number))
+                    if impact.lower() in ('closes', 'partial'):
+                        stats['fixed-bugs'].add(int(bug_number))
         else:
             debug(event)
-            raise SystemExit()
-    elif event['type'] == 'comment-added':
-        if event['author'].get('username') in USERS:
-            STATS['code-reviews'] += 1
-            STATS['participants'].add(event['author']['username'])
-            for impact, bug_number in bugs:
-                STATS['impacted-bugs'].add(int(bug_number))
-            for approval in event.get('approvals', []):
-                if approval['type'] == 'Workflow' and approval['value'] == '1':
-                    STATS['approved-patches'].add(event['change']['number'])
-                    break
-    elif event['type'] == 'change-merged':
-        STATS['patches-merged-total'] += 1
-        if (event['patchSet']['author']['username'] in USERS or
-                event['patchSet']['uploader']['username'] in USERS or
-                event['change']['owner'] in USERS):
-            for impact, bug_number in bugs:
-                for impact, bug_number in bugs:
-                    STATS['impacted-bugs'].add(int(bug_number))
-                if impact.lower() in ('closes', 'partial'):
-                    STATS['fixed-bugs'].add(int(bug_number))
+            raise ValueError('Unexpected event type: %s' % event['type'])
+
+    def update(self, events):
+        for event in events:
+            self.add(event)
+        return self
+
+    def merge(self, stats):
+        """Fold the statistics of another summary into this one."""
+        for key, value in stats.items():
+            if isinstance(value, set):
+                self.stats[key].update(value)
+            else:
+                self.stats[key] += value
+        return self
+
+    def report(self):
+        """Return the statistics as a dict of counts."""
+        report = dict(
+            (key, len(value) if isinstance(value, set) else value)
+            for key, value in self.stats.items())
+        report['contributors-registered'] = len(self.users)
+        return report
+
+
+USERS = frozenset()
+
+
+def init_worker(users):
+    global USERS
+    USERS = users
+
+
+def summarize(work):
+    """Summarize a single event log, in a worker process."""
+    path, filters = work
+    return Summary(USERS).update(event_log.iter_events(path, **filters)).stats
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Summarize the participation of registered contributors '
+                    'in logs of Gerrit events.')
+    parser.add_argument(
+        'events', nargs='*',
+        default=['bugsmash/events'],
+        help='Event logs to summarize, such as rotated segments.')
+    parser.add_argument(
+        '--users', dest='users',
+        default='bugsmash/validated-ids',
+        help='File listing the registered contributors, one per line.')
+    parser.add_argument(
+        '--jobs', dest='jobs', type=int,
+        default=1,
+        help='Summarize event logs in parallel across this many processes '
+             '(0 to use every CPU).')
+    event_log.add_filter_arguments(parser)
+    args = parser.parse_args()
+
+    users = load_users(args.users)
+    filters = {
+        'since': args.since,
+        'until': args.until,
+        'project': args.project,
+        'change': args.change,
+        'ignore': event_log.ignored_types(args, IGNORED_TYPES),
+    }
+
+    summary = Summary(users)
+    jobs = args.jobs or multiprocessing.cpu_count()
+    if jobs > 1 and len(args.events) > 1:
+        pool = multiprocessing.Pool(
+            jobs, initializer=init_worker, initargs=(users,))
+        try:
+            work = [(path, filters) for path in args.events]
+            for partial in pool.imap_unordered(summarize, work):
+                summary.merge(partial)
+        finally:
+            pool.close()
+            pool.join()
     else:
-        debug(event)
-        raise Exception(event)
-
-STATS['impacted-bugs'] = len(STATS['impacted-bugs'])
-STATS['approved-patches'] = len(STATS['approved-patches'])
-STATS['fixed-bugs'] = len(STATS['fixed-bugs'])
-STATS['participants'] = len(STATS['participants'])
-STATS['contributors-registered'] = len(STATS['contributors-registered'])
-debug(STATS)
-print(
-    'Of %d contributors that were tracked, %d participated in gerrit '
-    '(%.0f%%). Those %d participants did %d code reviews, authored patches to '
-    'fix %d bugs, and impacted %d bugs in total.' % (
-        STATS['contributors-registered'],
-        STATS['participants'],
-        100.0 * STATS['participants'] / STATS['contributors-registered'],
-        STATS['participants'],
-        STATS['code-reviews'],
-        STATS['fixed-bugs'],
-        STATS['impacted-bugs'],
+        for path in args.events:
+            summary.update(event_log.iter_events(path, jobs=jobs, **filters))
+
+    stats = summary.report()
+    debug(stats)
+    print(
+        'Of %d contributors that were tracked, %d participated in gerrit '
+        '(%.0f%%). Those %d participants did %d code reviews, authored '
+        'patches to fix %d bugs, and impacted %d bugs in total.' % (
+            stats['contributors-registered'],
+            stats['participants'],
+            100.0 * stats['participants'] / stats['contributors-registered'],
+            stats['participants'],
+            stats['code-reviews'],
+            stats['fixed-bugs'],
+            stats['impacted-bugs'],
+        )
     )
-)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+import unittest
+
+import activity
+
+
+def comment(when, username='jane', votes=(), project='p'):
+    return {
+        'type': 'comment-added',
+        'received_at': when,
+        'author': {'username': username},
+        'approvals': [{'type': label, 'value': value}
+                      for label, value in votes],
+        'change': {'project': project},
+    }
+
+
+class TestRing(unittest.TestCase):
+    def test_window(self):
+        ring = activity.Ring(size=3, width=10)
+        for when in (0, 5, 10, 25, 29):
+            ring.add('a', when)
+        self.assertEqual({'a': 5}, ring.totals(29))
+        # The first bucket, [0, 10), has left the window.
+        self.assertEqual({'a': 3}, ring.totals(30))
+        self.assertEqual({'a': 2}, ring.totals(49))
+        self.assertEqual({}, ring.totals(50))
+
+    def test_buckets_are_recycled(self):
+        ring = activity.Ring(size=3, width=10)
+        ring.add('a', 0)
+        ring.add('b', 30)
+        self.assertEqual({'b': 1}, ring.totals(30))
+        self.assertEqual(3, len(ring.buckets))
+
+    def test_too_old(self):
+        ring = activity.Ring(size=3, width=10)
+        ring.add('a', 30)
+        # Would land in the same bucket as the event 30s later.
+        ring.add('a', 0)
+        ring.add('a', 20)
+        self.assertEqual({'a': 2}, ring.totals(30))
+
+
+class TestActivity(unittest.TestCase):
+    def test_classify(self):
+        self.assertEqual((['reviews'], 'jane'),
+                         activity.classify(comment(0)))
+        self.assertEqual(
+            (['approvals', 'reviews'], 'jane'),
+            activity.classify(comment(0, votes=[('Workflow', '1')])))
+        self.assertEqual(
+            (['ci-votes'], 'zuul'),
+            activity.classify(comment(0, 'zuul', [('Verified', '-1')])))
+        self.assertEqual(
+            (['merges'], 'joe'),
+            activity.classify({'type': 'change-merged',
+                               'submitter': {'username': 'joe'}}))
+        self.assertEqual(([], None),
+                         activity.classify({'type': 'ref-updated'}))
+
+    def test_snapshot(self):
+        windows = activity.Activity(
+            windows=(('minute', 6, 10), ('hour', 60, 60)))
+        windows.add(comment(3600, votes=[('Workflow', '1')]))
+        windows.add(comment(3700, 'zuul', [('Verified', '1')], project='q'))
+        windows.add({'type': 'ref-updated'})
+        snapshot = windows.snapshot(now=3700)
+        self.assertEqual(
+            {'projects': {'q': {'ci-votes': 1}},
+             'reviewers': {'zuul': {'ci-votes': 1}}},
+            snapshot['minute'])
+        self.assertEqual(
+            {'p': {'reviews': 1, 'approvals': 1}, 'q': {'ci-votes': 1}},
+            snapshot['hour']['projects'])
+        self.assertEqual(3700, snapshot['generated_at'])
+
+
+if __name__ == '__main__':
+    unittest.main()
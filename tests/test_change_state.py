@@ -0,0 +1,150 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import change_state
+import event_log
+import event_store
+
+
+def comment(value, when, patch_set=1, username='reviewer'):
+    return {
+        'type': 'comment-added',
+        'eventCreatedOn': when,
+        'author': {'username': username},
+        'approvals': [{'type': 'Code-Review', 'value': value}],
+        'change': {'number': 1, 'project': 'p', 'status': 'NEW',
+                   'commitMessage': 'Fix it\n\nCloses-Bug: #123'},
+        'patchSet': {'number': patch_set, 'revision': 'r%d' % patch_set},
+    }
+
+
+class TestChangeTable(unittest.TestCase):
+    def test_votes(self):
+        table = change_state.ChangeTable()
+        table.update(comment('-1', 10))
+        table.update(comment('2', 20))
+        self.assertEqual({'Code-Review': {'reviewer': 2}},
+                         table.get(1)['votes'])
+        self.assertEqual([('Closes', 123)], table.get(1)['bugs'])
+
+    def test_replay_is_harmless(self):
+        table = change_state.ChangeTable()
+        table.update(comment('-1', 10))
+        table.update(comment('2', 20))
+        table.update(comment('-1', 10))
+        self.assertEqual({'Code-Review': {'reviewer': 2}},
+                         table.get(1)['votes'])
+
+    def test_new_patch_set_resets_votes(self):
+        table = change_state.ChangeTable()
+        table.update(comment('2', 10))
+        table.update(comment('1', 20, patch_set=2, username='other'))
+        self.assertEqual(2, table.get(1)['patch_set'])
+        self.assertEqual({'Code-Review': {'other': 1}},
+                         table.get(1)['votes'])
+
+    def test_merged(self):
+        table = change_state.ChangeTable()
+        table.update(comment('2', 10))
+        merged = comment('2', 20)
+        merged['type'] = 'change-merged'
+        table.update(merged)
+        self.assertEqual('MERGED', table.get(1)['status'])
+
+
+class TestBugCache(unittest.TestCase):
+    def test_bugs(self):
+        cache = change_state.BugCache(size=2)
+        self.assertEqual([('Closes', 123)], cache.bugs(comment('1', 10)))
+        self.assertEqual([], cache.bugs({'type': 'ref-updated'}))
+        # Parsed once per revision, whatever later events' messages say.
+        event = comment('1', 20)
+        event['change']['commitMessage'] = ''
+        self.assertEqual([('Closes', 123)], cache.bugs(event))
+
+    def test_bounded(self):
+        cache = change_state.BugCache(size=2)
+        for patch_set in range(1, 6):
+            cache.bugs(comment('1', 10, patch_set=patch_set))
+        cache.bugs(comment('1', 10, patch_set=4))
+        cache.bugs(comment('1', 10, patch_set=6))
+        self.assertEqual(['r4', 'r6'], list(cache.revisions))
+
+
+class TestCatchUp(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.state = os.path.join(self.tmp, 'changes.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_log(self):
+        path = os.path.join(self.tmp, 'event.log')
+        with open(path, 'wb') as f:
+            f.write(event_log.encode_event(comment('-1', 10)))
+            f.write(event_log.encode_event(comment('2', 20))[:-5])
+        table = change_state.ChangeTable()
+        table.catch_up(path)
+        table.save(self.state)
+        self.assertEqual({'Code-Review': {'reviewer': -1}},
+                         table.get(1)['votes'])
+
+        with open(path, 'wb') as f:
+            f.write(event_log.encode_event(comment('-1', 10)))
+            f.write(event_log.encode_event(comment('2', 20)))
+        table = change_state.ChangeTable.load(self.state)
+        table.catch_up(path)
+        self.assertEqual({'Code-Review': {'reviewer': 2}},
+                         table.get(1)['votes'])
+
+    def test_log_truncated_in_place(self):
+        path = os.path.join(self.tmp, 'event.log')
+        with open(path, 'wb') as f:
+            f.write(event_log.encode_event(comment('-1', 10)))
+        table = change_state.ChangeTable()
+        table.catch_up(path)
+
+        with open(path, 'wb') as f:
+            f.write(event_log.encode_event(comment('2', 20, username='a')))
+            f.write(event_log.encode_event(comment('1', 30, username='b')))
+        table.catch_up(path)
+        self.assertEqual({'reviewer': -1, 'a': 2, 'b': 1},
+                         table.get(1)['votes']['Code-Review'])
+
+    def test_store(self):
+        path = os.path.join(self.tmp, 'event.store')
+        writer = event_store.EventStoreWriter(path)
+        writer.write(comment('-1', 10))
+        writer.close()
+        table = change_state.ChangeTable()
+        table.catch_up(path)
+        self.assertEqual((-1, 1), (
+            table.get(1)['votes']['Code-Review']['reviewer'],
+            table.logs[os.path.abspath(path)][3]))
+
+        writer = event_store.EventStoreWriter(path)
+        writer.write(comment('2', 20))
+        writer.close()
+        table.catch_up(path)
+        table.catch_up(path)
+        self.assertEqual(2, table.get(1)['votes']['Code-Review']['reviewer'])
+        self.assertEqual(2, table.logs[os.path.abspath(path)][3])
+
+
+if __name__ == '__main__':
+    unittest.main()
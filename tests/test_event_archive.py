@@ -0,0 +1,76 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import event_archive
+import event_log
+import fake_gerrit
+
+
+class TestEventArchive(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.events = list(fake_gerrit.EventGenerator(seed=3).events(1000))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write_log(self, name, events):
+        path = os.path.join(self.tmp, name)
+        with open(path, 'wb') as f:
+            for event in events:
+                f.write(event_log.encode_event(event))
+        return path
+
+    def test_round_trip(self):
+        source = self.write_log('event.log', self.events)
+        path = os.path.join(self.tmp, 'event.archive')
+        event_archive.archive([source], path, block_bytes=4096)
+        self.assertTrue(event_archive.is_archive(path))
+        self.assertTrue(len(event_archive.read_index(path)) > 1)
+        self.assertEqual(self.events, list(event_log.iter_events(path)))
+        self.assertEqual(
+            self.events, list(event_archive.read_archive(path, jobs=2)))
+
+    def test_filters(self):
+        for i, event in enumerate(self.events):
+            event['received_at'] = float(i)
+        source = self.write_log('event.log', self.events)
+        path = os.path.join(self.tmp, 'event.archive')
+        event_archive.archive([source], path, block_bytes=4096)
+        events = list(event_archive.read_archive(path, since=100, until=199))
+        self.assertEqual(self.events[100:200], events)
+
+    def test_failure_leaves_nothing(self):
+        source = self.write_log('event.log', self.events)
+        first = os.path.join(self.tmp, 'first.archive')
+        event_archive.archive([source], first)
+        path = os.path.join(self.tmp, 'event.archive')
+        self.assertRaises(
+            ValueError, event_archive.archive, [source, first], path)
+        self.assertEqual(
+            ['event.log', 'first.archive'], sorted(os.listdir(self.tmp)))
+
+    def test_destination_is_a_source(self):
+        source = self.write_log('event.log', self.events)
+        size = os.path.getsize(source)
+        self.assertRaises(
+            ValueError, event_archive.archive, [source], source)
+        self.assertEqual(size, os.path.getsize(source))
+
+
+if __name__ == '__main__':
+    unittest.main()
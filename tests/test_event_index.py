@@ -0,0 +1,85 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import event_index
+import event_log
+import fake_gerrit
+
+
+class TestEventIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'event.log')
+        self.events = list(fake_gerrit.EventGenerator(
+            projects=5, changes=50, seed=5).events(2000))
+        for i, event in enumerate(self.events):
+            event['received_at'] = 1000000000.0 + i * 60
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def append(self, events):
+        with open(self.path, 'ab') as f:
+            for event in events:
+                f.write(event_log.encode_event(event))
+
+    def expected(self, **filters):
+        return [event for event in self.events
+                if event_index.matches(event, **filters)]
+
+    def assertQueries(self):
+        project = event_index.event_project(self.events[0])
+        change = event_index.event_change(self.events[0])
+        since = self.events[500]['received_at']
+        until = self.events[1500]['received_at']
+        for filters in ({'project': project},
+                        {'change': change},
+                        {'project': project, 'since': since, 'until': until},
+                        {'since': since}):
+            self.assertEqual(self.expected(**filters),
+                             list(event_index.query(self.path, **filters)))
+
+    def test_query(self):
+        self.append(self.events)
+        self.assertQueries()
+        # And again, from the saved index.
+        self.assertQueries()
+
+    def test_update(self):
+        self.append(self.events[:700])
+        event_index.EventIndex.load(self.path)
+        self.append(self.events[700:])
+        self.assertQueries()
+
+    def test_replaced(self):
+        self.append(self.events[:700])
+        event_index.EventIndex.load(self.path)
+        os.remove(self.path)
+        self.append(self.events)
+        self.assertQueries()
+
+    def test_truncated_in_place(self):
+        self.append(self.events[1000:1700])
+        event_index.EventIndex.load(self.path)
+        # Truncated, then grown past the indexed size before the next query.
+        open(self.path, 'wb').close()
+        self.append(self.events)
+        self.assertQueries()
+
+
+if __name__ == '__main__':
+    unittest.main()
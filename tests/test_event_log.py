@@ -0,0 +1,195 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import event_log
+import fake_gerrit
+
+
+class TestTypeFilter(unittest.TestCase):
+    def test_no_types(self):
+        self.assertIsNone(event_log.type_filter(None))
+        self.assertIsNone(event_log.type_filter([]))
+
+    def test_matches_type_only(self):
+        skip = event_log.type_filter(['ref-updated', 'ref-replicated'])
+        self.assertTrue(skip(b'{"type":"ref-updated","refUpdate":{}}'))
+        self.assertTrue(skip(b'{"a":1, "type" : "ref-replicated"}'))
+        self.assertFalse(skip(b'{"type":"ref-replication-done"}'))
+        self.assertFalse(skip(
+            b'{"type":"comment-added","comment":"see ref-updated"}'))
+
+
+class TestRawEvent(unittest.TestCase):
+    def setUp(self):
+        generator = fake_gerrit.EventGenerator(seed=1)
+        self.lines = list(generator.lines(500))
+
+    def test_fields_without_decoding(self):
+        for line in self.lines:
+            expected = json.loads(line.decode('utf-8'))
+            event = event_log.RawEvent(line)
+            self.assertEqual(expected['type'], event['type'])
+            self.assertEqual('change' in expected, 'change' in event)
+            self.assertEqual(
+                expected.get('eventCreatedOn'), event.get('eventCreatedOn'))
+            self.assertNotIn('received_at', event)
+            self.assertIsNone(event._event)
+
+    def test_splice(self):
+        for line in self.lines:
+            expected = json.loads(line.decode('utf-8'))
+            expected['received_at'] = 1234.5
+            expected['origin'] = 'review.example.org'
+            event = event_log.RawEvent(line)
+            event.setdefault('received_at', 1234.5)
+            event['origin'] = 'review.example.org'
+            encoded = event_log.encode_event(event)
+            self.assertIsNone(event._event)
+            self.assertTrue(encoded.endswith(b'}\n'))
+            self.assertEqual(expected, json.loads(encoded.decode('utf-8')))
+
+    def test_existing_field_is_replaced(self):
+        event = event_log.RawEvent(b'{"type":"x","origin":"old"}\n')
+        event['origin'] = 'new'
+        self.assertEqual(
+            {'type': 'x', 'origin': 'new'},
+            json.loads(event.encode().decode('utf-8')))
+
+    def test_decode_hook(self):
+        decoded = []
+
+        def decode(line):
+            decoded.append(line)
+            return json.loads(line.decode('utf-8'))
+
+        event = event_log.RawEvent(b'{"type":"x","change":{"number":1}}',
+                                   decode)
+        event['received_at'] = 1.0
+        self.assertEqual(1, event['change']['number'])
+        self.assertEqual(1.0, event['received_at'])
+        self.assertEqual(1.0, event.event['received_at'])
+        self.assertEqual(1, len(decoded))
+
+
+class TestResumeOffset(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'event.log')
+        self.write(b'{"type":"a"}\n{"type":"b"}\n')
+        self.offset = os.path.getsize(self.path)
+        self.inode = os.stat(self.path).st_ino
+        self.digest = event_log.fingerprint(self.path, self.offset)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, data, mode='wb'):
+        with open(self.path, mode) as f:
+            f.write(data)
+
+    def resume_offset(self, digest=True):
+        return event_log.resume_offset(
+            self.path, self.inode, self.offset,
+            self.digest if digest else None)
+
+    def test_appended(self):
+        self.write(b'{"type":"c"}\n', 'ab')
+        self.assertEqual(self.offset, self.resume_offset())
+        self.assertEqual(self.offset, self.resume_offset(digest=False))
+
+    def test_truncated_and_grown(self):
+        self.write(b'{"type":"replaced"}\n{"type":"c"}\n', 'r+b')
+        self.assertEqual(0, self.resume_offset())
+
+    def test_truncated_mid_line(self):
+        self.write(b'{"type":"c"}\n{"type":"lengthy"}\n', 'r+b')
+        self.assertEqual(0, self.resume_offset(digest=False))
+
+    def test_shrunk(self):
+        self.write(b'{"type":"a"}\n', 'wb')
+        self.assertEqual(0, self.resume_offset())
+
+    def test_replaced(self):
+        os.remove(self.path)
+        self.write(b'{"type":"a"}\n{"type":"b"}\n{"type":"c"}\n')
+        self.inode += 1
+        self.assertEqual(0, self.resume_offset())
+
+    def test_never_read(self):
+        self.assertEqual(
+            0, event_log.resume_offset(self.path, None, 0, None))
+
+
+class TestEventLogWriter(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'event.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_round_trip(self):
+        events = list(fake_gerrit.EventGenerator(seed=2).events(200))
+        writer = event_log.EventLogWriter(self.path, flush_events=0)
+        for event in events:
+            writer.write(event)
+        writer.close()
+        self.assertEqual(events, list(event_log.iter_events(self.path)))
+
+    def test_tick_flushes(self):
+        writer = event_log.EventLogWriter(
+            self.path, flush_events=0, flush_ms=50)
+        writer.write({'type': 'x'})
+        self.assertEqual(0, os.path.getsize(self.path))
+        time.sleep(0.06)
+        writer.tick()
+        self.assertNotEqual(0, os.path.getsize(self.path))
+        writer.close()
+
+    def test_rotate(self):
+        writer = event_log.EventLogWriter(self.path, rotate_bytes=1000)
+        for i in range(100):
+            writer.write({'type': 'x', 'received_at': float(i)})
+        writer.close()
+        with open(self.path + '.segments') as f:
+            segments = [json.loads(line) for line in f]
+        self.assertTrue(segments)
+        count = sum(s['events'] for s in segments)
+        count += len(list(event_log.iter_events(self.path)))
+        self.assertEqual(100, count)
+
+    def test_rotate_reopened(self):
+        writer = event_log.EventLogWriter(self.path)
+        for i in range(10):
+            writer.write({'type': 'x', 'received_at': 100000.0 + i})
+        writer.close()
+        writer = event_log.EventLogWriter(self.path)
+        writer.write({'type': 'x', 'received_at': 100010.0})
+        writer.rotate()
+        writer.close()
+        with open(self.path + '.segments') as f:
+            segment, = [json.loads(line) for line in f]
+        self.assertEqual(11, segment['events'])
+        self.assertEqual(100000.0, segment['first_received_at'])
+        self.assertEqual(100010.0, segment['last_received_at'])
+        self.assertEqual('event.log.19700102T034640', segment['path'])
+
+
+if __name__ == '__main__':
+    unittest.main()
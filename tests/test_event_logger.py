@@ -0,0 +1,105 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+import unittest
+
+import event_log
+import event_logger
+
+
+class LoggerTestCase(unittest.TestCase):
+    def patch(self, name, value, module=event_logger):
+        original = getattr(module, name)
+        setattr(module, name, value)
+        self.addCleanup(setattr, module, name, original)
+
+
+class TestRecentEvents(unittest.TestCase):
+    def test_seen(self):
+        recent = event_logger.RecentEvents(size=2)
+        self.assertFalse(recent.seen('a'))
+        self.assertFalse(recent.seen('b'))
+        self.assertTrue(recent.seen('a'))
+        # b is now the least recently seen, so it's forgotten first.
+        self.assertFalse(recent.seen('c'))
+        self.assertTrue(recent.seen('a'))
+        self.assertFalse(recent.seen('b'))
+
+    def test_replayed_lines_have_the_same_key(self):
+        line = b'{"type":"comment-added","eventCreatedOn":1}'
+        first = event_log.RawEvent(line)
+        first['received_at'] = 1.0
+        self.assertEqual(event_logger.event_key(first),
+                         event_logger.event_key(event_log.RawEvent(line)))
+
+
+class TestFollow(LoggerTestCase):
+    def setUp(self):
+        self.sleeps = []
+        self.patch('sleep', self.sleeps.append, module=event_logger.time)
+        self.patch('uniform', lambda low, high: high,
+                   module=event_logger.random)
+        self.patch('print_exc', lambda: None, module=event_logger.traceback)
+
+    def connections(self, *outcomes):
+        """Stub list_events(), with each connection's events or error."""
+        outcomes = list(outcomes)
+
+        def list_events(host, port, username, password=None, raw=False):
+            outcome = outcomes.pop(0)
+            if isinstance(outcome, BaseException):
+                raise outcome
+            for line in outcome:
+                yield event_log.RawEvent(line)
+            raise IOError('Disconnected')
+
+        self.patch('list_events', list_events)
+
+    def test_backoff(self):
+        self.connections(*([IOError('Refused')] * 12 +
+                           [SystemExit('Revoked')]))
+        event_logger.follow('h', 1, 'u', None)
+        self.assertEqual(
+            [1, 2, 4, 8, 16, 32, 64, 128, 256, 300, 300, 300], self.sleeps)
+
+    def test_events_reset_backoff_and_replays_are_dropped(self):
+        received = []
+        self.connections(
+            IOError('Refused'), IOError('Refused'),
+            [b'{"type":"a"}', b'{"type":"b"}'],
+            [b'{"type":"b"}', b'{"type":"c"}'],
+            SystemExit('Revoked'))
+        event_logger.follow(
+            'h', 1, 'u', lambda host, port, event: received.append(event))
+        self.assertEqual([1, 2, 1, 1], self.sleeps)
+        self.assertEqual(['a', 'b', 'c'], [e['type'] for e in received])
+
+
+class TestStreamEvents(LoggerTestCase):
+    def test_exits_once_every_server_is_lost(self):
+        def list_events(host, port, username, password=None, raw=False):
+            if port == 2:
+                yield event_log.RawEvent(b'{"type":"a"}')
+            raise SystemExit('Failed to authenticate against %s.' % host)
+
+        self.patch('list_events', list_events)
+        received = []
+        with self.assertRaises(SystemExit):
+            for host, port, event in event_logger.stream_events(
+                    [('h', 1), ('h', 2)], 'u'):
+                received.append(event)
+        self.assertEqual(['a'], [e['type'] for e in received])
+        self.assertEqual('h:2', received[0]['origin'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import event_store
+import fake_gerrit
+
+
+class TestEventStore(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.events = list(fake_gerrit.EventGenerator(seed=3).events(1000))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_round_trip(self):
+        path = os.path.join(self.tmp, 'event.store')
+        writer = event_store.EventStoreWriter(path, flush_events=0)
+        for event in self.events:
+            writer.write(event)
+        writer.close()
+        self.assertTrue(event_store.is_store(path))
+        self.assertEqual(self.events, list(event_store.read_store(path)))
+
+    def test_reopen_and_forget(self):
+        path = os.path.join(self.tmp, 'event.store')
+        self.patch_table_size(10)
+        writer = event_store.EventStoreWriter(path, flush_events=0)
+        for event in self.events[:500]:
+            writer.write(event)
+        writer.close()
+        writer = event_store.EventStoreWriter(path, flush_events=0)
+        for event in self.events[500:]:
+            writer.write(event)
+        writer.close()
+        self.assertEqual(self.events, list(event_store.read_store(path)))
+
+    def test_partial_record_is_truncated(self):
+        path = os.path.join(self.tmp, 'event.store')
+        writer = event_store.EventStoreWriter(path)
+        writer.write(self.events[0])
+        writer.close()
+        with open(path, 'ab') as f:
+            f.write(event_store.RECORD.pack(event_store.EVENT, 100) + b'{"')
+        writer = event_store.EventStoreWriter(path)
+        writer.write(self.events[1])
+        writer.close()
+        self.assertEqual(
+            self.events[:2], list(event_store.read_store(path)))
+
+    def test_rotate_reopened(self):
+        path = os.path.join(self.tmp, 'event.store')
+        for i, event in enumerate(self.events):
+            event['received_at'] = 100000.0 + i
+        writer = event_store.EventStoreWriter(path)
+        for event in self.events[:10]:
+            writer.write(event)
+        writer.close()
+        writer = event_store.EventStoreWriter(path)
+        writer.write(self.events[10])
+        writer.rotate()
+        writer.close()
+        with open(path + '.segments') as f:
+            segment, = [json.loads(line) for line in f]
+        self.assertEqual(11, segment['events'])
+        self.assertEqual(100000.0, segment['first_received_at'])
+        self.assertEqual(
+            self.events[:11],
+            list(event_store.read_store(
+                os.path.join(self.tmp, segment['path']))))
+
+    def patch_table_size(self, size):
+        original = event_store.TABLE_SIZE
+        event_store.TABLE_SIZE = size
+        self.addCleanup(setattr, event_store, 'TABLE_SIZE', original)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import event_log
+import events_in_english
+import fake_gerrit
+import user_registry
+
+
+class TestRenderIncremental(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'event.log')
+        self.checkpoint = self.path + '.checkpoint'
+        self.events = list(fake_gerrit.EventGenerator(seed=4).events(3000))
+        for i, event in enumerate(self.events):
+            event['received_at'] = 1000000000.0 + i
+        self.reset_users()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def reset_users(self):
+        events_in_english.USERS = user_registry.UserRegistry()
+
+    def render(self, render):
+        actions = []
+        render(actions.append)
+        return [events_in_english.markdown(action) for action in actions]
+
+    def test_rotated_several_times(self):
+        expected_path = os.path.join(self.tmp, 'all.log')
+        with open(expected_path, 'wb') as f:
+            for event in self.events:
+                f.write(event_log.encode_event(event))
+        expected = self.render(lambda write: events_in_english.render_from(
+            expected_path, 0, write))
+        os.remove(expected_path)
+
+        rendered = []
+        writer = event_log.EventLogWriter(self.path, rotate_bytes=200000)
+        # The first run finds the log before it's rotated.
+        batches = [self.events[:1]] + [
+            self.events[i:i + 1000] for i in range(1, len(self.events), 1000)]
+        for batch in batches:
+            for event in batch:
+                writer.write(event)
+            writer.flush()
+            self.reset_users()
+            rendered.extend(self.render(
+                lambda write: events_in_english.render_incremental(
+                    self.path, self.checkpoint, write)))
+        writer.close()
+
+        with open(self.path + '.segments') as f:
+            # Several rotations between each run.
+            self.assertTrue(len(f.readlines()) > 6)
+        self.assertEqual(expected, rendered)
+
+    def test_truncated_in_place(self):
+        def run():
+            self.reset_users()
+            return self.render(
+                lambda write: events_in_english.render_incremental(
+                    self.path, self.checkpoint, write))
+
+        with open(self.path, 'wb') as f:
+            for event in self.events[:100]:
+                f.write(event_log.encode_event(event))
+        run()
+        size = os.path.getsize(self.path)
+
+        # Truncated, then grown past the checkpoint before the next run.
+        with open(self.path, 'wb') as f:
+            for event in self.events[200:400]:
+                f.write(event_log.encode_event(event))
+        self.assertTrue(os.path.getsize(self.path) > size)
+        expected = self.render(lambda write: events_in_english.render_from(
+            self.path, 0, write))
+        self.assertEqual(expected, run())
+
+
+class TestRenderParallel(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'event.log')
+        with open(self.path, 'wb') as f:
+            for line in fake_gerrit.EventGenerator(seed=5).lines(2000):
+                f.write(line)
+        events_in_english.USERS = user_registry.UserRegistry()
+        events_in_english.USERS.catch_up(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_same_as_serial(self):
+        serial = []
+        events_in_english.render_from(self.path, 0, serial.append)
+        parallel = []
+        events_in_english.render_parallel([self.path], 3, parallel.append)
+        self.assertTrue(serial)
+        self.assertEqual(serial, parallel)
+
+    def test_unknown_event_type(self):
+        # Followed by more of the log, for the other workers to classify.
+        with open(self.path, 'ab') as f:
+            f.write(b'{"type":"wip-state-changed"}\n')
+            f.write(b'{"type":"ref-updated"}\n' * 2000)
+        self.assertRaises(
+            events_in_english.UnknownEventType,
+            events_in_english.render_parallel, [self.path], 3, len)
+
+
+if __name__ == '__main__':
+    unittest.main()
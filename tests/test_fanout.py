@@ -0,0 +1,109 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+import json
+import os
+import shutil
+import socket
+import tempfile
+import time
+import unittest
+
+import fanout
+
+
+def change_event(kind, project):
+    return {'type': kind, 'change': {'number': 1, 'project': project}}
+
+
+class TestSubscriber(unittest.TestCase):
+    def test_wants(self):
+        everything = fanout.Subscriber(None)
+        comments = fanout.Subscriber(None, types=['comment-added'])
+        nova = fanout.Subscriber(
+            None, types=['comment-added'], projects=['nova'])
+        for event, wanted in (
+                (change_event('comment-added', 'nova'), [True, True, True]),
+                (change_event('comment-added', 'glance'),
+                 [True, True, False]),
+                (change_event('change-merged', 'nova'), [True, False, False]),
+                ({'type': 'ref-updated',
+                  'refUpdate': {'project': 'nova'}}, [True, False, False])):
+            self.assertEqual(wanted, [everything.wants(event),
+                                      comments.wants(event),
+                                      nova.wants(event)])
+
+    def test_drop_oldest(self):
+        subscriber = fanout.Subscriber(None, maxsize=2, drop='oldest')
+        for line in (b'1', b'2', b'3'):
+            subscriber.put(line)
+        self.assertEqual([b'2', b'3'], list(subscriber.lines))
+        self.assertEqual(1, subscriber.dropped)
+
+    def test_drop_newest(self):
+        subscriber = fanout.Subscriber(None, maxsize=2, drop='newest')
+        for line in (b'1', b'2', b'3'):
+            subscriber.put(line)
+        self.assertEqual([b'1', b'2'], list(subscriber.lines))
+        self.assertEqual(1, subscriber.dropped)
+
+
+class TestFanoutServer(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'fanout.sock')
+        self.server = fanout.FanoutServer(self.path).start()
+
+    def tearDown(self):
+        self.server.close()
+        shutil.rmtree(self.tmp)
+
+    def connect(self, subscription):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(5)
+        sock.connect(self.path)
+        sock.sendall(json.dumps(subscription).encode('utf-8') + b'\n')
+        self.addCleanup(sock.close)
+        return sock
+
+    def wait_for_subscribers(self, count):
+        deadline = time.time() + 5
+        while len(self.server.subscribers) < count:
+            self.assertTrue(time.time() < deadline)
+            time.sleep(0.01)
+
+    def test_publish(self):
+        everything = self.connect({}).makefile('rb')
+        nova = self.connect({'projects': ['nova']}).makefile('rb')
+        self.wait_for_subscribers(2)
+        events = [change_event('comment-added', 'glance'),
+                  change_event('change-merged', 'nova')]
+        for event in events:
+            self.server.publish(event)
+        self.assertEqual(events, [json.loads(everything.readline().decode(
+            'utf-8')) for event in events])
+        self.assertEqual(events[1], json.loads(nova.readline().decode(
+            'utf-8')))
+
+    def test_departed_subscribers_are_forgotten(self):
+        sock = self.connect({})
+        self.wait_for_subscribers(1)
+        sock.close()
+        deadline = time.time() + 5
+        while self.server.subscribers:
+            self.server.publish(change_event('comment-added', 'nova'))
+            self.assertTrue(time.time() < deadline)
+            time.sleep(0.01)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,156 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+import json
+import re
+import threading
+import time
+import unittest
+
+import gerrit_query
+
+
+class FakeClient(object):
+    """Answers gerrit queries for changes 1-99, which are owned by owner."""
+
+    def __init__(self, gerrit):
+        self.gerrit = gerrit
+
+    def exec_command(self, command, timeout=None):
+        self.gerrit.commands.append((command, timeout))
+        self.gerrit.answer.wait()
+        numbers = [int(n) for n in re.findall(r'change:(\d+)', command)]
+        if 'is:starred' in command:
+            numbers = [n for n in numbers if n in self.gerrit.starred]
+        rows = [{'number': n, 'owner': {'username': 'owner'},
+                 'allReviewers': [{'username': 'reviewer'}]}
+                for n in numbers if n < 100]
+        rows.append({'type': 'stats', 'rowCount': len(rows)})
+        return None, iter([json.dumps(row) + '\n' for row in rows]), None
+
+    def close(self):
+        pass
+
+
+class FakeGerrit(object):
+    def __init__(self, starred=()):
+        self.starred = frozenset(starred)
+        self.commands = []
+        self.connects = 0
+        self.fail = False
+        self.answer = threading.Event()
+        self.answer.set()
+
+    def connect(self):
+        self.connects += 1
+        if self.fail:
+            raise IOError('Connection refused')
+        return FakeClient(self)
+
+    def queries(self):
+        """Return the changes in each batch looked up."""
+        return [sorted(int(n) for n in re.findall(r'change:(\d+)', command))
+                for command, timeout in self.commands
+                if '--all-reviewers' in command]
+
+
+class TestChangeLookup(unittest.TestCase):
+    def setUp(self):
+        self.gerrit = FakeGerrit(starred=[2])
+        original = gerrit_query.traceback.print_exc
+        gerrit_query.traceback.print_exc = lambda: None
+        self.addCleanup(setattr, gerrit_query.traceback, 'print_exc',
+                        original)
+
+    def lookup(self, **kwargs):
+        kwargs.setdefault('window', 0.05)
+        return gerrit_query.ChangeLookup(
+            self.gerrit.connect, 'reviewer', **kwargs)
+
+    def wait_for(self, condition):
+        deadline = time.time() + 5
+        while not condition():
+            self.assertTrue(time.time() < deadline)
+            time.sleep(0.01)
+
+    def test_batching(self):
+        lookup = self.lookup()
+        for number in range(1, 6):
+            lookup.prefetch(number)
+        metadata = [lookup.get(number) for number in range(1, 6)]
+        self.assertEqual([[1, 2, 3, 4, 5]], self.gerrit.queries())
+        self.assertEqual(
+            [False, True, False, False, False],
+            [m['starred'] for m in metadata])
+        self.assertTrue(all(m['reviewing'] for m in metadata))
+
+        lookup = self.lookup(batch=2)
+        for number in range(11, 16):
+            lookup.prefetch(number)
+        lookup.get(15)
+        self.assertEqual([[11, 12], [13, 14], [15]],
+                         self.gerrit.queries()[1:])
+
+    def test_single_flight(self):
+        lookup = self.lookup()
+        self.gerrit.answer.clear()
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(
+            lookup.get(7))) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        self.wait_for(lambda: self.gerrit.commands)
+        self.gerrit.answer.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([[7]], self.gerrit.queries())
+        self.assertEqual(5, len([r for r in results if r is not None]))
+
+    def test_stale_results_are_refreshed_without_waiting(self):
+        lookup = self.lookup(ttl=0.05)
+        first = lookup.get(1)
+        time.sleep(0.1)
+        self.gerrit.answer.clear()
+        start = time.time()
+        self.assertEqual(first, lookup.get(1))
+        self.assertTrue(time.time() - start < 0.05)
+        self.gerrit.answer.set()
+        self.wait_for(lambda: len(self.gerrit.queries()) == 2)
+
+    def test_unknown_change(self):
+        metadata = self.lookup().get(123)
+        self.assertEqual(None, metadata['owner'])
+        self.assertFalse(metadata['reviewing'])
+
+    def test_failures_are_remembered(self):
+        self.gerrit.fail = True
+        lookup = self.lookup(retry=0.2)
+        self.assertIsNone(lookup.get(1))
+        start = time.time()
+        for i in range(10):
+            lookup.prefetch(1)
+            self.assertIsNone(lookup.get(1))
+        self.assertTrue(time.time() - start < 0.05)
+        self.assertEqual(1, self.gerrit.connects)
+
+        time.sleep(0.25)
+        self.gerrit.fail = False
+        self.assertTrue(lookup.get(1)['reviewing'])
+        self.assertEqual(2, self.gerrit.connects)
+
+    def test_timeout(self):
+        self.lookup(timeout=3).get(1)
+        self.assertEqual([3, 3], [t for c, t in self.gerrit.commands])
+
+
+if __name__ == '__main__':
+    unittest.main()
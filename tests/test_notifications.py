@@ -0,0 +1,127 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+import threading
+import time
+import unittest
+
+import notifications
+
+
+def change_event(number, kind='comment-added'):
+    return {'type': kind, 'origin': 'h:1', 'change': {'number': number}}
+
+
+class PipelineTestCase(unittest.TestCase):
+    def pipeline(self, **kwargs):
+        self.delivered = []
+        self.delivery = threading.Event()
+
+        def sink(batch):
+            self.delivered.append(batch)
+            self.delivery.set()
+
+        kwargs.setdefault('window', 0.05)
+        kwargs.setdefault('rate', 1000)
+        return notifications.NotificationPipeline(sink, **kwargs)
+
+    def wait_for(self, count):
+        deadline = time.time() + 5
+        while len(self.delivered) < count:
+            self.assertTrue(time.time() < deadline)
+            self.delivery.wait(0.01)
+
+
+class TestRateLimiter(unittest.TestCase):
+    def test_burst_then_rate(self):
+        limiter = notifications.RateLimiter(rate=20, burst=2)
+        start = time.time()
+        for i in range(2):
+            limiter.acquire()
+        self.assertTrue(time.time() - start < 0.04)
+        for i in range(4):
+            limiter.acquire()
+        self.assertTrue(time.time() - start >= 0.19)
+
+
+class TestCoalescing(PipelineTestCase):
+    def test_bursts_on_a_change(self):
+        pipeline = self.pipeline()
+        for number in (1, 2, 1, 1):
+            self.assertTrue(pipeline.submit(change_event(number)))
+        ref_updated = {'type': 'ref-updated'}
+        pipeline.submit(ref_updated)
+        pipeline.submit(dict(ref_updated))
+        self.wait_for(4)
+        self.assertEqual(
+            [['1', '1', '1'], ['2'], ['ref-updated'], ['ref-updated']],
+            sorted([str(e['change']['number']) if 'change' in e
+                    else e['type'] for e in batch]
+                   for batch in self.delivered))
+
+    def test_origins_are_kept_apart(self):
+        pipeline = self.pipeline()
+        other = change_event(1)
+        other['origin'] = 'h:2'
+        pipeline.submit(change_event(1))
+        pipeline.submit(other)
+        self.wait_for(2)
+        self.assertEqual(2, len(self.delivered))
+
+
+class TestDrops(PipelineTestCase):
+    def test_too_many_pending(self):
+        pipeline = self.pipeline(window=60, maxsize=2)
+        self.assertTrue(pipeline.submit(change_event(1)))
+        self.assertTrue(pipeline.submit(change_event(2)))
+        # Joins a pending batch, so isn't dropped.
+        self.assertTrue(pipeline.submit(change_event(1)))
+        self.assertFalse(pipeline.submit(change_event(3)))
+        self.assertEqual(1, pipeline.dropped)
+
+    def test_queue_full(self):
+        # Without workers, batches wait in the queue until it's full.
+        pipeline = self.pipeline(workers=0, maxsize=1)
+        pipeline.submit(change_event(1))
+        pipeline.submit(change_event(1))
+        self.wait_for_queue(pipeline, 1)
+        pipeline.submit(change_event(2))
+        pipeline.submit(change_event(2))
+        deadline = time.time() + 5
+        while pipeline.dropped < 2:
+            self.assertTrue(time.time() < deadline)
+            time.sleep(0.01)
+        self.assertEqual(2, pipeline.dropped)
+
+    def wait_for_queue(self, pipeline, size):
+        deadline = time.time() + 5
+        while pipeline.batches.qsize() < size:
+            self.assertTrue(time.time() < deadline)
+            time.sleep(0.01)
+
+
+class TestAccept(PipelineTestCase):
+    def test_only_accepted_events_are_delivered(self):
+        pipeline = self.pipeline(
+            accept=lambda event: event['change']['number'] != 2)
+        for number in (1, 2, 1, 2, 3):
+            pipeline.submit(change_event(number))
+        self.wait_for(2)
+        time.sleep(0.1)
+        self.assertEqual(
+            [[1, 1], [3]],
+            sorted([e['change']['number'] for e in batch]
+                   for batch in self.delivered))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+import unittest
+
+import priority_rules
+
+
+def comment(project='nova', votes=(), author='jane', owner='joe',
+            branch='master'):
+    return {
+        'type': 'comment-added',
+        'author': {'username': author},
+        'approvals': [{'type': label, 'value': value}
+                      for label, value in votes],
+        'change': {'number': 1, 'project': project, 'branch': branch,
+                   'owner': {'username': owner}},
+    }
+
+
+class TestThresholds(unittest.TestCase):
+    def test_operators(self):
+        event = comment(votes=[('Code-Review', '-1'), ('Verified', '+1')])
+        for threshold, expected in (
+                ('Code-Review <= -1', True),
+                ('Code-Review<-1', False),
+                ('Code-Review == -1', True),
+                ('Code-Review != -1', False),
+                ('Verified >= +1', True),
+                ('Verified > 1', False),
+                ('Workflow >= 0', False)):
+            check = priority_rules.compile_threshold(threshold)
+            self.assertEqual(expected, check(event), threshold)
+
+    def test_invalid(self):
+        for threshold in ('Code-Review', 'Code-Review =< 1', '<= 1',
+                          'Code-Review <= one'):
+            self.assertRaises(
+                ValueError, priority_rules.compile_threshold, threshold)
+
+
+class TestRules(unittest.TestCase):
+    def test_match(self):
+        rules = priority_rules.Rules([
+            {'projects': ['nova'], 'approvals': ['Code-Review <= -1']},
+            {'owners': ['dolph'], 'types': ['comment-added']},
+            {'reviewers': ['zuul'], 'branches': ['stable']},
+        ])
+        self.assertTrue(rules.match(comment(votes=[('Code-Review', '-2')])))
+        self.assertFalse(rules.match(comment(votes=[('Code-Review', '1')])))
+        self.assertFalse(rules.match(
+            comment('glance', votes=[('Code-Review', '-1')])))
+        self.assertTrue(rules.match(comment('glance', owner='dolph')))
+        self.assertTrue(rules.match(
+            comment('glance', author='zuul', branch='stable')))
+        self.assertFalse(rules.match(comment('glance', author='zuul')))
+        self.assertFalse(rules.needs_lookup)
+
+    def test_empty_rule_matches_everything(self):
+        self.assertTrue(priority_rules.Rules([{}]).match(comment()))
+        self.assertFalse(priority_rules.Rules([]).match(comment()))
+
+    def test_unknown_conditions(self):
+        self.assertRaises(
+            ValueError, priority_rules.Rules, [{'project': ['nova']}])
+
+    def test_lookups(self):
+        self.assertRaises(
+            ValueError, priority_rules.Rules, [{'starred': True}])
+
+        looked_up = []
+
+        def lookup(event):
+            looked_up.append(event['change']['project'])
+            return {'starred': True, 'reviewing': False}
+
+        rules = priority_rules.Rules(
+            [{'projects': ['nova'], 'starred': True},
+             {'types': ['change-merged'], 'reviewing': False}], lookup)
+        self.assertTrue(rules.needs_lookup)
+        self.assertTrue(rules.match(comment('nova')))
+        # Not looked up, as no rule's other conditions match.
+        self.assertFalse(rules.match(comment('glance')))
+        self.assertEqual(['nova'], looked_up)
+
+    def test_failed_lookup(self):
+        rules = priority_rules.Rules(
+            [{'reviewing': False}], lambda event: None)
+        self.assertFalse(rules.match(comment()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+import unittest
+
+import summarize_events
+
+USERS = ['jane', 'joe', 'nobody']
+
+
+def change(number, bug):
+    return {'number': number, 'owner': {'username': 'owner'},
+            'commitMessage': 'Fix it\n\nCloses-Bug: #%d' % bug}
+
+
+def patchset(number, patchset_number, uploader, bug):
+    return {
+        'type': 'patchset-created',
+        'change': change(number, bug),
+        'patchSet': {'number': str(patchset_number), 'kind': 'REWORK',
+                     'revision': '%d-%d' % (number, patchset_number),
+                     'uploader': {'username': uploader}},
+    }
+
+
+def comment(number, author, bug, workflow=False):
+    return {
+        'type': 'comment-added',
+        'change': change(number, bug),
+        'author': {'username': author},
+        'approvals': [{'type': 'Workflow', 'value': '1'}] if workflow else [],
+    }
+
+
+def merged(number, author, bug):
+    return {
+        'type': 'change-merged',
+        'change': change(number, bug),
+        'patchSet': {'author': {'username': author},
+                     'uploader': {'username': author}},
+    }
+
+
+EVENTS = [
+    patchset(1, 1, 'jane', 101),
+    patchset(2, 1, 'stranger', 102),
+    comment(2, 'joe', 102, workflow=True),
+    patchset(1, 2, 'jane', 101),
+    {'type': 'change-abandoned', 'change': change(3, 103)},
+    comment(1, 'joe', 101),
+    comment(1, 'stranger', 101, workflow=True),
+    merged(1, 'jane', 101),
+    merged(2, 'stranger', 102),
+    patchset(3, 1, 'stranger', 103),
+    comment(3, 'jane', 104, workflow=True),
+]
+
+
+class TestSummary(unittest.TestCase):
+    def test_report(self):
+        report = summarize_events.Summary(USERS).update(EVENTS).report()
+        self.assertEqual({
+            'contributors-registered': 3,
+            'participants': 2,
+            'new-patches': 1,
+            'new-patches-total': 3,
+            'approved-patches': 2,
+            'code-reviews': 3,
+            'revised-patches': 1,
+            'revised-patches-total': 1,
+            'patches-merged-total': 2,
+            'impacted-bugs': 3,
+            'fixed-bugs': 1,
+        }, report)
+
+    def test_merge_matches_a_single_pass(self):
+        expected = summarize_events.Summary(USERS).update(EVENTS).report()
+        for split in range(len(EVENTS) + 1):
+            summary = summarize_events.Summary(USERS)
+            for part in (EVENTS[:split], EVENTS[split:]):
+                summary.merge(
+                    summarize_events.Summary(USERS).update(part).stats)
+            self.assertEqual(expected, summary.report(), split)
+
+    def test_merge_doesnt_count_sets_twice(self):
+        stats = summarize_events.Summary(USERS).update(EVENTS).stats
+        summary = summarize_events.Summary(USERS).merge(stats).merge(stats)
+        report = summary.report()
+        self.assertEqual(2, report['participants'])
+        self.assertEqual(3, report['impacted-bugs'])
+        self.assertEqual(6, report['code-reviews'])
+
+    def test_event_types(self):
+        summary = summarize_events.Summary(USERS)
+        summary.add({'type': 'topic-changed', 'change': change(1, 101)})
+        self.assertRaises(
+            ValueError, summary.add,
+            {'type': 'hashtags-changed', 'change': change(1, 101)})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import user_registry
+
+
+def comment(username, name, votes):
+    return {
+        'type': 'comment-added',
+        'author': {'username': username, 'name': name},
+        'approvals': [{'type': label, 'value': str(value)}
+                      for label, value in votes.items()],
+        'change': {'number': 1, 'owner': {'username': 'owner'}},
+    }
+
+
+class TestUserRegistry(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'event.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, events, mode='wb'):
+        with open(self.path, mode) as f:
+            for event in events:
+                f.write(json.dumps(event).encode('utf-8') + b'\n')
+
+    def test_learn(self):
+        registry = user_registry.UserRegistry()
+        registry.merge(user_registry.learn([
+            comment('zuul', 'Zuul', {'Verified': 1}),
+            comment('jane', 'Jane', {'Verified': 1, 'Code-Review': 2}),
+            comment('ci', 'Acme CI', {}),
+        ]))
+        self.assertTrue(registry.is_bot({'username': 'zuul'}))
+        self.assertFalse(registry.is_bot({'username': 'jane'}))
+        self.assertTrue(registry.is_bot({'username': 'ci'}))
+        self.assertFalse(registry.is_bot({'username': 'owner'}))
+        self.assertTrue(registry.is_bot(
+            {'username': 'unseen', 'name': 'Other CI'}))
+
+    def test_catch_up_in_parallel(self):
+        self.write([comment('user%d' % i, 'User', {'Code-Review': 1})
+                    for i in range(200)])
+        self.write([comment('zuul', 'Zuul', {'Verified': 1})], 'ab')
+        serial = user_registry.UserRegistry()
+        serial.catch_up(self.path)
+        parallel = user_registry.UserRegistry()
+        parallel.catch_up(self.path, jobs=3)
+        self.assertEqual(serial.users, parallel.users)
+        self.assertTrue(parallel.is_bot({'username': 'zuul'}))
+
+    def test_catch_up_bots_only(self):
+        events = [comment('user%d' % i, 'User', {'Code-Review': 1})
+                  for i in range(100)]
+        events[10] = comment('zuul', 'Zuul', {'Verified': 1})
+        events[20] = comment('acme', 'Acme CI', {})
+        self.write(events)
+        everyone = user_registry.UserRegistry()
+        everyone.catch_up(self.path)
+        bots = user_registry.UserRegistry()
+        bots.catch_up(self.path, bots_only=True)
+        self.assertTrue(len(bots.users) < len(everyone.users))
+        for event in events:
+            self.assertEqual(everyone.is_bot(event['author']),
+                             bots.is_bot(event['author']))
+        self.assertTrue(bots.is_bot({'username': 'zuul'}))
+        self.assertTrue(bots.is_bot({'username': 'acme'}))
+
+    def test_catch_up_truncated_in_place(self):
+        self.write([comment('jane', 'Jane', {'Code-Review': 1})])
+        registry = user_registry.UserRegistry()
+        registry.catch_up(self.path)
+        # Truncated, then grown past what was read before catching up again.
+        self.write([comment('zuul', 'Zuul', {'Verified': 1}),
+                    comment('joe', 'Joe', {'Code-Review': 1})])
+        registry.catch_up(self.path)
+        self.assertTrue(registry.is_bot({'username': 'zuul'}))
+        self.assertIn('joe', registry.users)
+
+
+if __name__ == '__main__':
+    unittest.main()
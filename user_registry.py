@@ -0,0 +1,238 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+"""A registry of the users seen in event logs, and which of them are bots.
+
+A user is a bot once they've cast a Verified vote without a Code-Review or
+Workflow vote, or if their name has " CI" in it. The registry is built from
+past logs, brought up to date with only what's been appended to them since,
+and saved so that renderers know every bot before reading their first event.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+
+import event_archive
+import event_log
+import event_store
+
+
+REGISTRY_VERSION = 1
+
+# Event types which don't name any users.
+UNRELATED_TYPES = frozenset([
+    'ref-replicated', 'ref-replication-done', 'ref-updated'])
+
+
+def is_ci_name(name):
+    return name is not None and ' CI' in name
+
+
+def may_show_bots(line):
+    """Return True if a raw event could show that one of its users is a bot.
+
+    Only events with a Verified vote, or a name with " CI" in it, can.
+    """
+    return b'"Verified"' in line or b' CI' in line
+
+
+def is_verifier(event):
+    """Return True if an event casts a Verified vote and no other."""
+    if event['type'] != 'comment-added':
+        return False
+    votes = {}
+    for approval in event.get('approvals', ()):
+        votes[approval['type']] = int(approval['value'])
+    return (votes.get('Verified', 0) != 0 and
+            votes.get('Code-Review', 0) == 0 and
+            votes.get('Workflow', 0) == 0)
+
+
+def event_users(event):
+    """Yield each user an event names."""
+    for value in event.values():
+        if event_store.is_account(value) and 'username' in value:
+            yield value
+    owner = event.get('change', {}).get('owner')
+    if owner is not None and 'username' in owner:
+        yield owner
+
+
+def learn(events):
+    """Return the users named in events, as {username: [is_bot, name]}."""
+    users = {}
+    for event in events:
+        for user in event_users(event):
+            entry = users.get(user['username'])
+            if entry is None:
+                entry = users[user['username']] = [False, None]
+            if 'name' in user:
+                entry[1] = user['name']
+                if is_ci_name(user['name']):
+                    entry[0] = True
+        if is_verifier(event) and 'username' in event['author']:
+            users[event['author']['username']][0] = True
+    return users
+
+
+def learn_chunk(work):
+    """Return the users named within a chunk of a JSON lines log.
+
+    If bots_only is set, only lines which could show that a user is a bot are
+    decoded, so users who aren't bots may be missed.
+    """
+    chunk, bots_only = work
+    skip = event_log.type_filter(UNRELATED_TYPES)
+    lines = event_log.read_chunk(*chunk)
+    if bots_only:
+        lines = (line for line in lines if may_show_bots(line))
+    return learn(
+        json.loads(line.decode('utf-8'))
+        for line in lines if not skip(line))
+
+
+class UserRegistry(object):
+    """Every user seen, keyed by username, with whether they're a bot.
+
+    Each entry is an ``[is_bot, name]`` list, where name is the latest
+    display name seen for the user.
+    """
+
+    def __init__(self, users=None):
+        self.users = users or {}
+        self.logs = {}
+
+    @classmethod
+    def load(cls, path):
+        """Load a saved registry, or return an empty one if there isn't one."""
+        registry = cls()
+        if os.path.exists(path):
+            with open(path) as f:
+                data = json.load(f)
+            if data.get('version') == REGISTRY_VERSION:
+                registry.users = data['users']
+                registry.logs = data['logs']
+        return registry
+
+    def save(self, path):
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({
+                'version': REGISTRY_VERSION,
+                'users': self.users,
+                'logs': self.logs,
+            }, f, separators=(',', ':'))
+        os.rename(tmp, path)
+
+    def is_bot(self, user):
+        entry = self.users.get(user['username'])
+        if entry is None:
+            # Not seen yet, so all we have to go on is their name.
+            return is_ci_name(user.get('name'))
+        return entry[0]
+
+    def add_bot(self, username):
+        self.users.setdefault(username, [True, None])[0] = True
+
+    def merge(self, users):
+        """Merge in users learned from later events."""
+        for username, (bot, name) in users.items():
+            entry = self.users.get(username)
+            if entry is None:
+                self.users[username] = [bot, name]
+                continue
+            entry[0] = entry[0] or bot
+            if name is not None:
+                entry[1] = name
+
+    def update(self, event):
+        """Learn the users named in an event."""
+        self.merge(learn([event]))
+
+    def catch_up(self, path, jobs=1, bots_only=False):
+        """Learn the users in a log which haven't been learned already.
+
+        Only the lines appended to a JSON lines log since it was last read are
+        read, across jobs processes if there's more than one; other kinds of
+        logs are read in full. If bots_only is set, JSON lines logs are only
+        read for their bots, which is much quicker, but leaves the registry
+        incomplete: it's then only good for telling bots apart.
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        progress = self.logs.get(path, (None, 0))
+        offset = event_log.resume_offset(path, *progress)
+
+        if event_store.is_store(path) or event_archive.is_archive(path):
+            self.merge(learn(event_log.iter_events(path, jobs=jobs)))
+            return
+
+        end = event_log.complete_size(path)
+        work = [(chunk, bots_only)
+                for chunk in event_log.chunks(path, jobs * 4, offset, end)]
+        if jobs > 1 and len(work) > 1:
+            pool = multiprocessing.Pool(min(jobs, len(work)))
+            try:
+                for users in pool.imap(learn_chunk, work):
+                    self.merge(users)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for users in map(learn_chunk, work):
+                self.merge(users)
+        self.logs[path] = (stat.st_ino, end, event_log.fingerprint(path, end))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Maintain a registry of the users in Gerrit event logs, '
+                    'and which of them are bots.')
+    parser.add_argument(
+        'logs', nargs='*',
+        help='Event logs to bring the registry up to date with.')
+    parser.add_argument(
+        '--registry', dest='registry',
+        default='users.json',
+        help='File the registry is kept in.')
+    parser.add_argument(
+        '--jobs', dest='jobs', type=int,
+        default=1,
+        help='Read logs in parallel across this many processes (0 to use '
+             'every CPU).')
+    parser.add_argument(
+        '--bots', dest='bots', action='store_true',
+        help='List the bots in the registry.')
+    args = parser.parse_args()
+
+    if args.jobs == 0:
+        args.jobs = multiprocessing.cpu_count()
+    registry = UserRegistry.load(args.registry)
+    if args.logs:
+        for path in args.logs:
+            registry.catch_up(path, args.jobs)
+        registry.save(args.registry)
+
+    if args.bots:
+        for username, (bot, name) in sorted(registry.users.items()):
+            if bot:
+                print('%s (%s)' % (username, name))
+    else:
+        print('%s: %d users, %d bots' % (
+            args.registry, len(registry.users),
+            sum(1 for bot, name in registry.users.values() if bot)))
+
+
+if __name__ == '__main__':
+    main()